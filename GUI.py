@@ -1,11 +1,53 @@
 import tkinter as tk
 from tkinter import ttk
-from config import GUI_WINDOW_DIMENSIONS, IMAGES_DIRECTORY
+from config import GUI_WINDOW_DIMENSIONS, GUI_PAGE_SIZE, GUI_EXPORT_DELAY_MS
 import user_feedback
-import subprocess
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
 import main
 import attack_scoring
 
+class PagedText(tk.Frame):
+    """ Read-only text pane showing a long list one page at a time, so its cost does not grow with the list """
+    def __init__(self, master, page_size=GUI_PAGE_SIZE, **text_options):
+        super().__init__(master)
+        self.page_size = page_size
+        self.header = ""
+        self.count = 0
+        self.item_text = None
+        self.page = 0
+
+        self.text = tk.Text(self, **text_options)
+        self.text.grid(row=0, column=0, columnspan=3)
+        self.prev_button = ttk.Button(self, text='< Prev', command=lambda: self.show_page(self.page - 1))
+        self.prev_button.grid(row=1, column=0, sticky='w')
+        self.page_label = ttk.Label(self, text="")
+        self.page_label.grid(row=1, column=1)
+        self.next_button = ttk.Button(self, text='Next >', command=lambda: self.show_page(self.page + 1))
+        self.next_button.grid(row=1, column=2, sticky='e')
+
+    def show(self, header, count, item_text):
+        """ Shows header above items 0..count-1, item_text(i) giving the text of item i. Only one page is built. """
+        self.header, self.count, self.item_text = header, count, item_text
+        self.show_page(0)
+
+    def show_page(self, page):
+        last_page = max(0, (self.count - 1) // self.page_size)
+        self.page = min(max(page, 0), last_page)
+        start = self.page * self.page_size
+        stop = min(start + self.page_size, self.count)
+
+        self.text.config(state="normal")
+        self.text.delete("1.0", tk.END)
+        self.text.insert(tk.END, self.header + "".join(self.item_text(i) for i in range(start, stop)))
+        self.text.config(state="disabled")
+
+        self.page_label.config(text=f"{start + 1 if self.count else 0}-{stop} of {self.count}")
+        self.prev_button.config(state='normal' if self.page > 0 else 'disabled')
+        self.next_button.config(state='normal' if self.page < last_page else 'disabled')
+
+
 class App(tk.Tk):
     def __init__(self):
         #basic setup
@@ -60,6 +102,10 @@ class App(tk.Tk):
         self.load_button = ttk.Button(self.dropdown_container, text='Reload data', command=self.load_system_data)
         self.load_button.grid(row=0, column=0, pady=10)
 
+        self.status_var = tk.StringVar(value="")
+        self.status_label = ttk.Label(self.dropdown_container, textvariable=self.status_var, wraplength=350)
+        self.status_label.grid(row=3, column=0, sticky='w')
+
         self.subgraph_var = tk.StringVar()
         self.subgraph_dropdown = ttk.Combobox(self.dropdown_container, textvariable=self.subgraph_var, state="readonly")
         self.subgraph_dropdown.grid(row=1, column=0)
@@ -71,23 +117,45 @@ class App(tk.Tk):
         self.info_scrollbar = ttk.Scrollbar(info_frame)
         #self.info_scrollbar.grid(row=0,column=1)
 
-        self.subgraph_info_box = tk.Text(info_frame, width=50, height=15, wrap="word", yscrollcommand=self.info_scrollbar.set)
-        self.subgraph_info_box.grid(row=0,column=0)
+        # Both panes only build the page being shown, whatever the size of the incident
+        self.alert_pane = PagedText(info_frame, width=50, height=15, wrap="word", yscrollcommand=self.info_scrollbar.set)
+        self.alert_pane.grid(row=0,column=0)
+        self.subgraph_info_box = self.alert_pane.text
 
         self.info_scrollbar.config(command=self.subgraph_info_box.yview)
 
-        self.host_info_container = tk.Text(info_frame, width=50, height=15, wrap="word", yscrollcommand=self.info_scrollbar.set)
-        self.host_info_container.grid(row=1,column=0)
-
-
-        # Populate dropdown
-        self.all_event_subgraphs = main.ev_data_tracker.sort_by_score(return_copy=True)
-        #self.subgraph_dropdown["values"] = ["Event "+str(sg["Index"])+" | Score: "+str(sg["Score"]) for sg in self.all_event_subgraphs]
-        self.subgraph_dropdown["values"] = [sg["Index"] for sg in self.all_event_subgraphs if sg["Index"] < main.GRAPH_DISPLAY_CUTOFF]
+        self.host_pane = PagedText(info_frame, width=50, height=15, wrap="word", yscrollcommand=self.info_scrollbar.set)
+        self.host_pane.grid(row=1,column=0)
+        self.host_info_container = self.host_pane.text
+
+
+        # The pipeline runs on a worker thread; the dropdown is populated when its first run is done
+        self.pipeline = None
+        self.all_event_subgraphs = []
+        self.subgraphs_by_index = {}
+        self.pipeline_queue = queue.Queue()
+        self.pipeline_thread = None
+        # Feedback exports the scores on this thread, one export at a time, so the window never waits for them
+        self.export_executor = ThreadPoolExecutor(max_workers=1)
+        self.export_after_id = None
+        self.export_future = None
         self.subgraph_dropdown.bind("<<ComboboxSelected>>", self.on_dropdown_select)
+        self.load_system_data()
     
     def update_image(self, path):
         self.attack_image.config(file=path)
+
+    def show_image_when_ready(self, selected_index, future, poll_ms=100):
+        """ Shows the rendered image unless another incident was selected since """
+        if self.subgraph_var.get() != selected_index:
+            return
+        if future.done():
+            self.image_container.config(text='Attack Graph')
+            if not future.cancelled() and future.exception() is None: # cancelled by a reload, or the render failed
+                self.update_image(future.result())
+        else:
+            self.image_container.config(text='Attack Graph (rendering...)')
+            self.after(poll_ms, self.show_image_when_ready, selected_index, future, poll_ms)
         
     def update_user_feedback(self, dct):
 
@@ -122,60 +190,53 @@ class App(tk.Tk):
             tactic_dict["Exfiltration"] = self.bool_exfiltration.get()
         if self.tactic_statuses["Defense Evasion"] == 'enabled':
             tactic_dict["Defense Evasion"] = self.bool_defense_evasion.get()
-        user_feedback.update_weight_parameters(tactic_dict)
+        weights = user_feedback.update_weight_parameters(tactic_dict)
+        # Scores are linear in the weights, so every incident is rescored at once from the run's marginals
+        self.pipeline.rescorer.rescore(weights)
+        self.show_incidents()
+        self.schedule_export()
+        self.status_var.set("Scores and priorities updated with the feedback.")
+
+    def schedule_export(self, delay_ms=GUI_EXPORT_DELAY_MS):
+        """ Exports the scores once no feedback came for delay_ms, so a burst of submissions writes them once """
+        if self.export_after_id is not None:
+            self.after_cancel(self.export_after_id)
+        self.export_after_id = self.after(delay_ms, self.start_export)
+
+    def start_export(self):
+        """ Exports a snapshot of the current scores on the export thread; the Tk thread only copies them """
+        self.export_after_id = None
+        snapshot = self.pipeline.ev_data_tracker.snapshot()
+        self.export_future = self.export_executor.submit(snapshot.export)
+        self.poll_export(self.export_future)
+
+    def poll_export(self, future, poll_ms=100):
+        if not future.done():
+            self.after(poll_ms, self.poll_export, future, poll_ms)
+        elif future.exception() is not None:
+            self.status_var.set(f"Exporting the scores failed: {future.exception()}")
+        elif not self.pipeline_thread.is_alive(): # a reload reports its own progress
+            self.status_var.set("Scores and priorities updated with the feedback, and exported.")
 
     def on_dropdown_select(self, event=None):
         selected_index = self.subgraph_var.get()
-        selected_subgraph = next((sg for sg in self.all_event_subgraphs if str(sg["Index"]) == selected_index), None)
+        selected_subgraph = self.subgraphs_by_index.get(selected_index)
         if selected_subgraph:
-            # Update image path
-            if int(selected_index) < main.GRAPH_DISPLAY_CUTOFF:
-                image_path = IMAGES_DIRECTORY + f"event_subgraph_{selected_index}.png"
-                self.update_image(image_path)
-            else:
-                self.attack_image.config(file=IMAGES_DIRECTORY + "placeholder.png")
-
-
-            # Display basic info
-            self.subgraph_info_box.config(state="normal")
-            self.subgraph_info_box.delete("1.0", tk.END)
-            self.subgraph_info_box.insert(tk.END, f"Alert index: \t\t{selected_index}")
-            score = selected_subgraph["Priority"]
-            print(score)
-            self.subgraph_info_box.insert(tk.END, f"\tPriority: \t{score}")
-            subgraph = selected_subgraph["Subgraph"]
-            self.subgraph_info_box.insert(tk.END, "\n\n"+"="*20+ " ALERTS " + "="*20+"\n")
-            for node in subgraph.nodes():
-                desc = subgraph.nodes[node].get("description", "[Missing description]")
-                type = subgraph.nodes[node].get("type", "[Missing type]")
-                message = subgraph.nodes[node].get("alert_message", "[Missing message]")
-                timestamp = subgraph.nodes[node].get("timestamp", "[Missing timestamp]")
-                self.subgraph_info_box.insert(tk.END, f"\nDescription: \t{desc}")
-                self.subgraph_info_box.insert(tk.END, f"\nType: \t{type}")
-                self.subgraph_info_box.insert(tk.END, f"\nMessage: \t{message}")
-                self.subgraph_info_box.insert(tk.END, f"\nTimestamp: \t{timestamp}")
-                self.subgraph_info_box.insert(tk.END, "\n"+"-"*50)
-            self.subgraph_info_box.config(state="disabled")
-
-            self.host_info_container.config(state="normal")
-            self.host_info_container.delete("1.0", tk.END)
-            self.host_info_container.insert(tk.END, f"Event index: \t\t{selected_index}")
-            self.host_info_container.insert(tk.END, "\n\n"+"="*20+ " HOSTS " + "="*20+"\n")
-            for node in subgraph.nodes():
-                for neighbor in main.G.neighbors(node):
-                    if main.G.nodes[neighbor].get("type") == "Host":
-                        host_props = main.G.nodes[neighbor].get("properties", {})
-                        ip_address = host_props["ip_address"]
-                        os_type = host_props["os_type"]
-                        department = host_props["department"]
-                        host_name = main.G.nodes[neighbor].get("name", {})
-                        self.host_info_container.insert(tk.END, f"\nName: \t\t{host_name}")
-                        self.host_info_container.insert(tk.END, f"\nIP address: \t{ip_address}")
-                        self.host_info_container.insert(tk.END, f"\nOS type: \t\t{os_type}")
-                        self.host_info_container.insert(tk.END, f"\nDepartment: \t{department}")
-                        self.host_info_container.insert(tk.END, "\n"+"-"*50)
-            self.host_info_container.config(state="disabled")
-            
+            # Show the image once it is rendered, without blocking the window meanwhile
+            self.show_image_when_ready(selected_index, self.pipeline.renderer.request(int(selected_index)))
+
+
+            # Display basic info, one page of alerts and hosts at a time
+            store = self.pipeline.store
+            rows = self.pipeline.component_rows[int(selected_index)]
+            priority = selected_subgraph["Priority"]
+            alert_header = f"Alert index: \t\t{selected_index}\tPriority: \t{priority}\n\n" + "="*20 + " ALERTS " + "="*20 + "\n"
+            self.alert_pane.show(alert_header, len(rows), lambda i: self.alert_text(store, rows[i]))
+
+            _, hosts = store.hosts_of_rows(rows)
+            host_header = f"Event index: \t\t{selected_index}\n\n" + "="*20 + " HOSTS " + "="*20 + "\n"
+            self.host_pane.show(host_header, len(hosts), lambda i: self.host_text(store, hosts[i]))
+
             subgraph_tactics = {"Initial Access": False, "Privilege Escalation": False, "Collection": False, "Exfiltration": False, "Defense Evasion": False}
             for key in selected_subgraph['Marginals'].keys():
                 subgraph_tactics[key] = True
@@ -183,8 +244,86 @@ class App(tk.Tk):
 
             
 
+    @staticmethod
+    def alert_text(store, row):
+        desc = store.get(row, "description", "[Missing description]")
+        type = store.get(row, "type", "[Missing type]")
+        message = store.get(row, "alert_message", "[Missing message]")
+        timestamp = store.get(row, "timestamp", "[Missing timestamp]")
+        return f"\nDescription: \t{desc}\nType: \t{type}\nMessage: \t{message}\nTimestamp: \t{timestamp}\n" + "-"*50
+
+    @staticmethod
+    def host_text(store, host):
+        host_props = store.host_properties[host]
+        return (f"\nName: \t\t{store.host_names[host]}\nIP address: \t{host_props['ip_address']}"
+                f"\nOS type: \t\t{host_props['os_type']}\nDepartment: \t{host_props['department']}\n" + "-"*50)
+
     def load_system_data(self):
-        subprocess.run(["python", "main.py"])
+        """ Starts a pipeline run on a worker thread, unless one is already running """
+        if self.pipeline_thread is not None and self.pipeline_thread.is_alive():
+            return
+        # No feedback until the run is done: it would rescore the run being replaced
+        self.load_button.config(state='disabled')
+        self.submit_button.config(state='disabled')
+        # The run scores and exports everything with the latest weights, a pending feedback export is moot
+        if self.export_after_id is not None:
+            self.after_cancel(self.export_after_id)
+            self.export_after_id = None
+        self.pipeline_thread = threading.Thread(target=self.run_pipeline, args=(self.export_future,), daemon=True)
+        self.pipeline_thread.start()
+        self.poll_pipeline()
+
+    def run_pipeline(self, running_export=None):
+        """ Worker thread: runs the pipeline and reports through pipeline_queue, never touches Tk """
+        try:
+            if running_export is not None:
+                wait([running_export]) # else its older scores could be moved over the run's export
+            result = main.run_pipeline(progress=lambda message: self.pipeline_queue.put(("progress", message)))
+            self.pipeline_queue.put(("done", result))
+        except Exception as e:
+            self.pipeline_queue.put(("error", e))
+
+    def poll_pipeline(self, poll_ms=100):
+        """ Handles the worker thread's messages on the Tk thread, until its run is over """
+        while True:
+            try:
+                kind, payload = self.pipeline_queue.get_nowait()
+            except queue.Empty:
+                break
+            if kind == "progress":
+                self.status_var.set(payload)
+            elif kind == "done":
+                self.swap_pipeline(payload)
+                self.status_var.set("Data loaded.")
+                self.load_button.config(state='normal')
+                self.submit_button.config(state='normal')
+                return
+            else:
+                self.status_var.set(f"Reload failed: {payload}")
+                self.load_button.config(state='normal')
+                self.submit_button.config(state='normal' if self.pipeline is not None else 'disabled')
+                return
+        self.after(poll_ms, self.poll_pipeline, poll_ms)
+
+    def swap_pipeline(self, result):
+        """ Replaces the displayed run with a finished one, all at once on the Tk thread """
+        old_pipeline = self.pipeline
+        self.pipeline = result
+        self.show_incidents()
+        if old_pipeline is not None:
+            old_pipeline.renderer.shutdown(wait=False)
+
+    def show_incidents(self):
+        """ Lists the current run's incidents by score, keeping the selected one shown with its new priority """
+        result = self.pipeline
+        self.all_event_subgraphs = result.ev_data_tracker.sort_by_score(return_copy=True)
+        self.subgraphs_by_index = {str(sg["Index"]): sg for sg in self.all_event_subgraphs}
+        #self.subgraph_dropdown["values"] = ["Event "+str(sg["Index"])+" | Score: "+str(sg["Score"]) for sg in self.all_event_subgraphs]
+        self.subgraph_dropdown["values"] = [sg["Index"] for sg in self.all_event_subgraphs if sg["Index"] < result.GRAPH_DISPLAY_CUTOFF]
+        if self.subgraph_var.get() in map(str, self.subgraph_dropdown["values"]):
+            self.on_dropdown_select()
+        else:
+            self.subgraph_var.set("")
 
 
 if __name__ == "__main__":
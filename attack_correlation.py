@@ -1,17 +1,21 @@
 import networkx as nx
+import instrumentation
 from itertools import product
+from bisect import bisect_right
 from datetime import datetime
-from config import CORRELATION_THRESHOLD, MITRE_TRANSITION, EVENT_TYPE_TO_MITRE
+from utils import save_graph
+from config import CORRELATION_THRESHOLD, CORRELATION_ENGINE, MITRE_TRANSITION, EVENT_TYPE_TO_MITRE
+from correlation_kernel import vectorized_correlation_edges, store_correlation_edges
 
-def build_event_to_ips_map(G):
+def build_event_to_ips_map(G, nodes=None):
   '''
   Returns a dictionary that links event nodes in G
   to the set of all IPs addresses of hosts connected to the
-  event in G.
+  event in G. If nodes is given, only those nodes are looked at.
   '''
   event_to_ips = {}
 
-  for node in G.nodes:
+  for node in (G.nodes if nodes is None else nodes):
     if G.nodes[node].get("node_type") == "event":
       # Collect IPs from all Host entities linked to this event
       ips = set()
@@ -25,15 +29,31 @@ def build_event_to_ips_map(G):
 
   return event_to_ips
 
-def alert_correlation_measure(vertex1, vertex2, data: dict, event_to_ips: dict) -> float:
+def build_ip_index(event_to_ips: dict, event_times: dict) -> dict:
+  '''
+  Inverts the output of build_event_to_ips_map: returns a dictionary
+  mapping each IP address to the list of events seen on it, sorted by
+  timestamp. event_times maps event ids to parsed datetimes.
+  '''
+  ip_index = {}
+  for event_id, ips in event_to_ips.items():
+    for ip in ips:
+      ip_index.setdefault(ip, []).append(event_id)
+
+  for ip in ip_index:
+    ip_index[ip].sort(key=event_times.__getitem__)
+
+  return ip_index
+
+def alert_correlation_measure(vertex1, vertex2, data: dict, event_to_ips: dict, event_lookup: dict=None) -> float:
   '''
   Args are nodes of a graph that correspond to events.
   Returns thee computed value C(vertex1, vertex2) as defined in (3),
   page 5 of https://arxiv.org/pdf/2101.02573.
-  Yes, I KNOW this program is wildly inefficient and yes,
-  I know how to make it faster, bear with me it works for now.
+  Pass event_lookup (event id -> event) to avoid rebuilding it on every call.
   '''
-  event_lookup = {event["id"]: event for event in data["events"]}
+  if event_lookup is None:
+    event_lookup = {event["id"]: event for event in data["events"]}
 
   event1 = event_lookup[vertex1]
   event2 = event_lookup[vertex2]
@@ -49,27 +69,296 @@ def alert_correlation_measure(vertex1, vertex2, data: dict, event_to_ips: dict)
 
   return max(set_T_KC) * max(set_C_IP), shared_ips
 
-def attack_correlation(G: nx.Graph, data: dict) -> nx.DiGraph:
+def naive_correlation_edges(event_nodes: list, data: dict, event_to_ips: dict):
   '''
-  Returns the attack correlation graph corresponding to G, the graph with
-  nodes consisting of all events and entities, as produces by the data_loader
+  Yields (u, v, score, shared_ips) for every correlated pair by checking
+  all ordered pairs of events. Quadratic; kept as a reference implementation.
   '''
-  event_nodes = [n for n, d in G.nodes(data=True) if d.get("node_type") == "event"]
   event_lookup = {event["id"]: event for event in data["events"]}
+  instrumentation.count("correlation.pairs_evaluated", len(event_nodes) ** 2)
 
-  attack_correlation_graph = nx.DiGraph()
-  attack_correlation_graph.add_nodes_from((n, G.nodes[n]) for n in event_nodes)
-
-  event_to_ips = build_event_to_ips_map(G)
   for u, v in product(event_nodes, repeat=2):
     # Temporal logic:
     time_u = datetime.fromisoformat(event_lookup[u]["timestamp"])
     time_v = datetime.fromisoformat(event_lookup[v]["timestamp"])
 
     if time_u < time_v:
-      score, shared_ips = alert_correlation_measure(u, v, data, event_to_ips)
+      score, shared_ips = alert_correlation_measure(u, v, data, event_to_ips, event_lookup)
+      if score > CORRELATION_THRESHOLD:
+        yield u, v, score, shared_ips
+
+def indexed_correlation_edges(event_nodes: list, data: dict, event_to_ips: dict):
+  '''
+  Yields the same edges as naive_correlation_edges, in the same order, but
+  only visits time-ordered pairs of events that share a host IP. Pairs without
+  a shared IP always score 0, so nothing is lost.
+  '''
+  event_lookup = {event["id"]: event for event in data["events"]}
+  event_times = {n: datetime.fromisoformat(event_lookup[n]["timestamp"]) for n in event_nodes}
+  position = {n: i for i, n in enumerate(event_nodes)}
+  ip_index = build_ip_index({n: event_to_ips.get(n, set()) for n in event_nodes}, event_times)
+
+  # A pair sharing several IPs shows up in several buckets, so collect first
+  successors = {}
+  for bucket in ip_index.values():
+    times = [event_times[n] for n in bucket]
+    for i, u in enumerate(bucket):
+      later = bucket[bisect_right(times, times[i], lo=i + 1):] # strictly later events only
+      if later:
+        successors.setdefault(u, set()).update(later)
+
+  instrumentation.count("correlation.pairs_evaluated", sum(len(later) for later in successors.values()))
+  # Visit pairs in the order of product(event_nodes, repeat=2)
+  for u in sorted(successors, key=position.__getitem__):
+    for v in sorted(successors[u], key=position.__getitem__):
+      score, shared_ips = alert_correlation_measure(u, v, data, event_to_ips, event_lookup)
       if score > CORRELATION_THRESHOLD:
-        match_IP = ",".join(shared_ips)
-        attack_correlation_graph.add_edge(u, v, weight=score, match_IP=match_IP)
+        yield u, v, score, shared_ips
+
+class EventComponents:
+  """
+  Disjoint-set forest over the events of an attack correlation graph, kept up to date as
+  edges are added so the connected components never have to be extracted afterwards.
+  Uses union by size and path halving, so a sequence of n operations is near linear.
+  Kept in H.graph["components"], see event_components.
+  """
+  def __init__(self, nodes=()):
+    self.parent = {}
+    self.size = {}
+    for node in nodes:
+      self.add(node)
+
+  def add(self, node):
+    if node not in self.parent:
+      self.parent[node] = node
+      self.size[node] = 1
+
+  def find(self, node):
+    parent = self.parent
+    while parent[node] != node:
+      parent[node] = parent[parent[node]]
+      node = parent[node]
+    return node
+
+  def union(self, u, v):
+    root_u, root_v = self.find(u), self.find(v)
+    if root_u == root_v:
+      return
+    if self.size[root_u] < self.size[root_v]:
+      root_u, root_v = root_v, root_u
+    self.parent[root_v] = root_u
+    self.size[root_u] += self.size.pop(root_v)
+
+  def __len__(self) -> int:
+    return len(self.size)
+
+  def components(self) -> tuple:
+    '''
+    Returns (members, component_of): the member lists of every component, largest first, and
+    a dictionary mapping each event to the index of its component in members. Members are
+    in insertion order and ties keep the order of their first member, which is the order
+    sorting nx.connected_components by size gives.
+    '''
+    by_root = {}
+    for node in self.parent:
+      by_root.setdefault(self.find(node), []).append(node)
+    members = sorted(by_root.values(), key=len, reverse=True)
+    component_of = {node: i for i, component in enumerate(members) for node in component}
+    return members, component_of
+
+def event_components(H: nx.DiGraph) -> EventComponents:
+  '''
+  Returns the EventComponents of H. Graphs built by this module carry it in H.graph;
+  for other graphs (e.g. cached before it existed) it is built from the edges once and kept.
+  '''
+  if "components" not in H.graph:
+    components = EventComponents(H.nodes)
+    for u, v in H.edges():
+      components.union(u, v)
+    H.graph["components"] = components
+  return H.graph["components"]
+
+CORRELATION_ENGINES = {"naive"     : naive_correlation_edges,
+                       "indexed"   : indexed_correlation_edges,
+                       "vectorized": vectorized_correlation_edges}
+
+def attack_correlation(G: nx.Graph, data: dict, engine: str=CORRELATION_ENGINE) -> nx.DiGraph:
+  '''
+  Returns the attack correlation graph corresponding to G, the graph with
+  nodes consisting of all events and entities, as produces by the data_loader.
+  engine is one of the keys of CORRELATION_ENGINES.
+  '''
+  if engine not in CORRELATION_ENGINES:
+    raise ValueError(f"Unknown correlation engine '{engine}'. Use one of {list(CORRELATION_ENGINES)}.")
+
+  event_nodes = [n for n, d in G.nodes(data=True) if d.get("node_type") == "event"]
+
+  attack_correlation_graph = nx.DiGraph()
+  attack_correlation_graph.add_nodes_from((n, G.nodes[n]) for n in event_nodes)
+
+  components = attack_correlation_graph.graph["components"] = EventComponents(event_nodes)
+  event_to_ips = build_event_to_ips_map(G)
+  for u, v, score, shared_ips in CORRELATION_ENGINES[engine](event_nodes, data, event_to_ips):
+    match_IP = ",".join(shared_ips)
+    attack_correlation_graph.add_edge(u, v, weight=score, match_IP=match_IP)
+    components.union(u, v)
+
+  instrumentation.count("correlation.edges_emitted", attack_correlation_graph.number_of_edges())
+  return attack_correlation_graph
+
+def attack_correlation_from_store(store) -> nx.DiGraph:
+  '''
+  Returns the attack correlation graph of the events of an EventStore, using the
+  vectorized engine. It has the same nodes and edges as attack_correlation, but the
+  nodes carry no copy of the event: their data is read from the store with store.row_of.
+  '''
+  attack_correlation_graph = nx.DiGraph()
+  attack_correlation_graph.add_nodes_from(store.ids)
+  components = attack_correlation_graph.graph["components"] = EventComponents(store.ids)
+
+  for u, v, score, shared_ips in store_correlation_edges(store):
+    attack_correlation_graph.add_edge(store.ids[u], store.ids[v], weight=score, match_IP=",".join(shared_ips))
+    components.union(store.ids[u], store.ids[v])
+
+  instrumentation.count("correlation.edges_emitted", attack_correlation_graph.number_of_edges())
+  return attack_correlation_graph
+
+def hosts_by_ip(G) -> dict:
+  '''
+  Returns a dictionary mapping IP addresses to the Host entities of G that have them.
+  Built once per graph and kept in G.graph; update_attack_correlation keeps it current.
+  '''
+  if "hosts_by_ip" not in G.graph:
+    index = {}
+    for node, d in G.nodes(data=True):
+      if d.get("node_type") == "entity" and d.get("type") == "Host":
+        ip = d.get("properties", {}).get("ip_address")
+        if ip:
+          index.setdefault(ip, set()).add(node)
+    G.graph["hosts_by_ip"] = index
+  return G.graph["hosts_by_ip"]
+
+def update_attack_correlation(H: nx.DiGraph, G: nx.Graph, new_events: list, new_entities: list=(),
+                              new_relationships: list=(), save_path: str=None) -> nx.DiGraph:
+  '''
+  Appends a batch of new events, entities and relationships to an existing attack
+  correlation graph H in place, and returns it. G is updated with the batch the same
+  way data_loader builds it. Records already in G (e.g. because G was loaded from the
+  full dataset) are not added twice.
+
+  Only pairs involving an affected event are scored: the new events, and old events
+  that gained a relationship in this batch. The work is proportional to the batch and
+  to the events sharing an IP with it, not to the size of H. The resulting edges are
+  the same as those of a full attack_correlation rebuild.
+  If save_path is given, the updated graph is saved there with save_graph.
+  '''
+  ip_hosts = hosts_by_ip(G)
+  for entity in new_entities:
+    if entity["id"] not in G:
+      G.add_node(entity["id"], **entity, node_type="entity")
+      if entity.get("type") == "Host" and entity.get("properties", {}).get("ip_address"):
+        ip_hosts.setdefault(entity["properties"]["ip_address"], set()).add(entity["id"])
+
+  affected = []
+  for event in new_events:
+    if event["id"] not in H:
+      G.add_node(event["id"], **event, node_type="event")
+      affected.append(event["id"])
+
+  for rel in new_relationships:
+    G.add_edge(rel["source"], rel["target"], **rel)
+    if rel["source"] in H and rel["source"] not in affected:
+      affected.append(rel["source"])
+
+  components = event_components(H)
+  H.add_nodes_from((n, G.nodes[n]) for n in affected if n not in H)
+  for n in affected:
+    components.add(n)
+
+  # All events sharing an IP with an affected event, found through the hosts having that IP
+  event_to_ips = build_event_to_ips_map(G, affected)
+  candidates = set(affected)
+  for ips in event_to_ips.values():
+    for ip in ips:
+      for host in ip_hosts.get(ip, ()):
+        candidates.update(n for n in G.predecessors(host) if n in H)
+  event_to_ips.update(build_event_to_ips_map(G, candidates - event_to_ips.keys()))
+
+  event_times = {n: datetime.fromisoformat(G.nodes[n]["timestamp"]) for n in candidates}
+  ip_index = build_ip_index(event_to_ips, event_times)
+  affected_set = set(affected)
+  edges_before = H.number_of_edges()
+  pairs = set()
+  for bucket in ip_index.values():
+    for u in bucket:
+      if u in affected_set:
+        pairs.update((u, v) for v in bucket if event_times[u] < event_times[v])
+        pairs.update((v, u) for v in bucket if event_times[v] < event_times[u])
+
+  instrumentation.count("correlation.pairs_evaluated", len(pairs))
+  for u, v in pairs:
+    score, shared_ips = alert_correlation_measure(u, v, None, event_to_ips, G.nodes)
+    if score > CORRELATION_THRESHOLD:
+      H.add_edge(u, v, weight=score, match_IP=",".join(shared_ips))
+      components.union(u, v)
+  instrumentation.count("correlation.edges_emitted", H.number_of_edges() - edges_before)
+
+  if save_path:
+    save_graph(H, save_path)
+
+  return H
+
+def update_attack_correlation_from_store(H: nx.DiGraph, store, save_path: str=None) -> nx.DiGraph:
+  '''
+  Store counterpart of update_attack_correlation: adds the events of store that are
+  not yet in H, built by attack_correlation_from_store from an earlier version of the
+  data, along with the edges touching them. Returns H, saved to save_path if given.
+  '''
+  new_rows = [row for row, event_id in enumerate(store.ids) if event_id not in H]
+  components = event_components(H)
+  H.add_nodes_from(store.ids[row] for row in new_rows)
+  for row in new_rows:
+    components.add(store.ids[row])
+
+  edges_before = H.number_of_edges()
+  for u, v, score, shared_ips in store_correlation_edges(store, new_rows):
+    H.add_edge(store.ids[u], store.ids[v], weight=score, match_IP=",".join(shared_ips))
+    components.union(store.ids[u], store.ids[v])
+  instrumentation.count("correlation.edges_emitted", H.number_of_edges() - edges_before)
+
+  if save_path:
+    save_graph(H, save_path)
+
+  return H
+
+def same_correlation_graph(H1: nx.DiGraph, H2: nx.DiGraph) -> bool:
+  '''
+  Returns True if both graphs have the same nodes and the same edges, in the
+  same order, with the same weight and match_IP attributes.
+  '''
+  return list(H1.nodes) == list(H2.nodes) and list(H1.edges(data=True)) == list(H2.edges(data=True))
+
+if __name__ == "__main__":
+  # Benchmark of the correlation engines on growing prefixes of the data
+  from time import perf_counter
+  from data_loader import data_load_into_graph as load
+
+  G, data = load()
+  sizes = [n for n in (100, 200, 400, 800, 1600, 3200) if n < len(data["events"])] + [len(data["events"])]
+
+  for size in sizes:
+    events = data["events"][:size]
+    event_ids = {event["id"] for event in events}
+    keep = [n for n, d in G.nodes(data=True) if d.get("node_type") != "event" or n in event_ids]
+    G_sub, data_sub = G.subgraph(keep), {"events": events}
+
+    timings = {}
+    graphs = {}
+    for engine in CORRELATION_ENGINES:
+      start = perf_counter()
+      graphs[engine] = attack_correlation(G_sub, data_sub, engine=engine)
+      timings[engine] = perf_counter() - start
 
-  return attack_correlation_graph
\ No newline at end of file
+    for engine in CORRELATION_ENGINES:
+      assert same_correlation_graph(graphs["naive"], graphs[engine]), engine
+    print(f"{size:>8} events | " + " | ".join(f"{e}: {t:.3f}s" for e, t in timings.items()))
@@ -1,12 +1,112 @@
+from __future__ import annotations
 from typing import List, Dict
 
+import os
 import json
+import tempfile
 from json.decoder import JSONDecodeError
-from copy import deepcopy
+from bisect import bisect_right
+import numpy as np
 
-from factor_graph import FactorGraph
+from factor_graph import FactorGraph, TacticSummary
+from quantile_sketch import StreamingPriorityAssigner
+import config
 from config import *
 
+_UMASK = os.umask(0o022)
+os.umask(_UMASK)
+
+def temporary_path(filename: str, suffix: str=".tmp") -> str:
+    """ Creates an empty file next to filename, under a name no other writer gets, with the permissions
+    of a newly created file (mkstemp alone makes it private). Returns its path, to write and then
+    os.replace over filename. """
+    fd, path = tempfile.mkstemp(dir=os.path.dirname(filename) or ".", prefix=os.path.basename(filename) + ".", suffix=suffix)
+    os.close(fd)
+    os.chmod(path, 0o666 & ~_UMASK)
+    return path
+
+class ScoreExportSink:
+    """ Buffered, append-only export of incident scores, meant to be shared by every incident of a run.
+    Records are written as JSON Lines in batches of batch_size to a temporary file, which finalize
+    renames over filename, so readers only ever see a complete export. Used as a context manager,
+    the export is finalized on success and discarded if an exception is raised.
+    With fmt="txt" the lines have the format of ScoreCalculator.export_scores_txt instead.
+    With binary=True the scores are also saved as NumPy columns in filename with an .npz extension:
+    index, name, score, priority and marginals (one column per MITRE tactic, NaN where absent).
+    """
+    def __init__(self, filename: str=DEFAULT_SCORES_PATH_JSONL, batch_size: int=EXPORT_BATCH_SIZE,
+                 fmt: str="jsonl", binary: bool=EXPORT_BINARY):
+        if fmt not in ("jsonl", "txt"):
+            raise ValueError(f"Unknown export format '{fmt}'. Use 'jsonl' or 'txt'.")
+        self.filename = filename
+        self.batch_size = batch_size
+        self.fmt = fmt
+        self.binary = binary
+        self.count = 0
+        self.buffer = []
+        self.columns = {"index": [], "name": [], "score": [], "priority": [], "marginals": []}
+
+        os.makedirs(os.path.dirname(filename) or ".", exist_ok=True)
+        self.tmp_filename = temporary_path(filename)
+        self.file = open(self.tmp_filename, mode="w")
+
+    def write(self, record: Dict):
+        """ Adds one incident, a dict with "marginals" and "score" and optionally "name", "index" and "priority" """
+        if self.fmt == "jsonl":
+            self.buffer.append(json.dumps(record))
+        else:
+            marginal_output = ','.join(f"{tactic},{record['marginals'][tactic]}" for tactic in record["marginals"])
+            self.buffer.append(f"{record.get('name')},{marginal_output},Score,{record['score']}")
+        if self.binary:
+            self.columns["index"].append(record.get("index", self.count))
+            self.columns["name"].append(str(record.get("name", "")))
+            self.columns["score"].append(record["score"])
+            self.columns["priority"].append(str(record.get("priority")))
+            self.columns["marginals"].append([record["marginals"].get(tactic, np.nan) for tactic in MITRE_TACTICS])
+        self.count += 1
+        if len(self.buffer) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self.file.write("\n".join(self.buffer) + "\n")
+            self.buffer = []
+
+    def finalize(self):
+        """ Writes what is left and moves the export into place """
+        self.flush()
+        self.file.close()
+        os.replace(self.tmp_filename, self.filename)
+        if self.binary:
+            binary_filename = os.path.splitext(self.filename)[0] + ".npz"
+            tmp_filename = temporary_path(binary_filename, suffix=".tmp.npz")
+            try:
+                np.savez(tmp_filename, index=np.asarray(self.columns["index"], dtype=np.int64),
+                         name=np.asarray(self.columns["name"]), score=np.asarray(self.columns["score"], dtype=np.float64),
+                         priority=np.asarray(self.columns["priority"]),
+                         marginals=np.asarray(self.columns["marginals"], dtype=np.float64).reshape(-1, len(MITRE_TACTICS)),
+                         tactics=np.asarray(MITRE_TACTICS))
+                os.replace(tmp_filename, binary_filename)
+            except BaseException:
+                os.remove(tmp_filename)
+                raise
+
+    def discard(self):
+        """ Drops the export, leaving any previous one in place """
+        self.file.close()
+        if os.path.exists(self.tmp_filename):
+            os.remove(self.tmp_filename)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.finalize()
+        else:
+            self.discard()
+
+
 class ScoreCalculator:
     """ Class designed to compute scores given alerts and factor graph.
     Used a class so different 'types' of scores can be calculated if needed.
@@ -14,23 +114,63 @@ class ScoreCalculator:
     """
     def __init__(self, alerts: List, fg: FactorGraph):
         self.alerts = alerts
+        self.severities = [alert['severity'] for alert in alerts]
+        self.tactics = [EVENT_TYPE_TO_MITRE[alert['type']][0] for alert in alerts]
         self.fg = fg
+        self.summary = None
         self.score = None
+
+    @classmethod
+    def from_store(cls, store, rows: List[int], fg: FactorGraph):
+        """ Score calculator for the alerts at the given rows of an EventStore """
+        return cls.from_arrays(store.tactic_codes[rows], store.severity[rows], fg)
+
+    @classmethod
+    def from_arrays(cls, tactic_codes: np.ndarray, severities: np.ndarray, fg: FactorGraph):
+        """ Score calculator for alerts given by their tactic codes and severities """
+        sc = cls([], fg)
+        sc.severities = severities.tolist()
+        sc.tactics = [MITRE_TACTICS[code] for code in tactic_codes.tolist()]
+        return sc
     
+    @classmethod
+    def from_summary(cls, summary: TacticSummary, fg: FactorGraph):
+        """ Score calculator for the alerts a TacticSummary describes, in O(1) in their number """
+        sc = cls([], fg)
+        sc.summary = summary
+        return sc
+
     def compute_weighted_score(self):
         if not self.fg.marginals:
             raise ValueError("Marginals have not been computed yet.")
+        # Feedback replaces config.WEIGHT_PARAMETERS with a new dict, so one score never mixes two sets of weights
+        weights = config.WEIGHT_PARAMETERS
+        if self.summary is not None:
+            return self._compute_summary_score(weights)
         
         # If only one alert then use alert severity
-        if len(self.alerts) == 1:
-            return self.alerts[0]['severity'] / 10.0
+        if len(self.severities) == 1:
+            return self.severities[0] / 10.0
         
         score = 0
-        for alert in self.alerts:
-            score += alert['severity'] * self.fg.marginals[EVENT_TYPE_TO_MITRE[alert['type']][0]] * WEIGHT_PARAMETERS[EVENT_TYPE_TO_MITRE[alert['type']][0]]
-        self.score = score / (10 * len(self.alerts)) # 10 * len(alerts) is the maximum possible score so normalise by that
+        for severity, tactic in zip(self.severities, self.tactics):
+            score += severity * self.fg.marginals[tactic] * weights[tactic]
+        self.score = score / (10 * len(self.severities)) # 10 * len(alerts) is the maximum possible score so normalise by that
         return float(self.score)
     
+    def _compute_summary_score(self, weights: Dict[str, float]):
+        """ compute_weighted_score with the severities summed per tactic """
+        n_alerts = self.summary.n_alerts
+        if n_alerts == 1:
+            return float(self.summary.severity_sum.sum()) / 10.0
+
+        score = 0
+        for t in np.flatnonzero(self.summary.count).tolist():
+            tactic = MITRE_TACTICS[t]
+            score += self.summary.severity_sum[t] * self.fg.marginals[tactic] * weights[tactic]
+        self.score = score / (10 * n_alerts)
+        return float(self.score)
+
     def check_computations(self):
         """ Raises ValueError if scores, marginals, etc. have not been computed. """
         if not self.fg.marginals:
@@ -38,25 +178,41 @@ class ScoreCalculator:
         if not self.score:
             raise ValueError("Score has not been computed yet.")
     
-    def export_scores_txt(self, incident_name: str, filename: str =DEFAULT_SCORES_PATH_TXT):
+    def export_record(self, incident_name: str) -> Dict:
+        """ The incident's scores as written by export_scores_json and ScoreExportSink """
+        self.check_computations()
+        formatted_marginals = {tactic: float(self.fg.marginals[tactic]) for tactic in self.fg.marginals}
+        return {"name": incident_name,
+                "marginals": formatted_marginals,
+                "score": float(self.score)}
+
+    def export_scores_txt(self, incident_name: str, filename: str =DEFAULT_SCORES_PATH_TXT, sink: ScoreExportSink=None):
         """ Saves the scores to filename.
         Adds a newline to filename if it exists and creates filenames if not.
         This function only handles the export part. It should not be doing any computations.
+        When exporting many incidents, pass a ScoreExportSink created with fmt="txt" instead
+        of a filename, so the file is written in batches instead of reopened per incident.
         """
         self.check_computations()
+        if sink is not None:
+            sink.write(self.export_record(incident_name))
+            return
 
         with open(filename, mode='a') as file:
             marginal_output = [f"{tactic},{self.fg.marginals[tactic]}" for tactic in self.fg.marginals]
             marginal_output = ','.join(marginal_output)
             file.write(f"{incident_name},{marginal_output},Score,{self.score}\n")
     
-    def export_scores_json(self, incident_name: str, filename: str=DEFAULT_SCORES_PATH_JSON):
-        """ Exports the scores to json file """
-        self.check_computations()
-        formatted_marginals = {tactic: float(self.fg.marginals[tactic]) for tactic in self.fg.marginals}
-        incident_export = {"name": incident_name,
-                           "marginals": formatted_marginals, 
-                           "score": float(self.score)}
+    def export_scores_json(self, incident_name: str, filename: str=DEFAULT_SCORES_PATH_JSON, sink: ScoreExportSink=None):
+        """ Exports the scores to json file.
+        This rewrites the whole file, so exporting N incidents this way is quadratic.
+        When exporting many incidents, pass a shared ScoreExportSink instead.
+        """
+        incident_export = self.export_record(incident_name)
+        if sink is not None:
+            sink.write(incident_export)
+            return
+
         with open(filename, "r") as file:
             try:
                 data = json.load(file)
@@ -67,22 +223,76 @@ class ScoreCalculator:
         with open(filename, "w") as file:
             json.dump(data, file, indent=4)
 
+class IncidentRecord:
+    """ One scored incident. Holds references to its subgraph and factor graph, never copies.
+    Supports the item access of the event_subgraph dicts built in main.py, e.g. record["Score"].
+    """
+    __slots__ = ("index", "score", "priority", "marginals", "subgraph", "factor_graph")
+    FIELDS = {"Index": "index", "Score": "score", "Priority": "priority", "Marginals": "marginals",
+              "Subgraph": "subgraph", "Factor graph": "factor_graph"}
+
+    def __init__(self, index: int, score: float, marginals: Dict[str, float], subgraph=None, factor_graph: FactorGraph=None, priority: str=None):
+        self.index = index
+        self.score = score
+        self.priority = priority
+        self.marginals = marginals
+        self.subgraph = subgraph
+        self.factor_graph = factor_graph
+
+    @classmethod
+    def from_dict(cls, event: Dict):
+        return cls(event["Index"], event["Score"], event["Marginals"], event.get("Subgraph"),
+                   event.get("Factor graph"), event.get("Priority"))
+
+    def __getitem__(self, key: str):
+        return getattr(self, self.FIELDS[key])
+
+    def __setitem__(self, key: str, value):
+        setattr(self, self.FIELDS[key], value)
+
+    def __repr__(self):
+        return f"IncidentRecord(index={self.index}, score={self.score}, priority={self.priority})"
+
 
 class EventsDataTracker:
-    """ Class to establish an interface between storing and accessing event data """
+    """ Class to establish an interface between storing and accessing event data.
+    Events are kept as IncidentRecords, sharing their subgraphs and factor graphs with the caller.
+    by_index and by_score are lists of the same records in Index and in descending score order;
+    events is whichever of the two was last asked for by sort_by_size or sort_by_score.
+    """
     def __init__(self, events: List):
-        self.events = deepcopy(events)
+        records = [event if isinstance(event, IncidentRecord) else IncidentRecord.from_dict(event) for event in events]
+        self.by_index = sorted(records, key=lambda record: record.index)
+        self._by_score = None
+        self.events = self.by_index
+
+    @property
+    def by_score(self) -> List[IncidentRecord]:
+        """ Records by descending score, ties in Index order. Sorted again only after the scores changed. """
+        if self._by_score is None:
+            self._by_score = sorted(self.by_index, key=lambda record: record.score, reverse=True)
+        return self._by_score
+
+    def scores_changed(self):
+        """ Call after changing records' scores in place, so by_score is sorted again """
+        self._by_score = None
 
     def sort_by_score(self, return_copy=False):
-        self.events.sort(key=lambda x: x["Score"], reverse=True)
+        self.events = self.by_score
         if return_copy:
-            return deepcopy(self.events)
+            return list(self.events) # a new list of the same records
     
     def sort_by_size(self):
-        self.events.sort(key=lambda x: x["Index"]) # Index is already sorted by size
+        self.events = self.by_index # Index is already sorted by size
 
-    def add_event(self, event: Dict):
-        self.events.append(event)
+    def add_event(self, event: Dict | IncidentRecord):
+        record = event if isinstance(event, IncidentRecord) else IncidentRecord.from_dict(event)
+        if self.by_index and record.index < self.by_index[-1].index:
+            self.by_index.insert(bisect_right(self.by_index, record.index, key=lambda r: r.index), record)
+        else:
+            self.by_index.append(record)
+        self._by_score = None
+        self.events = self.by_index
 
     def assign_priorities(self):
         """ Assume events is sorted by score """
@@ -96,8 +306,110 @@ class EventsDataTracker:
         for i in range(med_index_threshold, len(self.events)):
             self.events[i]["Priority"] = "Low"
 
+    def assign_priorities_streaming(self, assigner):
+        """ Sets every event's priority from a StreamingPriorityAssigner holding the score distribution.
+        Linear, with no sort, so it can be rerun whenever the distribution moves.
+        """
+        for record in self.by_index:
+            record.priority = assigner.priority(record.score)
+
+    def export_to_sink(self, sink: ScoreExportSink):
+        """ Writes every event to sink, sorted by score, in one pass """
+        self.sort_by_score()
+        for event in self.events:
+            sink.write({"index": event["Index"], "score": event["Score"], "marginals": event["Marginals"],
+                        "priority": event["Priority"], "name": f"incident{event['Index']}"})
+
     def export_to_json(self, filename=DEFAULT_SCORES_PATH_JSON, keys=("Index", "Score", "Marginals", "Priority")):
         self.sort_by_score()
         json_data = [{k: event[k] for k in keys} for event in self.events]
-        with open(filename, mode="w") as file:
-            json.dump(json_data, file, indent=4)
+        # Written next to filename and moved into place, so a concurrent export never interleaves with this one
+        tmp_filename = temporary_path(filename)
+        try:
+            with open(tmp_filename, mode="w") as file:
+                json.dump(json_data, file, indent=4)
+            os.replace(tmp_filename, filename)
+        except BaseException:
+            os.remove(tmp_filename)
+            raise
+
+    def snapshot(self) -> EventsDataTracker:
+        """ Copy of the scores, priorities and marginals, without subgraphs or factor graphs,
+        e.g. to export on another thread while the GUI rescores these records """
+        return EventsDataTracker([IncidentRecord(record.index, record.score, record.marginals, priority=record.priority)
+                                  for record in self.by_index])
+
+    def export(self, json_filename=DEFAULT_SCORES_PATH_JSON, jsonl_filename=DEFAULT_SCORES_PATH_JSONL):
+        """ Writes scores.json and scores.jsonl, as main.py does after each run and the GUI after rescoring """
+        self.export_to_json(json_filename)
+        with ScoreExportSink(jsonl_filename) as sink: # written in batches and moved into place once complete
+            self.export_to_sink(sink)
+
+
+class IncidentRescorer:
+    """ Scores every incident again for new weight parameters, e.g. after analyst feedback, without
+    running correlation or inference again. compute_weighted_score is linear in the weights once the
+    marginals are known, so each incident is reduced to its contributions: per MITRE tactic, the sum
+    over its alerts of severity * marginal. Scores for a weight vector w are then contributions @ w
+    over 10 * alerts, one matrix-vector product for all incidents. Single alerts score severity / 10
+    whatever the weights, as in compute_weighted_score.
+
+    Attributes:
+    tracker (EventsDataTracker): the incidents, whose scores and priorities rescore updates in place;
+                                 call tracker.export() to write them out again
+    contributions (np.ndarray): n_incidents x len(MITRE_TACTICS), rows in Index order
+    n_alerts (np.ndarray): alerts per incident
+    single_scores (np.ndarray): severity / 10 of single alert incidents, NaN for the others
+    """
+    def __init__(self, tracker: EventsDataTracker, contributions: np.ndarray, n_alerts: np.ndarray, single_scores: np.ndarray):
+        self.tracker = tracker
+        self.contributions = contributions
+        self.n_alerts = n_alerts
+        self.single_scores = single_scores
+        self.used = contributions.any(axis=0) # tactics that need a weight
+
+    @classmethod
+    def from_store(cls, store, component_rows: List[List[int]], tracker: EventsDataTracker):
+        """ Rescorer for incidents made of the given EventStore rows, whose records in tracker hold their marginals """
+        n = len(component_rows)
+        incident_of = np.repeat(np.arange(n), [len(rows) for rows in component_rows])
+        rows = np.concatenate([np.asarray(rows, dtype=np.int64) for rows in component_rows]) if n else np.zeros(0, dtype=np.int64)
+        severity_sum = np.zeros((n, len(MITRE_TACTICS)))
+        np.add.at(severity_sum, (incident_of, store.tactic_codes[rows]), store.severity[rows])
+
+        marginals = np.zeros((n, len(MITRE_TACTICS)))
+        for record in tracker.by_index:
+            for tactic, marginal in record.marginals.items():
+                marginals[record.index, MITRE_TACTICS.index(tactic)] = marginal
+
+        n_alerts = np.bincount(incident_of, minlength=n)
+        single_scores = np.where(n_alerts == 1, severity_sum.sum(axis=1) / 10.0, np.nan)
+        return cls(tracker, severity_sum * marginals, n_alerts, single_scores)
+
+    def weight_vector(self, weights: Dict[str, float]) -> np.ndarray:
+        """ weights as an array over MITRE_TACTICS. Raises KeyError if a tactic some incident needs has no weight. """
+        missing = [tactic for tactic, used in zip(MITRE_TACTICS, self.used) if used and tactic not in weights]
+        if missing:
+            raise KeyError(f"No weight parameter for {missing}.")
+        return np.array([weights.get(tactic, 0.0) for tactic in MITRE_TACTICS])
+
+    def scores(self, weights: Dict[str, float]=None) -> np.ndarray:
+        """ Every incident's score under weights (config.WEIGHT_PARAMETERS by default), in Index order """
+        weights = config.WEIGHT_PARAMETERS if weights is None else weights
+        scores = self.contributions @ self.weight_vector(weights) / (10 * np.maximum(self.n_alerts, 1))
+        return np.where(self.n_alerts == 1, self.single_scores, scores)
+
+    def rescore(self, weights: Dict[str, float]=None, priority_assignment: str=PRIORITY_ASSIGNMENT) -> np.ndarray:
+        """ Sets every incident's score under weights and assigns priorities again, as main.py does """
+        scores = self.scores(weights)
+        for record, score in zip(self.tracker.by_index, scores.tolist()):
+            record.score = score
+        self.tracker.scores_changed()
+        if priority_assignment == "streaming":
+            assigner = StreamingPriorityAssigner()
+            for score in scores.tolist():
+                assigner.add(score)
+            self.tracker.assign_priorities_streaming(assigner)
+        else:
+            self.tracker.assign_priorities()
+        return scores
@@ -0,0 +1,181 @@
+import os
+import sys
+import json
+import time
+import platform
+import tempfile
+import subprocess
+import matplotlib
+matplotlib.use("Agg") # plot_graph saves images, no window is needed
+import numpy as np
+import networkx as nx
+
+from data_generator import generate_dataset
+from data_loader import data_load_into_graph
+from event_store import EventStore
+from attack_correlation import attack_correlation, attack_correlation_from_store, event_components
+from factor_graph import FactorGraph, run_batched_inference
+from attack_scoring import ScoreCalculator
+from utils import peak_memory, plot_graph
+from instrumentation import size_histogram
+from config import BENCHMARK_SIZES, BENCHMARK_DIRECTORY, BENCHMARK_PLOTS, CORRELATION_ENGINE, INFERENCE_ENGINE, INFERENCE_BATCH_SIZE
+
+# The graph based loading and correlation main.py used before the EventStore, kept to compare against
+LEGACY_STAGES = ("data_load_into_graph", "attack_correlation")
+STAGES = LEGACY_STAGES + ("event_store", "attack_correlation_from_store", "components", "factor_graphs", "inference", "scoring", "plot_graph")
+SKIPPABLE_STAGES = LEGACY_STAGES + ("plot_graph",)
+# Incidents are capped so the largest scale stays within reach of nx; see generate_dataset for the other parameters
+GENERATOR_DEFAULTS = {"size_distribution": "zipf", "size_param": 2.0, "max_incident_size": 100}
+SLOWER_RATIO = 1.2 # compare flags stages taking this many times as long as in the baseline
+MIN_COMPARED_SECONDS = 0.1 # ... if they took at least this long there, shorter stages are mostly noise
+
+def benchmark_file(filepath: str, skip=(), trace_memory: bool = True, plots: int = BENCHMARK_PLOTS) -> dict:
+  '''
+  Runs the pipeline stages of main.py on one dataset, in order, and returns for each stage
+  its wall time in seconds, the peak bytes allocated during it (tracemalloc, None with
+  trace_memory=False) and a few counts of what it produced.
+  Tracing memory slows Python heavy stages down; pass trace_memory=False for timings alone.
+  '''
+  stages = {}
+  def measure(name, func, *args):
+    start = time.perf_counter()
+    if trace_memory:
+      result, peak = peak_memory(func, *args)
+    else:
+      result, peak = func(*args), None
+    stages[name] = {"seconds": time.perf_counter() - start, "peak_bytes": peak}
+    return result
+
+  if "data_load_into_graph" not in skip:
+    G, data = measure("data_load_into_graph", data_load_into_graph, filepath)
+    stages["data_load_into_graph"]["nodes"] = G.number_of_nodes()
+    if "attack_correlation" not in skip:
+      H_legacy = measure("attack_correlation", attack_correlation, G, data)
+      stages["attack_correlation"].update(edges=H_legacy.number_of_edges(), engine=CORRELATION_ENGINE)
+      del H_legacy
+    del G, data
+
+  store = measure("event_store", EventStore.from_file, filepath)
+  stages["event_store"]["events"] = len(store)
+  H = measure("attack_correlation_from_store", attack_correlation_from_store, store)
+  stages["attack_correlation_from_store"].update(edges=H.number_of_edges(), engine="vectorized")
+
+  def extract_components():
+    components, component_of = event_components(H).components()
+    component_rows = [[] for _ in components]
+    for row, event_id in enumerate(store.ids):
+      component_rows[component_of[event_id]].append(row)
+    return components, component_rows
+  components, component_rows = measure("components", extract_components)
+  stages["components"].update(count=len(components), sizes=size_histogram([len(rows) for rows in component_rows]))
+
+  factor_graphs = measure("factor_graphs", lambda: [FactorGraph.from_store(store, rows) for rows in component_rows])
+  stages["factor_graphs"].update(variables=sum(len(fg.variables) for fg in factor_graphs),
+                                 factors=sum(len(fg.factors) for fg in factor_graphs))
+  measure("inference", run_batched_inference, factor_graphs)
+  measure("scoring", lambda: [ScoreCalculator.from_store(store, rows, fg).compute_weighted_score()
+                              for rows, fg in zip(component_rows, factor_graphs)])
+
+  if plots and "plot_graph" not in skip:
+    largest = [component for component in components[:plots] if len(component) > 1]
+    with tempfile.TemporaryDirectory() as directory:
+      measure("plot_graph", lambda: [plot_graph(H.subgraph(component), save_path=os.path.join(directory, f"{i}.png"), store=store)
+                                     for i, component in enumerate(largest)])
+    stages["plot_graph"].update(images=len(largest), nodes=sum(len(component) for component in largest))
+  return stages
+
+def environment() -> dict:
+  '''
+  What a result depends on besides the code: machine, library versions and the inference settings.
+  The correlation engine of each correlation stage is recorded with the stage.
+  '''
+  try:
+    commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+  except (OSError, subprocess.CalledProcessError):
+    commit = None
+  return {"commit": commit, "python": platform.python_version(), "numpy": np.__version__, "networkx": nx.__version__,
+          "platform": platform.platform(), "cpu_count": os.cpu_count(),
+          "config": {"INFERENCE_ENGINE": INFERENCE_ENGINE,
+                     "INFERENCE_BATCH_SIZE": INFERENCE_BATCH_SIZE}}
+
+def run_benchmarks(sizes=BENCHMARK_SIZES, generator: dict = None, data_directory: str = None, progress=print, **options) -> dict:
+  '''
+  Generates a dataset of each size with generate_dataset(**GENERATOR_DEFAULTS, **generator) and
+  benchmarks it with benchmark_file(**options). Datasets are written to data_directory and reused
+  from there on later runs if it is given, to a temporary directory otherwise.
+  Returns the report: the environment and, per size, the dataset parameters and stage results.
+  '''
+  generator = {**GENERATOR_DEFAULTS, **(generator or {})}
+  report = {"started": time.strftime("%Y-%m-%dT%H:%M:%S"), "environment": environment(), "runs": []}
+  with tempfile.TemporaryDirectory() as temporary:
+    directory = data_directory or temporary
+    os.makedirs(directory, exist_ok=True)
+    for n_events in sizes:
+      parameters = {"n_events": n_events, **generator}
+      name = "_".join(f"{value}" for value in parameters.values() if not isinstance(value, dict))
+      filepath = os.path.join(directory, f"synthetic_{name}.json")
+      parameters_path = filepath + ".params.json"
+      if os.path.exists(parameters_path):
+        with open(parameters_path) as f:
+          dataset = json.load(f)
+      else:
+        progress(f"Generating {n_events} events...")
+        dataset = generate_dataset(filepath, **parameters)
+        with open(parameters_path, "w") as f:
+          json.dump(dataset, f)
+      progress(f"Benchmarking {n_events} events...")
+      stages = benchmark_file(filepath, **options)
+      report["runs"].append({"dataset": dataset, "bytes": os.path.getsize(filepath), "stages": stages})
+      progress(format_run(report["runs"][-1]))
+  return report
+
+def format_run(run: dict) -> str:
+  lines = [f"{run['dataset']['events']} events ({run['bytes'] / 1e6:.1f} MB):"]
+  for name, stage in run["stages"].items():
+    peak = "" if stage["peak_bytes"] is None else f"{stage['peak_bytes'] / 1e6:10.1f} MB"
+    lines.append(f"  {name:<32}{stage['seconds']:10.3f} s{peak}")
+  return "\n".join(lines)
+
+def compare(report: dict, baseline: dict, slower: float = SLOWER_RATIO) -> list:
+  '''
+  Returns (events, stage, ratio) for each stage of report that took more than slower times
+  as long as the same stage at the same size in baseline, ignoring stages shorter than MIN_COMPARED_SECONDS there.
+  '''
+  baseline_runs = {run["dataset"]["events"]: run["stages"] for run in baseline["runs"]}
+  regressions = []
+  for run in report["runs"]:
+    previous = baseline_runs.get(run["dataset"]["events"], {})
+    for name, stage in run["stages"].items():
+      if name in previous and previous[name]["seconds"] >= MIN_COMPARED_SECONDS:
+        ratio = stage["seconds"] / previous[name]["seconds"]
+        if ratio > slower:
+          regressions.append((run["dataset"]["events"], name, ratio))
+  return regressions
+
+if __name__ == "__main__":
+  import argparse
+
+  parser = argparse.ArgumentParser(description="Times each pipeline stage on synthetic datasets of growing size.")
+  parser.add_argument("--sizes", type=int, nargs="+", default=list(BENCHMARK_SIZES))
+  parser.add_argument("--generator", type=json.loads, default=None, help='generate_dataset parameters, e.g. \'{"size_distribution": "geometric"}\'')
+  parser.add_argument("--data-dir", default=None, help="keep the datasets here and reuse them")
+  parser.add_argument("--skip", nargs="*", choices=SKIPPABLE_STAGES, default=[])
+  parser.add_argument("--plots", type=int, default=BENCHMARK_PLOTS)
+  parser.add_argument("--no-memory", action="store_true", help="time the stages without tracing memory")
+  parser.add_argument("--output", default=None, help=f"results file, by default under {BENCHMARK_DIRECTORY}")
+  parser.add_argument("--baseline", default=None, help="earlier results file to compare against")
+  args = parser.parse_args()
+
+  report = run_benchmarks(args.sizes, args.generator, args.data_dir, skip=args.skip, plots=args.plots, trace_memory=not args.no_memory)
+  output = args.output or os.path.join(BENCHMARK_DIRECTORY, f"benchmark_{time.strftime('%Y%m%d_%H%M%S')}.json")
+  os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+  with open(output, "w") as f:
+    json.dump(report, f, indent=2)
+  print(f"Results written to {output}")
+
+  if args.baseline:
+    with open(args.baseline) as f:
+      regressions = compare(report, json.load(f))
+    for events, name, ratio in regressions:
+      print(f"{name} is {ratio:.2f}x slower at {events} events")
+    sys.exit(1 if regressions else 0)
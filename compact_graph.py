@@ -0,0 +1,259 @@
+import os
+import json
+import shutil
+import numpy as np
+import networkx as nx
+from bisect import bisect_left
+from attack_correlation import EventComponents, event_components
+
+COMPACT_GRAPH_VERSION = 1 # Bump when the files written by save_compact_graph change
+META_FILENAME = "meta.json"
+ARRAYS = ("node_bytes", "node_offsets", "node_order", "indptr", "indices", "weight", "match_ip",
+          "ip_bytes", "ip_offsets", "component")
+
+def _string_table(strings) -> tuple:
+  ''' Returns (bytes, offsets): the UTF-8 encoded strings end to end, the i-th at bytes[offsets[i]:offsets[i + 1]]. '''
+  encoded = [s.encode() for s in strings]
+  offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+  offsets[1:] = np.cumsum([len(e) for e in encoded])
+  return np.frombuffer(b"".join(encoded), dtype=np.uint8), offsets
+
+def save_compact_graph(H: nx.DiGraph, directory: str):
+  '''
+  Writes an attack correlation graph to directory as .npy arrays that CompactGraph memory-maps:
+  - node_bytes, node_offsets: the node ids as a string table, in the order of H.nodes;
+    node_order lists the nodes by id, to find a node without reading every id;
+  - indptr, indices: the edges u -> v in CSR form, the successors of node i in indices[indptr[i]:indptr[i + 1]];
+  - weight: each edge's weight as float32;
+  - match_ip: each edge's match_IP as a code into the string table ip_bytes, ip_offsets, since few distinct values repeat;
+  - component: the index of each node's component in event_components(H).components().
+  The directory is replaced as a whole, through a temporary directory next to it.
+  '''
+  nodes = list(H.nodes)
+  index = {node: i for i, node in enumerate(nodes)}
+  n, m = len(nodes), H.number_of_edges()
+
+  arrays = {}
+  arrays["node_bytes"], arrays["node_offsets"] = _string_table(map(str, nodes))
+  arrays["node_order"] = np.array(sorted(range(n), key=lambda i: str(nodes[i])), dtype=np.int64)
+
+  indptr = np.zeros(n + 1, dtype=np.int64)
+  indptr[1:] = np.cumsum([len(H._succ[node]) for node in nodes])
+  indices = np.zeros(m, dtype=np.int32 if n < 2**31 else np.int64)
+  weight = np.zeros(m, dtype=np.float32)
+  match_ip = np.zeros(m, dtype=np.int32)
+  ip_codes = {}
+  k = 0
+  for node in nodes:
+    for v, d in H._succ[node].items():
+      indices[k] = index[v]
+      weight[k] = d.get("weight", 0)
+      match_ip[k] = ip_codes.setdefault(d.get("match_IP", ""), len(ip_codes))
+      k += 1
+  arrays.update(indptr=indptr, indices=indices, weight=weight, match_ip=match_ip)
+  arrays["ip_bytes"], arrays["ip_offsets"] = _string_table(ip_codes)
+
+  members, _ = event_components(H).components()
+  component = np.zeros(n, dtype=np.int64)
+  for label, member_nodes in enumerate(members):
+    component[[index[node] for node in member_nodes]] = label
+  arrays["component"] = component
+
+  tmp_directory = directory.rstrip("/") + ".tmp"
+  shutil.rmtree(tmp_directory, ignore_errors=True)
+  os.makedirs(tmp_directory)
+  for name in ARRAYS:
+    np.save(os.path.join(tmp_directory, f"{name}.npy"), arrays[name])
+  with open(os.path.join(tmp_directory, META_FILENAME), "w") as f:
+    json.dump({"version": COMPACT_GRAPH_VERSION, "nodes": n, "edges": m, "components": len(members)}, f)
+  shutil.rmtree(directory, ignore_errors=True)
+  os.replace(tmp_directory, directory)
+
+class _SortedIds:
+  ''' The node ids of a CompactGraph in sorted order, decoded only when bisect looks at them. '''
+  def __init__(self, graph):
+    self.graph = graph
+
+  def __len__(self) -> int:
+    return len(self.graph.node_order)
+
+  def __getitem__(self, k: int) -> str:
+    return self.graph.node_id(int(self.graph.node_order[k]))
+
+class CompactGraph:
+  """
+  Read-only attack correlation graph memory-mapped from the files of save_compact_graph.
+  Opening it reads meta.json and maps the arrays, whatever the size of the graph; pages are
+  read from disk as they are used, so graphs larger than RAM can be opened.
+
+  It stands in for the nx.DiGraph where main.py uses one: number_of_nodes/edges,
+  event_components(H).components() and, per component, component_subgraph(k) in place of
+  H.subgraph(component). Both return a CompactSubgraph, which builds an nx.DiGraph (to_networkx)
+  only when a caller such as plot_graph needs one.
+  """
+  def __init__(self, directory: str, mmap_mode: str = "r"):
+    self.directory = directory
+    with open(os.path.join(directory, META_FILENAME)) as f:
+      self.meta = json.load(f)
+    if self.meta["version"] != COMPACT_GRAPH_VERSION:
+      raise ValueError(f"{directory} holds version {self.meta['version']} of the compact graph format, not {COMPACT_GRAPH_VERSION}.")
+    for name in ARRAYS:
+      setattr(self, name, np.load(os.path.join(directory, f"{name}.npy"), mmap_mode=mmap_mode))
+    self.graph = {"components": self} # event_components(H) returns the graph itself, see components
+    self._ids = None
+    self._ips = {}
+    self._component_order_bounds = None
+
+  def number_of_nodes(self) -> int:
+    return self.meta["nodes"]
+
+  def number_of_edges(self) -> int:
+    return self.meta["edges"]
+
+  def __len__(self) -> int:
+    return self.meta["nodes"]
+
+  def node_id(self, i: int) -> str:
+    return bytes(self.node_bytes[self.node_offsets[i]:self.node_offsets[i + 1]]).decode()
+
+  def node_ids(self) -> list:
+    ''' Every node id, in node order. Decoded once, on first use. '''
+    if self._ids is None:
+      text = bytes(self.node_bytes).decode()
+      offsets = self.node_offsets.tolist()
+      if len(text) != offsets[-1]: # not ASCII, so byte offsets are not character offsets
+        text = bytes(self.node_bytes)
+        self._ids = [text[a:b].decode() for a, b in zip(offsets, offsets[1:])]
+      else:
+        self._ids = [text[a:b] for a, b in zip(offsets, offsets[1:])]
+    return self._ids
+
+  def index_of(self, node: str) -> int:
+    ''' Position of node in node order, found by binary search over the sorted ids. Raises KeyError if absent. '''
+    sorted_ids = _SortedIds(self)
+    k = bisect_left(sorted_ids, node)
+    if k == len(sorted_ids) or sorted_ids[k] != node:
+      raise KeyError(node)
+    return int(self.node_order[k])
+
+  def __contains__(self, node) -> bool:
+    try:
+      self.index_of(node)
+    except KeyError:
+      return False
+    return True
+
+  def match_IP(self, code: int) -> str:
+    if code not in self._ips:
+      self._ips[code] = bytes(self.ip_bytes[self.ip_offsets[code]:self.ip_offsets[code + 1]]).decode()
+    return self._ips[code]
+
+  def _component_order(self) -> tuple:
+    ''' Returns (order, bounds): the node indices by component, the k-th component at order[bounds[k]:bounds[k + 1]]. '''
+    if self._component_order_bounds is None:
+      component = np.asarray(self.component) # a plain array, slicing a memmap costs more than the slice
+      order = np.argsort(component, kind="stable")
+      bounds = np.searchsorted(component[order], np.arange(self.meta["components"] + 1)).tolist()
+      self._component_order_bounds = order, bounds
+    return self._component_order_bounds
+
+  def components(self) -> tuple:
+    '''
+    Same as EventComponents.components: (members, component_of) with the members of each component,
+    largest first, in node order.
+    '''
+    order, bounds = self._component_order()
+    ordered_ids = list(map(self.node_ids().__getitem__, order.tolist()))
+    members = [ordered_ids[a:b] for a, b in zip(bounds, bounds[1:])]
+    component_of = {node: k for k, component in enumerate(members) for node in component}
+    return members, component_of
+
+  def component_subgraph(self, k: int) -> "CompactSubgraph":
+    ''' The k-th component of components(), from its node indices rather than its ids. '''
+    order, bounds = self._component_order()
+    return CompactSubgraph(self, order[bounds[k]:bounds[k + 1]])
+
+  def edges_among(self, indices: np.ndarray) -> tuple:
+    ''' Returns (u, v, weight, match_ip) arrays of the edges between the given node indices, in CSR order. '''
+    indices = np.sort(np.asarray(indices, dtype=np.int64))
+    starts, ends = self.indptr[indices], self.indptr[indices + 1]
+    counts = ends - starts
+    positions = np.repeat(ends - np.cumsum(counts), counts) + np.arange(counts.sum()) # flat positions in indices
+    u = np.repeat(indices, counts)
+    v = np.asarray(self.indices[positions], dtype=np.int64)
+    keep = np.isin(v, indices)
+    return u[keep], v[keep], self.weight[positions[keep]], self.match_ip[positions[keep]]
+
+  def subgraph(self, nodes) -> "CompactSubgraph":
+    ''' Looks each node up by binary search; component_subgraph is the fast way to get a component. '''
+    return CompactSubgraph(self, np.array([self.index_of(node) for node in nodes], dtype=np.int64))
+
+  def to_networkx(self, indices=None) -> nx.DiGraph:
+    '''
+    Builds the nx.DiGraph of the given node indices (all nodes by default), with the weight and
+    match_IP of each edge. The whole graph also gets its EventComponents, as attack_correlation builds it.
+    '''
+    ids = self.node_ids()
+    indices = np.arange(len(self)) if indices is None else np.sort(np.asarray(indices, dtype=np.int64))
+    H = nx.DiGraph()
+    H.add_nodes_from(ids[i] for i in indices.tolist())
+    u, v, weight, match_ip = self.edges_among(indices)
+    # str gives the shortest decimal of each float32, e.g. 0.8 rather than 0.800000011920929, which is
+    # the weight attack_correlation computed whenever it had at most 7 significant digits
+    H.add_edges_from((ids[a], ids[b], {"weight": float(str(w)), "match_IP": self.match_IP(c)})
+                     for a, b, w, c in zip(u.tolist(), v.tolist(), weight, match_ip.tolist()))
+    if len(indices) == len(self):
+      components = H.graph["components"] = EventComponents(H.nodes)
+      for a, b in H.edges():
+        components.union(a, b)
+    return H
+
+class CompactSubgraph:
+  """
+  Some nodes of a CompactGraph, standing in for H.subgraph(nodes) without building an nx graph.
+  Edge counts come from the CSR arrays; to_networkx builds the nx.DiGraph when it is needed.
+  """
+  __slots__ = ("graph", "indices", "_edges")
+
+  def __init__(self, graph: CompactGraph, indices: np.ndarray):
+    self.graph = graph
+    self.indices = indices
+    self._edges = None
+
+  def __len__(self) -> int:
+    return len(self.indices)
+
+  def number_of_nodes(self) -> int:
+    return len(self.indices)
+
+  def number_of_edges(self) -> int:
+    if self._edges is None:
+      self._edges = len(self.graph.edges_among(self.indices)[0])
+    return self._edges
+
+  def to_networkx(self) -> nx.DiGraph:
+    return self.graph.to_networkx(self.indices)
+
+if __name__ == "__main__":
+  import time
+  import pickle
+  from event_store import EventStore
+  from attack_correlation import attack_correlation_from_store, same_correlation_graph
+  from config import DATA_FILEPATH, CACHE_DIRECTORY
+
+  H = attack_correlation_from_store(EventStore.from_file(DATA_FILEPATH))
+  directory = os.path.join(CACHE_DIRECTORY, "compact_graph_demo")
+  save_compact_graph(H, directory)
+  pickled = pickle.dumps(H)
+
+  start = time.perf_counter()
+  pickle.loads(pickled)
+  unpickle_time = time.perf_counter() - start
+  start = time.perf_counter()
+  compact = CompactGraph(directory)
+  open_time = time.perf_counter() - start
+  print(f"{H.number_of_edges()} edges: unpickling takes {unpickle_time * 1000:.1f} ms, opening the compact graph {open_time * 1000:.1f} ms")
+
+  assert compact.components()[0] == event_components(H).components()[0]
+  assert same_correlation_graph(compact.to_networkx(), H)
+  shutil.rmtree(directory)
@@ -1,15 +1,46 @@
 import json
 
 CORRELATION_THRESHOLD = 0.4
+CORRELATION_ENGINE    = "indexed" # Engine of attack_correlation on a data_loader graph G: "naive" checks every pair, "indexed"
+                                  # only pairs sharing a host IP, "vectorized" scores the "indexed" pairs in NumPy blocks.
+                                  # main.py builds the graph from the EventStore, always with the vectorized kernel.
 FALSE_INDICATION = 0.2 # used by factor graphs
+INFERENCE_ENGINE = "auto"   # "recursive" is the original capped Messages recursion, "loopy" the iterative engine,
+                            # "exact" enumerates all states, "auto" is "exact" for small graphs and "loopy" otherwise
+EXACT_INFERENCE_MAX_VARIABLES = 12 # 2**12 states. Every graph fits today, there are only 12 MITRE tactics
+BP_SCHEDULE      = "flooding" # "flooding" updates every message each iteration, "residual" the largest change first
+BP_TOLERANCE     = 1e-8     # Loopy belief propagation stops once no message moves by more than this
+BP_MAX_ITER      = 200      # ... or after this many iterations
+INFERENCE_BATCH_SIZE = 10000 # Components solved together by run_batched_inference; 0 solves them one by one
+INFERENCE_CACHE_SIZE = 100000 # Marginals memoised by canonical factor graph structure; 0 disables the memo
+INFERENCE_CACHE_PATH = "cached_graphs/inference_cache.pkl" # Where the memo is kept between runs, None to keep it in memory
+NUM_WORKERS          = 1  # Processes scoring components in main.py; 1 scores them in this process, None uses every core
+CHUNKS_PER_WORKER    = 8  # Components are sent to workers in this many chunks per worker, to balance uneven sizes
 DATA_FILEPATH         = "security_data_assignment.json" # This file is gitignored
+STREAM_CHUNK_SIZE     = 1 << 16     # Characters read at a time by the streaming loader
+STREAM_WINDOW_SECONDS = 24 * 3600   # stream_detection.py correlates a new event with events at most this much older, None for all
+STREAM_POLL_INTERVAL  = 0.2         # Seconds between checks for new lines when following a JSON Lines file
+STREAM_SOCKET_PORT    = 9099        # Local TCP port stream_detection.py listens on with --socket
 DEFAULT_SCORES_PATH_TXT = "scores/scores.txt"
 DEFAULT_SCORES_PATH_JSON = "scores/scores.json"
+DEFAULT_SCORES_PATH_JSONL = "scores/scores.jsonl" # Written by ScoreExportSink, one incident per line
+EXPORT_BATCH_SIZE = 1000       # Incidents buffered by ScoreExportSink between writes
+EXPORT_BINARY = False          # Also write the scores as NumPy columns next to the JSON Lines file (.npz)
 IMAGES_DIRECTORY      = "graph_plots/"                  # Directory contents are gitignored
+RENDER_WORKERS        = None # Processes rendering incident images in the background, None uses every core
+RENDER_PREFETCH       = 20   # Images of the highest scored incidents rendered ahead of the GUI asking for them
+CACHE_DIRECTORY       = "cached_graphs/"
+CACHE_MAX_BYTES       = 2 * 1024**3 # Disk budget for cached correlation graphs, least recently used are evicted
+CACHE_GRAPH_FORMAT    = "compact"   # "compact": memory-mapped arrays, see compact_graph.py. "pickle": a pickled nx.DiGraph
+CACHE_APPEND_ONLY     = False       # Set if the data feed only ever appends records. A cache miss then extends
+                                    # the latest graph built with the same config instead of rebuilding it
 WEIGHT_PARAMATER_ADJUST_AMOUNT = 0.01
 
 HIGH_PRIORITY = 0.1 # Top 10% of alerts are high priority
 MED_PRIORITY = 0.25 # Next 25% of alerts are medium. Remaining are low priority
+PRIORITY_ASSIGNMENT = "batch" # "batch" sorts all incidents, "streaming" ranks them with a quantile sketch, see quantile_sketch.py
+PRIORITY_SKETCH_K = 200       # Size of the quantile sketch; ranks are within about n / k of the exact ones
+PRIORITY_SKETCH_REBUILD = 0.5 # The streaming assigner rebuilds its sketch once removed scores exceed this fraction of the current ones
 
 MITRE_TACTICS = [
   "Initial Access", "Execution", "Persistence", "Privilege Escalation",
@@ -44,4 +75,15 @@ EVENT_TYPE_TO_MITRE = {"Authentication"     : ["Initial Access", "Credential Acc
                        "Defense Evasion"    : ["Defense Evasion"]}
 '''
 
-GUI_WINDOW_DIMENSIONS = '1600x1000'
\ No newline at end of file
+GUI_WINDOW_DIMENSIONS = '1600x1000'
+GUI_PAGE_SIZE = 50 # Alerts or hosts shown at once in the GUI's detail panes
+GUI_EXPORT_DELAY_MS = 1000 # After feedback, the GUI exports the scores once no more feedback came for this long
+
+PROFILE_ENABLED = False # Record a profile of each pipeline run in main.py: stage timings, counters and peak memory
+PROFILE_DIRECTORY = "profiles/" # Where the profiles are written
+PROFILE_TRACE_MEMORY = True # Peak memory per stage through tracemalloc, which slows Python heavy stages down
+PROFILE_SAMPLER = None # "cprofile" or "py-spy" (if installed) also profiles the run, saved next to the profile
+
+BENCHMARK_SIZES = (1_000, 10_000, 100_000, 1_000_000) # Event counts benchmark.py runs at by default
+BENCHMARK_DIRECTORY = "benchmarks/" # Where benchmark.py writes its JSON results
+BENCHMARK_PLOTS = 3 # Largest incidents drawn with plot_graph per benchmark run
@@ -0,0 +1,193 @@
+import numpy as np
+import instrumentation
+from datetime import datetime, timezone
+from config import CORRELATION_THRESHOLD, MITRE_TACTICS, EVENT_TYPE_TO_MITRE, trans_prob
+
+PAIR_BLOCK_SIZE = 1 << 20 # Max number of candidate pairs scored at once, bounds the kernel's memory use
+
+# prob_matrix.json as a 12x12 array, rows/columns ordered as MITRE_TACTICS
+TRANSITION_MATRIX = np.asarray(trans_prob, dtype=np.float64)
+TACTIC_CODES = {tactic: i for i, tactic in enumerate(MITRE_TACTICS)}
+EVENT_TYPES = list(EVENT_TYPE_TO_MITRE)
+EVENT_TYPE_CODES = {event_type: i for i, event_type in enumerate(EVENT_TYPES)}
+
+_EPOCH = datetime(1970, 1, 1)
+
+def to_epoch_us(timestamp: str) -> int:
+  '''
+  Converts an ISO timestamp to integer microseconds since the epoch.
+  Naive timestamps are taken as UTC, which preserves their ordering.
+  '''
+  dt = datetime.fromisoformat(timestamp)
+  if dt.tzinfo is not None:
+    dt = dt.astimezone(timezone.utc).replace(tzinfo=None)
+  delta = dt - _EPOCH
+  return (delta.days * 86400 + delta.seconds) * 1_000_000 + delta.microseconds
+
+def compile_type_transition_matrix() -> np.ndarray:
+  '''
+  Returns the matrix T with T[a, b] = max over the tactics t of event type a
+  and t' of event type b of MITRE_TRANSITION[t][t'], i.e. the set_T_KC term of
+  alert_correlation_measure for every pair of event types.
+  '''
+  n = len(EVENT_TYPES)
+  type_matrix = np.zeros((n, n), dtype=np.float64)
+  for a, type_a in enumerate(EVENT_TYPES):
+    codes_a = [TACTIC_CODES[t] for t in EVENT_TYPE_TO_MITRE[type_a]]
+    for b, type_b in enumerate(EVENT_TYPES):
+      codes_b = [TACTIC_CODES[t] for t in EVENT_TYPE_TO_MITRE[type_b]]
+      type_matrix[a, b] = TRANSITION_MATRIX[np.ix_(codes_a, codes_b)].max()
+  return type_matrix
+
+class EventEncoding:
+  """
+  Array encoding of a list of events, built once and reused for every pair.
+
+  Attributes:
+  type_codes (np.ndarray): uint8 index into EVENT_TYPES for each event
+  timestamps (np.ndarray): int64 epoch microseconds for each event
+  ip_indptr, ip_codes (np.ndarray): CSR event x IP incidence matrix. The IPs of event i are
+                                    ip_table[ip_codes[ip_indptr[i]:ip_indptr[i + 1]]]
+  ip_table (List[str]): interned IP addresses
+  """
+  def __init__(self, event_nodes: list, event_lookup: dict, event_to_ips: dict):
+    n = len(event_nodes)
+    self.type_codes = np.fromiter((EVENT_TYPE_CODES[event_lookup[e]["type"]] for e in event_nodes), dtype=np.uint8, count=n)
+    self.timestamps = np.fromiter((to_epoch_us(event_lookup[e]["timestamp"]) for e in event_nodes), dtype=np.int64, count=n)
+
+    ip_ids = {}
+    ip_codes = []
+    ip_indptr = np.zeros(n + 1, dtype=np.int64)
+    for i, e in enumerate(event_nodes):
+      for ip in event_to_ips.get(e, ()):
+        ip_codes.append(ip_ids.setdefault(ip, len(ip_ids)))
+      ip_indptr[i + 1] = len(ip_codes)
+    self.ip_indptr = ip_indptr
+    self.ip_codes = np.asarray(ip_codes, dtype=np.int32)
+    self.ip_table = list(ip_ids)
+
+  @classmethod
+  def from_store(cls, store) -> "EventEncoding":
+    ''' Builds the encoding from the columns of an EventStore, without touching any dict. '''
+    encoding = cls.__new__(cls)
+    encoding.type_codes = store.type_codes
+    encoding.timestamps = store.timestamps
+
+    ip_codes = store.host_ip_codes[store.host_indices]
+    rows = np.repeat(np.arange(len(store), dtype=np.int64), np.diff(store.host_indptr))
+    has_ip = ip_codes >= 0
+    counts = np.bincount(rows[has_ip], minlength=len(store))
+    encoding.ip_indptr = np.concatenate(([0], np.cumsum(counts)))
+    encoding.ip_codes = ip_codes[has_ip]
+    encoding.ip_table = store.ips.strings
+    return encoding
+
+  def ip_buckets(self):
+    '''
+    Yields, for every IP, the array of event rows seen on it sorted by timestamp.
+    '''
+    rows = np.repeat(np.arange(len(self.timestamps), dtype=np.int64), np.diff(self.ip_indptr))
+    order = np.lexsort((self.timestamps[rows], self.ip_codes))
+    rows, ips = rows[order], self.ip_codes[order]
+    bounds = np.flatnonzero(np.diff(ips)) + 1
+    for bucket in np.split(rows, bounds):
+      if len(bucket) > 1:
+        yield bucket
+
+def score_pair_block(u: np.ndarray, v: np.ndarray, encoding: EventEncoding, type_matrix: np.ndarray):
+  '''
+  Scores a block of candidate pairs (u[k], v[k]) that share an IP.
+  Returns the scores and the mask of pairs that are time ordered and pass CORRELATION_THRESHOLD.
+  '''
+  scores = type_matrix[encoding.type_codes[u], encoding.type_codes[v]]
+  mask = (encoding.timestamps[u] < encoding.timestamps[v]) & (scores > CORRELATION_THRESHOLD)
+  return scores, mask
+
+def correlated_pairs(encoding: EventEncoding, type_matrix: np.ndarray) -> np.ndarray:
+  '''
+  Returns the sorted, deduplicated codes u * n + v of all correlated pairs of event rows.
+  '''
+  n = len(encoding.timestamps)
+  found = []
+  evaluated = 0
+  for bucket in encoding.ip_buckets():
+    k = len(bucket)
+    rows_per_block = max(1, PAIR_BLOCK_SIZE // k)
+    for start in range(0, k - 1, rows_per_block):
+      i = np.arange(start, min(start + rows_per_block, k - 1))
+      j = np.arange(k)
+      upper = j[None, :] > i[:, None] # bucket is time sorted, so only look forward
+      ii, jj = np.broadcast_to(i[:, None], upper.shape)[upper], np.broadcast_to(j[None, :], upper.shape)[upper]
+      u, v = bucket[ii], bucket[jj]
+      _, mask = score_pair_block(u, v, encoding, type_matrix)
+      found.append(u[mask] * n + v[mask])
+      evaluated += len(u)
+  instrumentation.count("correlation.pairs_evaluated", evaluated)
+
+  if not found:
+    return np.zeros(0, dtype=np.int64)
+  return np.unique(np.concatenate(found)) # a pair sharing several IPs appears in several buckets
+
+def correlated_pairs_touching(encoding: EventEncoding, type_matrix: np.ndarray, rows) -> np.ndarray:
+  '''
+  Like correlated_pairs, but only returns pairs with at least one end in rows.
+  The work is proportional to len(rows) times the size of their IP buckets.
+  '''
+  n = len(encoding.timestamps)
+  touched = np.zeros(n, dtype=bool)
+  touched[rows] = True
+  found = []
+  evaluated = 0
+  for bucket in encoding.ip_buckets():
+    hits = bucket[touched[bucket]]
+    rows_per_block = max(1, PAIR_BLOCK_SIZE // len(bucket))
+    for start in range(0, len(hits), rows_per_block):
+      block = hits[start:start + rows_per_block]
+      a, b = np.repeat(block, len(bucket)), np.tile(bucket, len(block))
+      for u, v in ((a, b), (b, a)):
+        _, mask = score_pair_block(u, v, encoding, type_matrix)
+        found.append(u[mask] * n + v[mask])
+      evaluated += 2 * len(a)
+  instrumentation.count("correlation.pairs_evaluated", evaluated)
+
+  if not found:
+    return np.zeros(0, dtype=np.int64)
+  return np.unique(np.concatenate(found))
+
+def vectorized_correlation_edges(event_nodes: list, data: dict, event_to_ips: dict):
+  '''
+  Yields the same (u, v, score, shared_ips) edges, in the same order, as the
+  other engines in attack_correlation, scoring candidate pairs in NumPy blocks.
+  '''
+  event_lookup = {event["id"]: event for event in data["events"]}
+  encoding = EventEncoding(event_nodes, event_lookup, event_to_ips)
+  type_matrix = compile_type_transition_matrix()
+
+  n = len(event_nodes)
+  for code in correlated_pairs(encoding, type_matrix).tolist():
+    u, v = divmod(code, n)
+    score = float(type_matrix[encoding.type_codes[u], encoding.type_codes[v]])
+    yield event_nodes[u], event_nodes[v], score, event_to_ips[event_nodes[u]] & event_to_ips[event_nodes[v]]
+
+def store_correlation_edges(store, rows=None):
+  '''
+  Yields (row_u, row_v, score, shared_ips) for every correlated pair of rows of an
+  EventStore, in the same order as vectorized_correlation_edges.
+  If rows is given, only pairs with at least one end in rows are yielded.
+  '''
+  encoding = EventEncoding.from_store(store)
+  type_matrix = compile_type_transition_matrix()
+  if rows is None:
+    pairs = correlated_pairs(encoding, type_matrix)
+  else:
+    pairs = correlated_pairs_touching(encoding, type_matrix, rows)
+
+  n = len(store)
+  ip_sets = {}
+  for code in pairs.tolist():
+    u, v = divmod(code, n)
+    score = float(type_matrix[encoding.type_codes[u], encoding.type_codes[v]])
+    for row in (u, v):
+      if row not in ip_sets:
+        ip_sets[row] = store.ip_set(row)
+    yield u, v, score, ip_sets[u] & ip_sets[v]
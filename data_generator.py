@@ -0,0 +1,137 @@
+import json
+import numpy as np
+from config import EVENT_TYPE_TO_MITRE
+
+EVENT_TYPES = list(EVENT_TYPE_TO_MITRE)
+SIZE_DISTRIBUTIONS = ("fixed", "geometric", "zipf")
+DEPARTMENTS = ("IT", "Finance", "HR", "Engineering", "Sales")
+OS_TYPES = ("Linux", "Windows", "macOS")
+
+def incident_sizes(n_events: int, distribution: str = "zipf", param: float = 2.0, max_size: int = None, rng=None) -> np.ndarray:
+  '''
+  Draws group sizes adding up to n_events, each at most max_size.
+  "fixed" gives groups of int(param) events, "geometric" sizes of mean param and "zipf" sizes
+  following a power law of exponent param (> 1), i.e. mostly single events and a few large groups.
+  '''
+  rng = rng if rng is not None else np.random.default_rng()
+  if distribution not in SIZE_DISTRIBUTIONS:
+    raise ValueError(f"Unknown size distribution '{distribution}'. Use one of {SIZE_DISTRIBUTIONS}.")
+  sizes = []
+  total = 0
+  while total < n_events:
+    batch = max(16, (n_events - total) // max(1, int(param)))
+    if distribution == "fixed":
+      drawn = np.full(batch, max(1, int(param)))
+    elif distribution == "geometric":
+      drawn = rng.geometric(1 / max(1.0, param), batch)
+    else:
+      drawn = rng.zipf(param, batch)
+    drawn = np.minimum(drawn, max_size or n_events)
+    sizes.append(drawn)
+    total += int(drawn.sum())
+  sizes = np.concatenate(sizes)
+  cut = int(np.searchsorted(np.cumsum(sizes), n_events))
+  sizes = sizes[:cut + 1].copy()
+  sizes[-1] -= int(sizes.sum()) - n_events
+  return sizes[sizes > 0]
+
+def generate_dataset(filepath: str, n_events: int = 1000, n_hosts: int = None, n_ips: int = None, n_users: int = None,
+                     type_mix: dict = None, time_span: float = 30 * 86400, incident_span: float = 3600,
+                     size_distribution: str = "zipf", size_param: float = 2.0, max_incident_size: int = 1000, hosts_per_incident: int = 1,
+                     second_host_fraction: float = 0.1, start: str = "2024-01-01T00:00:00", seed: int = 0) -> dict:
+  '''
+  Writes a synthetic dataset in the schema data_loader expects: {"events": [...], "entities": [...],
+  "relationships": [...]}, with Host and User entities and "occurred_on"/"performed_by" relationships.
+  Records are written as they are produced, so millions of events never sit in memory as dicts.
+
+  Events come in groups (incidents) whose sizes follow size_distribution (see incident_sizes), capped at
+  max_incident_size since the correlation edges of a group grow with the square of its size.
+  The events of a group happen within incident_span seconds on the group's hosts_per_incident hosts;
+  groups start uniformly over time_span seconds. Groups get disjoint hosts while there are enough of them,
+  after that hosts are reused and groups on the same host can correlate into one component.
+  A group can also split into several components, when consecutive event types rarely follow each other.
+  Event types are drawn from type_mix ({type: weight}, uniform over EVENT_TYPE_TO_MITRE by default).
+  second_host_fraction of the events are also linked to a second host of their group.
+  Hosts get one of n_ips IP addresses (n_hosts by default, fewer makes hosts share IPs).
+
+  Returns the parameters used, with the number of groups drawn and the size of the largest.
+  '''
+  rng = np.random.default_rng(seed)
+  n_hosts = n_hosts or max(1, n_events // 4)
+  n_ips = min(n_ips or n_hosts, n_hosts)
+  n_users = n_users or n_hosts // 2 + 1
+  type_mix = type_mix or {event_type: 1.0 for event_type in EVENT_TYPES}
+  unknown = set(type_mix) - set(EVENT_TYPES)
+  if unknown:
+    raise ValueError(f"Unknown event types {sorted(unknown)}. Use types of EVENT_TYPE_TO_MITRE.")
+
+  sizes = incident_sizes(n_events, size_distribution, size_param, max_incident_size, rng)
+  incident = np.repeat(np.arange(len(sizes)), sizes)
+  types = list(type_mix)
+  weights = np.array([type_mix[t] for t in types], dtype=np.float64)
+  type_codes = rng.choice(len(types), n_events, p=weights / weights.sum())
+  severities = rng.integers(1, 11, n_events)
+
+  incident_start = rng.uniform(0, max(0.0, time_span - incident_span), len(sizes))
+  seconds = (incident_start[incident] + rng.uniform(0, incident_span, n_events)).astype(np.int64)
+  timestamps = (np.datetime64(start, "s") + seconds.astype("timedelta64[s]")).astype(str)
+
+  first_host = incident * hosts_per_incident
+  hosts = (first_host + rng.integers(0, hosts_per_incident, n_events)) % n_hosts
+  second = rng.random(n_events) < second_host_fraction
+  second_hosts = (first_host + rng.integers(0, hosts_per_incident, n_events)) % n_hosts
+  users = rng.integers(0, n_users, n_events)
+
+  with open(filepath, "w") as f:
+    def write_array(key, records, first=False):
+      f.write(("{" if first else ",\n") + json.dumps(key) + ": [")
+      for i, record in enumerate(records):
+        f.write((",\n" if i else "\n") + json.dumps(record))
+      f.write("\n]")
+
+    write_array("events", ({"id": f"evt_{i}", "type": types[type_codes[i]], "severity": int(severities[i]),
+                            "timestamp": timestamps[i], "description": f"{types[type_codes[i]]} on host_{hosts[i]}",
+                            "alert_message": f"Alert {i}: {types[type_codes[i]]}"} for i in range(n_events)), first=True)
+    write_array("entities", [{"id": f"host_{h}", "type": "Host", "name": f"host{h}",
+                              "properties": {"ip_address": f"10.{(h % n_ips) >> 16 & 255}.{(h % n_ips) >> 8 & 255}.{h % n_ips & 255}",
+                                             "os_type": OS_TYPES[h % len(OS_TYPES)], "department": DEPARTMENTS[h % len(DEPARTMENTS)]}}
+                             for h in range(n_hosts)] +
+                            [{"id": f"user_{u}", "type": "User", "name": f"user{u}",
+                              "properties": {"department": DEPARTMENTS[u % len(DEPARTMENTS)]}} for u in range(n_users)])
+
+    def relationships():
+      for i in range(n_events):
+        yield {"source": f"evt_{i}", "target": f"host_{hosts[i]}", "type": "occurred_on"}
+        if second[i] and second_hosts[i] != hosts[i]:
+          yield {"source": f"evt_{i}", "target": f"host_{second_hosts[i]}", "type": "occurred_on"}
+        yield {"source": f"evt_{i}", "target": f"user_{users[i]}", "type": "performed_by"}
+    write_array("relationships", relationships())
+    f.write("}\n")
+
+  return {"events": n_events, "hosts": n_hosts, "ips": n_ips, "users": n_users, "incidents": len(sizes),
+          "largest_incident": int(sizes.max()), "time_span": time_span, "incident_span": incident_span,
+          "size_distribution": size_distribution, "size_param": size_param, "max_incident_size": max_incident_size,
+          "hosts_per_incident": hosts_per_incident, "seed": seed}
+
+if __name__ == "__main__":
+  import argparse
+
+  parser = argparse.ArgumentParser(description="Writes a synthetic events/entities/relationships dataset.")
+  parser.add_argument("filepath")
+  parser.add_argument("--events", type=int, default=1000)
+  parser.add_argument("--hosts", type=int, default=None)
+  parser.add_argument("--ips", type=int, default=None)
+  parser.add_argument("--users", type=int, default=None)
+  parser.add_argument("--days", type=float, default=30, help="time span of the dataset")
+  parser.add_argument("--incident-hours", type=float, default=1, help="time span of one incident")
+  parser.add_argument("--sizes", choices=SIZE_DISTRIBUTIONS, default="zipf")
+  parser.add_argument("--size-param", type=float, default=2.0)
+  parser.add_argument("--max-size", type=int, default=1000, help="largest incident")
+  parser.add_argument("--hosts-per-incident", type=int, default=1)
+  parser.add_argument("--type-mix", type=json.loads, default=None, help='e.g. \'{"Authentication": 3, "Exfiltration": 1}\'')
+  parser.add_argument("--seed", type=int, default=0)
+  args = parser.parse_args()
+
+  print(generate_dataset(args.filepath, args.events, args.hosts, args.ips, args.users, args.type_mix,
+                         args.days * 86400, args.incident_hours * 3600, args.sizes, args.size_param, args.max_size,
+                         args.hosts_per_incident, seed=args.seed))
@@ -1,14 +1,140 @@
+import sys
 import json
 import networkx as nx
-from config import DATA_FILEPATH
+from config import DATA_FILEPATH, STREAM_CHUNK_SIZE
 
-def data_load_into_graph(filepath=DATA_FILEPATH):
+RECORD_KEYS = ("events", "entities", "relationships")
+INTERN_MAX_LENGTH = 64 # Short strings (ids, types, names) repeat across records and are shared
 
-  with open(filepath) as f:
-    data = json.load(f)
+def _intern(value):
+  if isinstance(value, str) and len(value) <= INTERN_MAX_LENGTH:
+    return sys.intern(value)
+  return value
+
+class JSONArrayStream:
+  """
+  Incrementally parses a file holding one JSON object whose values of interest are arrays,
+  e.g. {"events": [...], "entities": [...], "relationships": [...]}.
+  Iterating yields (key, record) for each element of those arrays, in file order.
+  Other values are parsed and dropped.
+
+  At most chunk_size characters plus the largest single record are held in memory at once,
+  whatever the size of the file. Keys and short strings are interned so records share them.
+
+  Attributes:
+  max_buffer (int): the largest number of characters buffered so far, to check the bound above
+  """
+  _decoder = json.JSONDecoder(object_pairs_hook=lambda pairs: {sys.intern(k): _intern(v) for k, v in pairs})
+  _whitespace = " \t\n\r"
+
+  def __init__(self, filepath: str, keys=RECORD_KEYS, chunk_size: int=STREAM_CHUNK_SIZE):
+    self.filepath = filepath
+    self.keys = set(keys)
+    self.chunk_size = chunk_size
+    self.max_buffer = 0
+
+  def __iter__(self):
+    with open(self.filepath) as f:
+      self._file = f
+      self._buffer = ""
+      self._pos = 0
+      self._eof = False
+
+      self._expect("{")
+      while self._next_char(",") != "}":
+        key = self._decode()
+        self._expect(":")
+        if key in self.keys and self._peek() == "[":
+          self._expect("[")
+          while self._next_char(",") != "]":
+            yield key, self._decode()
+        else:
+          self._decode()
+
+  def _fill(self) -> bool:
+    ''' Reads one more chunk. Returns False at end of file. '''
+    if self._eof:
+      return False
+    chunk = self._file.read(self.chunk_size)
+    if not chunk:
+      self._eof = True
+      return False
+    self._buffer = self._buffer[self._pos:] + chunk # drop what has been parsed already
+    self._pos = 0
+    self.max_buffer = max(self.max_buffer, len(self._buffer))
+    return True
+
+  def _peek(self) -> str:
+    ''' Returns the next non-whitespace character without consuming it. '''
+    while True:
+      while self._pos < len(self._buffer) and self._buffer[self._pos] in self._whitespace:
+        self._pos += 1
+      if self._pos < len(self._buffer):
+        return self._buffer[self._pos]
+      if not self._fill():
+        raise ValueError(f"Unexpected end of file in {self.filepath}")
 
+  def _expect(self, char: str):
+    if self._peek() != char:
+      raise ValueError(f"Expected '{char}' at character {self._pos} of the buffer in {self.filepath}")
+    self._pos += 1
+
+  def _next_char(self, separator: str) -> str:
+    ''' Skips a separator and returns the next character, which is consumed if it closes a container. '''
+    char = self._peek()
+    if char == separator:
+      self._pos += 1
+      char = self._peek()
+    if char in "]}":
+      self._pos += 1
+    return char
+
+  def _decode(self):
+    ''' Decodes the next JSON value, reading more of the file until it is complete. '''
+    self._peek()
+    while True:
+      try:
+        value, end = self._decoder.raw_decode(self._buffer, self._pos)
+      except json.JSONDecodeError:
+        if self._fill():
+          continue
+        raise
+      # A number can be cut in two by the end of the buffer
+      if end == len(self._buffer) and self._fill():
+        continue
+      self._pos = end
+      return value
+
+def data_load_into_graph(filepath=DATA_FILEPATH, streaming=False, chunk_size=STREAM_CHUNK_SIZE):
+  '''
+  Returns the graph G of all events and entities and the data dictionary.
+
+  With streaming=True the file is parsed record by record with JSONArrayStream and each
+  record is only stored once, as a node or edge attribute dict of G. The returned data then
+  only holds "events", a list of the event node attribute dicts of G (not copies).
+  Nodes are added in file order.
+
+  main.py no longer builds G: EventStore.from_file streams the file with the same
+  JSONArrayStream into columns. This function remains for callers that need G, such as
+  attack_correlation and update_attack_correlation.
+  '''
   G = nx.MultiDiGraph()
 
+  if streaming:
+    event_ids = []
+    for key, record in JSONArrayStream(filepath, chunk_size=chunk_size):
+      if key == "events":
+        G.add_node(record["id"], **record, node_type="event")
+        event_ids.append(record["id"])
+      elif key == "entities":
+        G.add_node(record["id"], **record, node_type="entity")
+      else:
+        G.add_edge(record["source"], record["target"], **record)
+    return G, {"events": [G.nodes[n] for n in event_ids]}
+
+  with open(filepath) as f:
+    data = json.load(f)
+
   for event in data["events"]:
     G.add_node(event["id"], **event, node_type="event")
 
@@ -22,12 +148,15 @@ def data_load_into_graph(filepath=DATA_FILEPATH):
 
 if __name__=="__main__":
   # Example of usage
-  
-  G, data = data_load_into_graph()
+  from utils import peak_memory
+
+  (G, data), peak = peak_memory(data_load_into_graph)
+  (G_stream, _), peak_stream = peak_memory(data_load_into_graph, streaming=True)
   print(f"Total nodes: {G.number_of_nodes()}")
   print(f"Total edges: {G.number_of_edges()}")
+  print(f"Peak memory: {peak / 1e6:.1f} MB with json.load, {peak_stream / 1e6:.1f} MB streaming")
 
   event_nodes  = [n for n, d in G.nodes(data=True) if d.get("node_type") == "event"]
   entity_nodes = [n for n, d in G.nodes(data=True) if d.get("node_type") == "entity"]
   print(f"Event nodes: {len(event_nodes)}")
-  print(f"Entity nodes: {len(entity_nodes)}")
\ No newline at end of file
+  print(f"Entity nodes: {len(entity_nodes)}")
@@ -0,0 +1,203 @@
+import numpy as np
+from datetime import datetime, timedelta
+from config import MITRE_TACTICS, EVENT_TYPE_TO_MITRE
+from data_loader import JSONArrayStream
+from correlation_kernel import EVENT_TYPES, EVENT_TYPE_CODES, TACTIC_CODES, to_epoch_us
+
+_EPOCH = datetime(1970, 1, 1)
+
+class StringTable:
+  """
+  Interns strings (or None) to int32 codes. Repeated values (descriptions, messages, IPs) are stored once.
+  """
+  def __init__(self):
+    self.strings = []
+    self.codes = {}
+
+  def intern(self, value: str) -> int:
+    code = self.codes.get(value)
+    if code is None:
+      code = self.codes[value] = len(self.strings)
+      self.strings.append(value)
+    return code
+
+  def __getitem__(self, code: int) -> str:
+    return self.strings[code]
+
+
+class EventStore:
+  """
+  Columnar table of all events, shared by every stage of the pipeline. Events are
+  addressed by their row index; row_of maps event ids to rows.
+
+  Attributes:
+  ids (List[str]): event id of each row
+  type_codes (np.ndarray): uint8 index into EVENT_TYPES
+  tactic_codes (np.ndarray): uint8 index into MITRE_TACTICS of the event's first tactic, as used by FactorGraph
+  severity (np.ndarray): uint8 severity, validated as an integer in 0..255 when the store is built
+  timestamps (np.ndarray): int64 epoch microseconds
+  host_indptr, host_indices (np.ndarray): CSR event x host matrix. The hosts of row i are
+                                          host_indices[host_indptr[i]:host_indptr[i + 1]], in relationship order
+  host_ids, host_names, host_properties (List): host table, host_properties holds the entities' property dicts
+  host_ip_codes (np.ndarray): int32 code of each host's IP in ips, or -1 if it has none
+  """
+  TEXT_FIELDS = ("description", "alert_message")
+
+  def __init__(self):
+    self.ids = []
+    self.row_of = {}
+    self.ips = StringTable()
+    self.text = {field: StringTable() for field in self.TEXT_FIELDS}
+
+    self.host_ids, self.host_names, self.host_properties = [], [], []
+    self.host_row_of = {}
+
+    # Columns are filled as Python lists, then frozen into arrays by _finalize
+    self._columns = {"type_codes": [], "severity": [], "timestamps": [], "description": [], "alert_message": []}
+    self._host_ip_codes = []
+    self._relationships = []
+
+  @classmethod
+  def from_records(cls, records) -> "EventStore":
+    ''' Builds a store from (key, record) pairs, key being "events", "entities" or "relationships". '''
+    store = cls()
+    for key, record in records:
+      if key == "events":
+        store._add_event(record)
+      elif key == "entities":
+        store._add_entity(record)
+      else:
+        store._relationships.append((record["source"], record["target"]))
+    store._finalize()
+    return store
+
+  @classmethod
+  def from_file(cls, filepath: str, **kwargs) -> "EventStore":
+    ''' Streams the data file straight into a store, without building the graph G. '''
+    return cls.from_records(JSONArrayStream(filepath, **kwargs))
+
+  @classmethod
+  def from_graph(cls, G) -> "EventStore":
+    ''' Builds a store from the graph G returned by data_loader. '''
+    def records():
+      for _, d in G.nodes(data=True):
+        if d.get("node_type") == "event":
+          yield "events", d
+        elif d.get("node_type") == "entity":
+          yield "entities", d
+      for source, target in G.edges():
+        yield "relationships", {"source": source, "target": target}
+    return cls.from_records(records())
+
+  def _add_event(self, event: dict):
+    self.row_of[event["id"]] = len(self.ids)
+    self.ids.append(event["id"])
+    columns = self._columns
+    columns["type_codes"].append(EVENT_TYPE_CODES[event["type"]])
+    columns["severity"].append(event["severity"])
+    columns["timestamps"].append(to_epoch_us(event["timestamp"]))
+    for field in self.TEXT_FIELDS:
+      columns[field].append(self.text[field].intern(event.get(field)))
+
+  def _add_entity(self, entity: dict):
+    if entity.get("type") != "Host":
+      return
+    self.host_row_of[entity["id"]] = len(self.host_ids)
+    self.host_ids.append(entity["id"])
+    self.host_names.append(entity.get("name"))
+    properties = entity.get("properties", {})
+    self.host_properties.append(properties)
+    ip = properties.get("ip_address")
+    self._host_ip_codes.append(self.ips.intern(ip) if ip else -1)
+
+  def _finalize(self):
+    columns = self._columns
+    self.type_codes = np.asarray(columns["type_codes"], dtype=np.uint8)
+    self.severity = self._severity_column(columns["severity"])
+    self.timestamps = np.asarray(columns["timestamps"], dtype=np.int64)
+    self.text_codes = {field: np.asarray(columns[field], dtype=np.int32) for field in self.TEXT_FIELDS}
+    type_to_tactic = np.array([TACTIC_CODES[EVENT_TYPE_TO_MITRE[t][0]] for t in EVENT_TYPES], dtype=np.uint8)
+    self.tactic_codes = type_to_tactic[self.type_codes]
+    self.host_ip_codes = np.asarray(self._host_ip_codes, dtype=np.int32)
+
+    # Event -> host CSR, keeping the first link to each host like G.neighbors does
+    hosts_of = {}
+    for source, target in self._relationships:
+      row, host = self.row_of.get(source), self.host_row_of.get(target)
+      if row is not None and host is not None:
+        hosts_of.setdefault(row, {})[host] = None
+    counts = np.zeros(len(self.ids) + 1, dtype=np.int64)
+    for row, hosts in hosts_of.items():
+      counts[row + 1] = len(hosts)
+    self.host_indptr = np.cumsum(counts)
+    self.host_indices = np.zeros(self.host_indptr[-1], dtype=np.int32)
+    for row, hosts in hosts_of.items():
+      self.host_indices[self.host_indptr[row]:self.host_indptr[row + 1]] = list(hosts)
+
+    del self._columns, self._host_ip_codes, self._relationships
+
+  def _severity_column(self, severities: list) -> np.ndarray:
+    ''' Severities as uint8, raising ValueError for any that is not an integer in 0..255 instead of truncating it '''
+    def valid(severity):
+      return isinstance(severity, (int, float, np.integer, np.floating)) and not isinstance(severity, bool) \
+             and float(severity).is_integer() and 0 <= severity <= 255
+    if not all(map(valid, severities)):
+      row = next(row for row, severity in enumerate(severities) if not valid(severity))
+      raise ValueError(f"Event '{self.ids[row]}' has severity {severities[row]!r}; severities must be integers in 0..255.")
+    return np.asarray(severities, dtype=np.uint8)
+
+  def __len__(self) -> int:
+    return len(self.ids)
+
+  def hosts(self, row: int) -> np.ndarray:
+    ''' Returns the host table rows linked to an event row. '''
+    return self.host_indices[self.host_indptr[row]:self.host_indptr[row + 1]]
+
+  def hosts_of_rows(self, rows) -> tuple:
+    '''
+    Returns (event_rows, hosts): one entry per event-host link of the given rows, in row then
+    relationship order, i.e. the concatenation of hosts(row) for each row, built without a Python loop.
+    '''
+    rows = np.asarray(rows, dtype=np.int64)
+    starts = self.host_indptr[rows]
+    counts = self.host_indptr[rows + 1] - starts
+    event_rows = np.repeat(rows, counts)
+    # Position of every link in host_indices: its row's start plus its rank within the row
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    return event_rows, self.host_indices[np.repeat(starts, counts) + offsets]
+
+  def ip_set(self, row: int) -> set:
+    ''' Returns the set of IPs of an event, the same set build_event_to_ips_map would give. '''
+    return {self.ips[code] for code in self.host_ip_codes[self.hosts(row)].tolist() if code >= 0}
+
+  def event_to_ips(self) -> dict:
+    ''' Returns the equivalent of build_event_to_ips_map for all events. '''
+    return {event_id: self.ip_set(row) for row, event_id in enumerate(self.ids)}
+
+  def tactic(self, row: int) -> str:
+    return MITRE_TACTICS[self.tactic_codes[row]]
+
+  def timestamp(self, row: int) -> str:
+    ''' Returns the event's timestamp as an ISO string (UTC if the original had an offset). '''
+    return (_EPOCH + timedelta(microseconds=int(self.timestamps[row]))).isoformat()
+
+  def get(self, row: int, field: str, default=None):
+    ''' Returns one field of an event in the same form as the original event dict. '''
+    if field == "id":
+      return self.ids[row]
+    if field == "type":
+      return EVENT_TYPES[self.type_codes[row]]
+    if field == "severity":
+      return int(self.severity[row])
+    if field == "timestamp":
+      return self.timestamp(row)
+    if field in self.text_codes:
+      value = self.text[field][self.text_codes[field][row]]
+      return default if value is None else value
+    return default
+
+  def nbytes(self) -> int:
+    ''' Returns the size of the numeric columns, in bytes. '''
+    arrays = [self.type_codes, self.tactic_codes, self.severity, self.timestamps,
+              self.host_indptr, self.host_indices, *self.text_codes.values()]
+    return sum(a.nbytes for a in arrays)
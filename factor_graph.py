@@ -5,8 +5,11 @@ from datetime import datetime
 import numpy as np
 
 # our files
+import instrumentation
 from data_loader import data_load_into_graph as load
-from config import EVENT_TYPE_TO_MITRE, MITRE_TRANSITION, FALSE_INDICATION
+from correlation_kernel import TACTIC_CODES, to_epoch_us
+from config import EVENT_TYPE_TO_MITRE, MITRE_TRANSITION, MITRE_TACTICS, FALSE_INDICATION
+from config import INFERENCE_ENGINE, BP_SCHEDULE, BP_TOLERANCE, BP_MAX_ITER, INFERENCE_BATCH_SIZE, EXACT_INFERENCE_MAX_VARIABLES
 
 MAX_ITER = 10 # Factor graph has cycles so need some way to stop the sumproduct algorithm
 
@@ -128,11 +131,363 @@ class Messages:
     
     def marginals(self, fg):
         marginals_dict = dict()
+        messages, truncated = 0, 0
         for variable in fg.variables:
             marginals_dict[variable] = float(self.marginal(fg.variables[variable])[1])
+            messages += self.i
+            truncated += self.i >= MAX_ITER
+        instrumentation.count("inference.recursive.messages", messages)
+        instrumentation.count("inference.recursive.truncated_marginals", truncated)
         return marginals_dict
 
 
+class CompiledFactorGraph:
+    """
+    Array form of a FactorGraph, used by the iterative inference engines.
+    Unary (single-alert) factors never receive messages, so they are folded into a log prior per variable.
+
+    Attributes:
+    names (List[str]): variable names, in the order of fg.variables
+    log_prior (np.ndarray): shape (V, 2), sum of the log distributions of each variable's unary factors
+    tables (np.ndarray): shape (P, 2, 2), the distributions of the pairwise factors
+    factor_vars (np.ndarray): shape (P, 2), the variable indices along each axis of tables
+    factor_names (List[Tuple[str]]): pairwise factor names, in the order of tables
+    """
+    def __init__(self, fg: FactorGraph):
+        self.names = list(fg.variables)
+        index = {name: i for i, name in enumerate(self.names)}
+
+        self.log_prior = np.zeros((len(self.names), 2))
+        with np.errstate(divide="ignore"): # a severity of 0 or 10 gives a zero probability
+            for i, name in enumerate(self.names):
+                for factor in fg.variables[name].neighbours:
+                    if len(factor.neighbours) == 1:
+                        self.log_prior[i] += np.log(factor.distr)
+
+        pairwise = list(fg.factors.values())
+        self.factor_names = list(fg.factors)
+        self.tables = np.array([factor.distr for factor in pairwise], dtype=np.float64).reshape(-1, 2, 2)
+        self.factor_vars = np.array([[index[v.name] for v in factor.neighbours] for factor in pairwise], dtype=np.int64).reshape(-1, 2)
+
+    @classmethod
+    def concatenate(cls, graphs: List[CompiledFactorGraph]) -> Tuple[CompiledFactorGraph, np.ndarray]:
+        """ Packs several disjoint graphs into one, returning it and the offset of each graph's first variable """
+        offsets = np.cumsum([0] + [len(g.names) for g in graphs])
+        packed = cls.__new__(cls)
+        packed.names = [name for g in graphs for name in g.names]
+        packed.factor_names = [name for g in graphs for name in g.factor_names]
+        packed.log_prior = np.concatenate([g.log_prior for g in graphs]) if graphs else np.zeros((0, 2))
+        packed.tables = np.concatenate([g.tables for g in graphs]) if graphs else np.zeros((0, 2, 2))
+        packed.factor_vars = np.concatenate([g.factor_vars + offset for g, offset in zip(graphs, offsets)]) if graphs else np.zeros((0, 2), dtype=np.int64)
+        return packed, offsets
+
+
+def normalise_log(log_p: np.ndarray) -> np.ndarray:
+    """ Turns unnormalised log probabilities along the last axis into probabilities """
+    log_p = log_p - np.max(log_p, axis=-1, keepdims=True)
+    p = np.exp(log_p)
+    return p / np.sum(p, axis=-1, keepdims=True)
+
+
+class LoopyBeliefPropagation:
+    """
+    Iterative sum-product message passing over a FactorGraph with explicitly stored messages.
+    Each iteration costs time linear in the number of edges. It runs until no message moves by more than tol.
+
+    Parameters:
+    schedule (str): "flooding" recomputes all messages each iteration. "residual" applies the message with the
+                    largest change first and only recomputes the messages depending on it. An iteration is then
+                    as many single-factor updates as there are pairwise factors.
+    messages (Dict[Tuple[str], np.ndarray]): messages to start from, by factor name, e.g. those of a previous run
+                    on a smaller version of the graph (see message_dict). Factors not in it start uniform.
+    changed (set): with messages, the variables whose factors changed since those messages converged. The residual
+                    schedule then only starts from the factors around them, and the other messages are recomputed
+                    only if a change reaches them.
+
+    Attributes:
+    messages (np.ndarray): shape (P, 2, 2), normalised factor-to-variable messages indexed as [factor, axis, state]
+    iterations (int): number of iterations run
+    updates (int): number of single-factor updates made by the residual schedule
+    residual (float): largest message change in the last iteration
+    """
+    def __init__(self, fg: FactorGraph | CompiledFactorGraph, schedule: str=BP_SCHEDULE, tol: float=BP_TOLERANCE, max_iter: int=BP_MAX_ITER,
+                 messages: Dict[Tuple[str], np.ndarray]=None, changed: set=None):
+        if schedule not in ("flooding", "residual"):
+            raise ValueError(f"Unknown schedule '{schedule}'. Use 'flooding' or 'residual'.")
+        self.graph = fg if isinstance(fg, CompiledFactorGraph) else CompiledFactorGraph(fg)
+        self.schedule = schedule
+        self.tol = tol
+        self.max_iter = max_iter
+        self.messages = np.full((len(self.graph.tables), 2, 2), 0.5)
+        self.iterations = 0
+        self.updates = 0
+        self.residual = 0.0
+        self.seed = slice(None) # factors whose messages may be out of date
+        if messages:
+            for p, name in enumerate(self.graph.factor_names):
+                if name in messages:
+                    self.messages[p] = messages[name]
+            if changed is not None:
+                changed_vars = [i for i, name in enumerate(self.graph.names) if name in changed]
+                self.seed = np.flatnonzero(np.isin(self.graph.factor_vars, changed_vars).any(axis=1))
+
+    def message_dict(self) -> Dict[Tuple[str], np.ndarray]:
+        """ The current messages by factor name, to warm start a later run """
+        return {name: self.messages[p].copy() for p, name in enumerate(self.graph.factor_names)}
+
+    def log_beliefs(self) -> np.ndarray:
+        """ Log of the product of the prior and all incoming messages, for each variable """
+        beliefs = self.graph.log_prior.copy()
+        np.add.at(beliefs, self.graph.factor_vars.ravel(), np.log(self.messages).reshape(-1, 2))
+        return beliefs
+
+    def factor_messages(self, log_beliefs: np.ndarray, factors=slice(None)) -> np.ndarray:
+        """ Computes new factor-to-variable messages for the given factors from the current beliefs """
+        tables = self.graph.tables[factors]
+        # Variable-to-factor messages: the belief without the factor's own message
+        incoming = normalise_log(log_beliefs[self.graph.factor_vars[factors]] - np.log(self.messages[factors]))
+        new = np.stack((np.einsum("pij,pj->pi", tables, incoming[:, 1]),
+                        np.einsum("pij,pi->pj", tables, incoming[:, 0])), axis=1)
+        return new / np.sum(new, axis=-1, keepdims=True)
+
+    def run(self) -> Dict[str, float]:
+        """ Runs message passing until convergence and returns the marginal probability of each variable being active """
+        if len(self.graph.tables):
+            if self.schedule == "flooding":
+                self._run_flooding()
+            else:
+                self._run_residual()
+        if len(self.graph.tables) and instrumentation.enabled():
+            instrumentation.count("inference.loopy.runs")
+            instrumentation.count("inference.loopy.iterations", self.iterations)
+            instrumentation.count("inference.loopy.factor_updates",
+                                  self.updates if self.schedule == "residual" else self.iterations * len(self.graph.tables))
+            instrumentation.count("inference.loopy.unconverged", int(self.residual >= self.tol))
+        return self.marginals()
+
+    def _run_flooding(self):
+        while self.iterations < self.max_iter:
+            self.iterations += 1
+            new = self.factor_messages(self.log_beliefs())
+            self.residual = float(np.max(np.abs(new - self.messages)))
+            self.messages = new
+            if self.residual < self.tol:
+                break
+
+    def _run_residual(self):
+        n_factors = len(self.graph.tables)
+        factor_vars = self.graph.factor_vars
+        factors_of = [np.flatnonzero((factor_vars == v).any(axis=1)) for v in range(len(self.graph.names))]
+
+        log_beliefs = self.log_beliefs()
+        pending = self.messages.copy()
+        residuals = np.zeros(n_factors)
+        pending[self.seed] = self.factor_messages(log_beliefs, self.seed)
+        residuals[self.seed] = np.max(np.abs(pending[self.seed] - self.messages[self.seed]), axis=(1, 2))
+        while self.iterations < self.max_iter:
+            self.iterations += 1
+            for _ in range(n_factors):
+                p = int(np.argmax(residuals))
+                if residuals[p] < self.tol:
+                    break
+                log_beliefs[factor_vars[p]] += np.log(pending[p]) - np.log(self.messages[p])
+                self.messages[p] = pending[p]
+                residuals[p] = 0.0
+                self.updates += 1
+                affected = np.unique(np.concatenate([factors_of[v] for v in factor_vars[p]]))
+                pending[affected] = self.factor_messages(log_beliefs, affected)
+                residuals[affected] = np.max(np.abs(pending[affected] - self.messages[affected]), axis=(1, 2))
+            self.residual = float(np.max(residuals))
+            if self.residual < self.tol:
+                break
+
+    def marginal_array(self) -> np.ndarray:
+        """ Probability of each variable being active, in variable order """
+        return normalise_log(self.log_beliefs())[:, 1]
+
+    def marginals(self) -> Dict[str, float]:
+        p = self.marginal_array()
+        return {name: float(p[i]) for i, name in enumerate(self.graph.names)}
+
+
+EXACT_BLOCK_SIZE = 1 << 22 # Max number of entries in the largest arrays of exact_marginal_arrays, see exact_blocks
+
+
+def all_states(n: int) -> np.ndarray:
+    """ Returns the (2**n, n) array of every assignment of n binary variables """
+    return (np.arange(2 ** n)[:, None] >> np.arange(n)) & 1
+
+
+def exact_blocks(graphs: List[CompiledFactorGraph], members: List[int], n: int, block_size: int=EXACT_BLOCK_SIZE) -> List[List[int]]:
+    """
+    Splits members, indices of graphs with n variables, into consecutive blocks for exact_marginal_arrays.
+    Its largest arrays hold, per graph, 2**n * n unary terms and 2**n terms per pairwise factor, so a block
+    takes 2**n * (n + its factors) entries in all. Blocks stay within block_size entries; a graph larger
+    than that is a block of its own.
+    """
+    blocks, block, size = [], [], 0
+    for i in members:
+        cost = 2 ** n * (n + len(graphs[i].tables))
+        if block and size + cost > block_size:
+            blocks.append(block)
+            block, size = [], 0
+        block.append(i)
+        size += cost
+    if block:
+        blocks.append(block)
+    return blocks
+
+
+def exact_marginal_arrays(graphs: List[CompiledFactorGraph]) -> List[np.ndarray]:
+    """
+    Computes exact marginals by evaluating the product of all factor distributions over the full
+    state space. Graphs with the same number of variables are evaluated together.
+    Returns, for each graph, the probability of each variable being active.
+    """
+    results = [None] * len(graphs)
+    by_size = dict()
+    for i, graph in enumerate(graphs):
+        by_size.setdefault(len(graph.names), []).append(i)
+
+    for n, members in by_size.items():
+        states = all_states(n)
+        var_index = np.broadcast_to(np.arange(n), states.shape)
+        instrumentation.count("inference.exact.states", len(states) * len(members))
+        for block_members in exact_blocks(graphs, members, n):
+            block = [graphs[i] for i in block_members]
+            # Unary factors: log_prior[graph, variable, state of variable] summed over variables
+            log_joint = np.stack([g.log_prior for g in block])[:, var_index, states].sum(axis=2)
+
+            # Pairwise factors, each summed into its own graph's row
+            counts = np.array([len(g.tables) for g in block])
+            if counts.sum():
+                with np.errstate(divide="ignore"):
+                    log_tables = np.log(np.concatenate([g.tables for g in block]))
+                factor_vars = np.concatenate([g.factor_vars for g in block])
+                terms = log_tables[np.arange(len(log_tables)), states[:, factor_vars[:, 0]], states[:, factor_vars[:, 1]]]
+                starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+                has_factors = counts > 0
+                log_joint[has_factors] += np.add.reduceat(terms, starts[has_factors], axis=1).T
+
+            p = normalise_log(log_joint) @ states
+            for k, i in enumerate(block_members):
+                results[i] = p[k]
+    return results
+
+
+def resolve_engine(fg: FactorGraph, engine: str=INFERENCE_ENGINE) -> str:
+    """ The engine that runs for fg: "auto" is "exact" for graphs with at most EXACT_INFERENCE_MAX_VARIABLES variables, "loopy" otherwise """
+    if engine == "auto":
+        return "exact" if len(fg.variables) <= EXACT_INFERENCE_MAX_VARIABLES else "loopy"
+    return engine
+
+
+def run_batched_inference(factor_graphs: List[FactorGraph], batch_size: int=INFERENCE_BATCH_SIZE, engine: str=INFERENCE_ENGINE) -> List[Dict[str, float]]:
+    """
+    Runs inference for many factor graphs at once and sets their marginals.
+    With engine "auto", graphs with at most EXACT_INFERENCE_MAX_VARIABLES variables are solved
+    exactly and the others with loopy belief propagation; "exact" and "loopy" force one of them.
+    Each batch of graphs for loopy belief propagation is packed into one CompiledFactorGraph. As the
+    graphs are disjoint, one flooding run over the packed arrays gives every graph its own marginals,
+    with the Python overhead paid per batch rather than per graph.
+    Returns the marginals of each graph, in order.
+    """
+    if engine == "recursive":
+        return [fg.run_inference(engine) for fg in factor_graphs]
+    if engine not in ("auto", "exact", "loopy"):
+        raise ValueError(f"Unknown inference engine '{engine}'. Use 'auto', 'exact', 'loopy' or 'recursive'.")
+
+    for start in range(0, len(factor_graphs), batch_size):
+        batch = factor_graphs[start:start + batch_size]
+        compiled = [CompiledFactorGraph(fg) for fg in batch]
+        instrumentation.count("inference.graphs", len(batch))
+        instrumentation.count("inference.factors", sum(len(g.tables) for g in compiled))
+        exact = [resolve_engine(fg, engine) == "exact" for fg in batch]
+
+        exact_graphs = [g for g, is_exact in zip(compiled, exact) if is_exact]
+        exact_results = iter(exact_marginal_arrays(exact_graphs))
+
+        packed, offsets = CompiledFactorGraph.concatenate([g for g, is_exact in zip(compiled, exact) if not is_exact])
+        bp = LoopyBeliefPropagation(packed, schedule="flooding")
+        bp.run()
+        loopy_p = bp.marginal_array().tolist()
+        loopy_offsets = iter(offsets)
+        loopy_stats = {"engine": "batched loopy", "iterations": bp.iterations, "residual": bp.residual, "batch_size": len(batch)}
+
+        for fg, is_exact in zip(batch, exact):
+            if is_exact:
+                fg.marginals = {name: float(p) for name, p in zip(fg.variables, next(exact_results))}
+                fg.inference_stats = {"engine": "batched exact", "batch_size": len(batch)}
+            else:
+                offset = next(loopy_offsets)
+                fg.marginals = {name: loopy_p[offset + i] for i, name in enumerate(fg.variables)}
+                fg.inference_stats = loopy_stats
+    return [fg.marginals for fg in factor_graphs]
+
+
+class TacticSummary:
+    """
+    Per-tactic summary of a set of alerts: everything the compressed FactorGraph and the weighted score need.
+    Arrays are indexed by tactic code, i.e. position in MITRE_TACTICS; tactics without alerts have count 0.
+    Alerts can be added one at a time and summaries of disjoint sets of alerts merged, both in O(1).
+
+    Attributes:
+    count (np.ndarray): number of alerts of each tactic
+    severity_sum (np.ndarray): sum of their severities
+    first, last (np.ndarray): int64 epoch microseconds of their earliest and latest alert
+    log_distr (np.ndarray): (tactics, 2) sums of log(1 - severity / 10) and log(severity / 10)
+    order (np.ndarray): position of each tactic's first alert, which orders the factor graph's variables
+    """
+    def __init__(self):
+        n_tactics = len(MITRE_TACTICS)
+        self.count = np.zeros(n_tactics, dtype=np.int64)
+        self.severity_sum = np.zeros(n_tactics, dtype=np.int64)
+        self.first = np.full(n_tactics, np.iinfo(np.int64).max)
+        self.last = np.full(n_tactics, np.iinfo(np.int64).min)
+        self.log_distr = np.zeros((n_tactics, 2))
+        self.order = np.full(n_tactics, np.iinfo(np.int64).max)
+
+    @classmethod
+    def from_arrays(cls, tactic_codes: np.ndarray, severities: np.ndarray, times: np.ndarray) -> TacticSummary:
+        """ Summary of alerts given by their tactic codes, severities and epoch times, ordered by position """
+        summary = cls()
+        tactic_codes = np.asarray(tactic_codes, dtype=np.int64)
+        np.add.at(summary.count, tactic_codes, 1)
+        np.add.at(summary.severity_sum, tactic_codes, severities)
+        np.minimum.at(summary.first, tactic_codes, times)
+        np.maximum.at(summary.last, tactic_codes, times)
+        np.minimum.at(summary.order, tactic_codes, np.arange(len(tactic_codes)))
+
+        alert_scores = np.asarray(severities) / 10.0
+        with np.errstate(divide="ignore"): # a severity of 0 or 10 gives a zero probability
+            np.add.at(summary.log_distr[:, 0], tactic_codes, np.log(1 - alert_scores))
+            np.add.at(summary.log_distr[:, 1], tactic_codes, np.log(alert_scores))
+        return summary
+
+    @property
+    def n_alerts(self) -> int:
+        return int(self.count.sum())
+
+    def add(self, tactic_code: int, severity: int, time: int, position: int):
+        """ Adds one alert; position orders tactics by first appearance and should grow with every alert """
+        self.count[tactic_code] += 1
+        self.severity_sum[tactic_code] += severity
+        self.first[tactic_code] = min(self.first[tactic_code], time)
+        self.last[tactic_code] = max(self.last[tactic_code], time)
+        self.order[tactic_code] = min(self.order[tactic_code], position)
+        with np.errstate(divide="ignore"):
+            self.log_distr[tactic_code] += np.log([1 - severity / 10.0, severity / 10.0])
+
+    def merge(self, other: TacticSummary):
+        """ Adds the alerts of other, which must not share alerts with this summary """
+        self.count += other.count
+        self.severity_sum += other.severity_sum
+        np.minimum(self.first, other.first, out=self.first)
+        np.maximum(self.last, other.last, out=self.last)
+        np.minimum(self.order, other.order, out=self.order)
+        self.log_distr += other.log_distr
+
+
 class FactorGraph:
     """
     Class for constructing factor graphs to compute marginal probabilities of tactics given a list of alerts
@@ -143,12 +498,157 @@ class FactorGraph:
     
     marginals (Dict[str, float]): A dictionary mapping MITRE tactics to their score/probability according to the factor graph
     """
-    def __init__(self, alerts: List):
+    def __init__(self, alerts: List, compress: bool=True):
+        """ With compress=False the graph is built the original way, with one unary factor per alert
+        and a scan over all alert pairs. The marginals are the same either way, except for the
+        "recursive" engine whose truncation depends on the number and order of factors.
+        """
         tactics = list([EVENT_TYPE_TO_MITRE[alert['type']][0] for alert in alerts]) # TODO: Need to be translated to MITRE tactics
+        if compress:
+            self._build_from_summaries(np.array([TACTIC_CODES[t] for t in tactics], dtype=np.uint8),
+                                       np.array([alert['severity'] for alert in alerts]),
+                                       np.array([to_epoch_us(alert['timestamp']) for alert in alerts], dtype=np.int64))
+        else:
+            times = [datetime.fromisoformat(alert['timestamp']) for alert in alerts]
+            self._build([alert['id'] for alert in alerts], tactics, [alert['severity'] for alert in alerts], times)
+
+    @classmethod
+    def from_store(cls, store, rows: List[int], compress: bool=True) -> FactorGraph:
+        """ Builds the factor graph of the alerts at the given rows of an EventStore """
+        fg = cls.__new__(cls)
+        if compress:
+            fg._build_from_summaries(store.tactic_codes[rows], store.severity[rows], store.timestamps[rows])
+        else:
+            fg._build([store.ids[row] for row in rows], [store.tactic(row) for row in rows],
+                      store.severity[rows].tolist(), store.timestamps[rows].tolist())
+        return fg
+
+    @classmethod
+    def from_arrays(cls, tactic_codes: np.ndarray, severities: np.ndarray, times: np.ndarray) -> FactorGraph:
+        """ Builds the factor graph from the tactic codes, severities and epoch times of its alerts """
+        fg = cls.__new__(cls)
+        fg._build_from_summaries(tactic_codes, severities, times)
+        return fg
+
+    @classmethod
+    def from_summary(cls, summary: TacticSummary) -> FactorGraph:
+        """ Builds the factor graph of the alerts a TacticSummary describes """
+        fg = cls.__new__(cls)
+        fg._build_from_tactic_summary(summary)
+        return fg
+
+    def _build_from_summaries(self, tactic_codes: np.ndarray, severities: np.ndarray, times: np.ndarray):
+        """ Builds the graph from the alerts' per-tactic summary, in O(n log n) """
+        self._build_from_tactic_summary(TacticSummary.from_arrays(tactic_codes, severities, times))
+
+    def _build_from_tactic_summary(self, summary: TacticSummary):
+        """
+        Builds the graph from a per-tactic summary of the alerts, in O(1) in the number of alerts:
+        - the unary factors of a tactic's alerts are folded into one factor named after the tactic,
+          whose distribution is the normalised product of theirs;
+        - the factor (X, Y) exists iff some alert of X is no later than some alert of Y,
+          i.e. iff first time of X <= last time of Y. This is exactly when the pairwise scan creates it.
+        """
+        self.summary = summary
+        self.variables = dict()
+        self.factors = dict()
+        self.marginals = None
+        self.messages = dict() # converged loopy messages by factor name, to warm start update_inference
+        self.changed = set() # variables whose factors changed since self.messages converged
+
+        # Variables in order of first appearance, as the pairwise scan creates them
+        present = np.flatnonzero(summary.count)
+        order = present[np.argsort(summary.order[present], kind="stable")]
+        for t in order.tolist():
+            self._add_variable(t)
+
+        # For each tactic X, the tactics Y with last[Y] >= first[X] are a suffix of the tactics sorted by last time
+        by_last = present[np.argsort(summary.last[present], kind="stable")]
+        sorted_last = summary.last[by_last]
+        for x in order.tolist():
+            for y in by_last[np.searchsorted(sorted_last, summary.first[x], side="left"):].tolist():
+                if x != y:
+                    self._add_factor(x, y)
+
+    def _add_variable(self, t: int):
+        """ Adds the variable of tactic code t with its unary factor, which is always its first neighbour """
+        name = MITRE_TACTICS[t]
+        var_node = VariableNode(name)
+        self.variables[name] = var_node
+
+        fact_node = FactorNode(name)
+        fact_node.set_distr(normalise_log(self.summary.log_distr[t]))
+        fact_node.add_neighbour(var_node)
+        var_node.add_neighbour(fact_node)
+
+    def _add_factor(self, x: int, y: int):
+        """ Adds the pairwise factor (X, Y) of tactic codes x and y, unless the graph already has it """
+        factor_node_name = (MITRE_TACTICS[x], MITRE_TACTICS[y])
+        if factor_node_name in self.factors:
+            return
+        fact_node = FactorNode(factor_node_name)
+        mu = MITRE_TRANSITION[MITRE_TACTICS[x]][MITRE_TACTICS[y]]
+        fact_node.set_distr(np.array([[FALSE_INDICATION, 1 - mu], [1 - mu, mu]]))
+
+        for var_node in (self.variables[MITRE_TACTICS[x]], self.variables[MITRE_TACTICS[y]]):
+            fact_node.add_neighbour(var_node)
+            var_node.add_neighbour(fact_node)
+        self.factors[factor_node_name] = fact_node
+
+    def add_alert(self, tactic_code: int, severity: int, time: int, position: int):
+        """ Adds one alert to a graph built from a TacticSummary, in place. See TacticSummary.add for position. """
+        self.summary.add(tactic_code, severity, time, position)
+        self._refresh([tactic_code])
+
+    def merge(self, other: FactorGraph):
+        """
+        Adds in place the alerts of another graph built from a TacticSummary, e.g. when a new correlation edge
+        joins two incidents. other's messages are kept for the factors this graph does not have yet.
+        """
+        self.summary.merge(other.summary)
+        for name, message in other.messages.items():
+            self.messages.setdefault(name, message)
+        self._refresh(np.flatnonzero(other.summary.count).tolist())
+
+    def _refresh(self, tactics: List[int]):
+        """
+        Brings the graph in line with self.summary after alerts of the given tactic codes were added.
+        Only their unary factors change, and pairwise factors are only ever added, since a tactic's
+        first time can only decrease and its last time only increase.
+        """
+        summary = self.summary
+        n_variables = len(self.variables)
+        for t in tactics:
+            name = MITRE_TACTICS[t]
+            if name in self.variables:
+                self.variables[name].neighbours[0].set_distr(normalise_log(summary.log_distr[t]))
+            else:
+                self._add_variable(t)
+            self.changed.add(name)
+
+        present = np.flatnonzero(summary.count).tolist()
+        for x in tactics:
+            for y in present:
+                if x == y:
+                    continue
+                if summary.first[x] <= summary.last[y]:
+                    self._add_factor(x, y)
+                if summary.first[y] <= summary.last[x]:
+                    self._add_factor(y, x)
+
+        if len(self.variables) != n_variables: # keep the order of first appearance
+            self.variables = {MITRE_TACTICS[t]: self.variables[MITRE_TACTICS[t]] for t in sorted(present, key=lambda t: summary.order[t])}
+        self.marginals = None
+
+    def _build(self, ids: List, tactics: List[str], severities: List, times: List):
+        """ Builds the graph from parallel lists of alert ids, tactics, severities and comparable timestamps,
+        with one unary factor per alert and a scan over all pairs of alerts """
         self.variables = dict() # Use a dict to easily find the variable nodes for a given tactic
         self.factors = dict()
         
         self.marginals = None
+        self.messages = dict()
+        self.changed = set()
 
         # Constructing variable nodes for the tactics
         for tactic in tactics:
@@ -156,26 +656,26 @@ class FactorGraph:
             self.variables[tactic] = var_node
         
         # Constructing single-alert factor nodes
-        for alert_a in alerts:
+        for a, alert_a_id in enumerate(ids):
             # create factor node for alert_a
-            fact_node = FactorNode(alert_a['id'])
-            tactic = EVENT_TYPE_TO_MITRE[alert_a['type']][0]
+            fact_node = FactorNode(alert_a_id)
+            tactic = tactics[a]
             fact_node.add_neighbour(self.variables[tactic])
             self.variables[tactic].add_neighbour(fact_node)
 
-            alert_score = alert_a['severity'] / 10.0
+            alert_score = severities[a] / 10.0
             fact_node.set_distr(np.array([1 - alert_score, alert_score]))
 
             # create pairwise factor nodes for tactics
             # Need to account for temporal data
-            alert_a_time = datetime.fromisoformat(alert_a['timestamp'])
-            alert_a_tactic = EVENT_TYPE_TO_MITRE[alert_a['type']][0]
-            for alert_b in alerts:
-                alert_b_tactic = EVENT_TYPE_TO_MITRE[alert_b['type']][0]
+            alert_a_time = times[a]
+            alert_a_tactic = tactics[a]
+            for b in range(len(ids)):
+                alert_b_tactic = tactics[b]
                 if alert_a_tactic == alert_b_tactic: # Only connect distinct tactics
                     continue
                 
-                alert_b_time = datetime.fromisoformat(alert_b['timestamp'])
+                alert_b_time = times[b]
                 factor_node_name = (alert_a_tactic, alert_b_tactic) # node name encodes the temporal data
                 if alert_b_time < alert_a_time:
                     factor_node_name = (alert_b_tactic, alert_a_tactic)
@@ -200,10 +700,52 @@ class FactorGraph:
                 # Add factor node to collection of nodes
                 self.factors[factor_node_name] = fact_node
     
-    def run_inference(self) -> Dict[str, np.ndarray]:
-        """ Sets the marginals and returns it """
-        m = Messages()
-        self.marginals = m.marginals(self)
+    def run_inference(self, engine: str=INFERENCE_ENGINE) -> Dict[str, float]:
+        """ Sets the marginals and returns it.
+        engine is "recursive" for the capped Messages recursion, "loopy" for LoopyBeliefPropagation,
+        "exact" for full enumeration of the states, or "auto" for "exact" on graphs with at most
+        EXACT_INFERENCE_MAX_VARIABLES variables and "loopy" otherwise.
+        Statistics about the run are kept in self.inference_stats.
+        """
+        engine = resolve_engine(self, engine)
+        instrumentation.count("inference.graphs")
+        instrumentation.count("inference.factors", len(self.factors))
+
+        if engine == "exact":
+            p = exact_marginal_arrays([CompiledFactorGraph(self)])[0]
+            self.marginals = {name: float(p[i]) for i, name in enumerate(self.variables)}
+            self.inference_stats = {"engine": engine, "states": 2 ** len(self.variables)}
+        elif engine == "recursive":
+            m = Messages()
+            self.marginals = m.marginals(self)
+            self.inference_stats = {"engine": engine}
+        elif engine == "loopy":
+            bp = LoopyBeliefPropagation(self)
+            self.marginals = bp.run()
+            self.inference_stats = {"engine": engine, "iterations": bp.iterations, "residual": bp.residual}
+        else:
+            raise ValueError(f"Unknown inference engine '{engine}'. Use 'auto', 'exact', 'loopy' or 'recursive'.")
+        # Only messages of a loopy run are a fixed point of this graph to resume from
+        self.messages = bp.message_dict() if engine == "loopy" else dict()
+        self.changed = set()
+        return self.marginals
+
+    def update_inference(self, engine: str=INFERENCE_ENGINE) -> Dict[str, float]:
+        """
+        Sets the marginals again after add_alert or merge, and returns them.
+        Loopy belief propagation resumes from the messages of the previous run with the residual schedule,
+        starting from the factors of the changed variables, so its cost follows the size of the change
+        rather than the size of the graph. Other engines, and graphs without previous messages, run from scratch.
+        """
+        engine = resolve_engine(self, engine)
+        if engine != "loopy" or not self.messages:
+            return self.run_inference(engine)
+
+        bp = LoopyBeliefPropagation(self, schedule="residual", messages=self.messages, changed=self.changed)
+        self.marginals = bp.run()
+        self.inference_stats = {"engine": "warm loopy", "iterations": bp.iterations, "updates": bp.updates, "residual": bp.residual}
+        self.messages = bp.message_dict()
+        self.changed = set()
         return self.marginals
     
     # FactorGraphs should not be computing scores
@@ -241,4 +783,12 @@ if __name__ == "__main__":
     alerts = data['events'][:10]
     fg = FactorGraph(alerts)
 
-    print(fg.run_inference())
+    for engine in ("exact", "loopy", "recursive"):
+        print(engine, fg.run_inference(engine))
+
+    # Growing the graph in place: loopy belief propagation resumes from the previous messages
+    fg.run_inference("loopy")
+    for position, alert in enumerate(data['events'][10:20], start=10):
+        fg.add_alert(TACTIC_CODES[EVENT_TYPE_TO_MITRE[alert['type']][0]], alert['severity'], to_epoch_us(alert['timestamp']), position)
+        fg.update_inference("loopy")
+        print(alert['id'], fg.inference_stats)
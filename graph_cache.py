@@ -0,0 +1,162 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import networkx as nx
+from utils import save_graph, load_graph
+from compact_graph import CompactGraph, save_compact_graph
+from config import CORRELATION_THRESHOLD, EVENT_TYPE_TO_MITRE, CACHE_DIRECTORY, CACHE_MAX_BYTES, CACHE_GRAPH_FORMAT, trans_prob
+
+CACHE_FORMATS = ("compact", "pickle")
+CACHE_FORMAT_VERSION = 3 # Bump when the correlation graph's contents change for the same inputs
+INDEX_FILENAME = "cache_index.json"
+
+def dataset_fingerprint(filepath: str, chunk_size: int = 1 << 20) -> str:
+  '''
+  Returns the sha256 of the dataset file, read in chunks.
+  '''
+  digest = hashlib.sha256()
+  with open(filepath, "rb") as f:
+    for chunk in iter(lambda: f.read(chunk_size), b""):
+      digest.update(chunk)
+  return digest.hexdigest()
+
+def correlation_config_fingerprint() -> str:
+  '''
+  Returns the sha256 of every setting that changes the correlation graph.
+  '''
+  config = {"version"            : CACHE_FORMAT_VERSION,
+            "threshold"          : CORRELATION_THRESHOLD,
+            "transition_matrix"  : trans_prob,
+            "event_type_to_mitre": EVENT_TYPE_TO_MITRE}
+  return hashlib.sha256(json.dumps(config, sort_keys=True).encode()).hexdigest()
+
+class GraphCache:
+  """
+  Content-addressed cache of attack correlation graphs, stored with compact_graph.save_compact_graph
+  (graph_format "compact": a directory of arrays, memory-mapped by get) or with utils.save_graph
+  (graph_format "pickle": one file, read whole by get). New entries are stored in graph_format;
+  each index entry records its own format, so entries written in the other one are still
+  loaded, counted and evicted. An entry's key is a fingerprint of the dataset and of the correlation config, so
+  changing either is a miss instead of a silently wrong graph. Several entries are kept
+  and the least recently used ones are evicted once they take more than max_bytes on disk.
+
+  Attributes:
+  hits, misses (int): lookups made through this object
+  """
+  def __init__(self, directory: str = CACHE_DIRECTORY, max_bytes: int = CACHE_MAX_BYTES, graph_format: str = CACHE_GRAPH_FORMAT):
+    if graph_format not in CACHE_FORMATS:
+      raise ValueError(f"Unknown cache format '{graph_format}'. Use one of {CACHE_FORMATS}.")
+    self.directory = directory
+    self.max_bytes = max_bytes
+    self.graph_format = graph_format
+    self.hits = 0
+    self.misses = 0
+    os.makedirs(directory, exist_ok=True)
+    self.index_path = os.path.join(directory, INDEX_FILENAME)
+    self.index = self._read_index()
+
+  def _read_index(self) -> dict:
+    try:
+      with open(self.index_path) as f:
+        index = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+      return {}
+    for key, entry in index.items():
+      # Entries written before the format was recorded: a .pkl file or a compact directory
+      if "format" not in entry:
+        entry["format"] = "pickle" if os.path.exists(self._path(key, "pickle")) else "compact"
+    # Drop entries whose file was deleted by hand
+    return {key: entry for key, entry in index.items() if os.path.exists(self._path(key, entry["format"]))}
+
+  def _write_index(self):
+    tmp_path = self.index_path + ".tmp"
+    with open(tmp_path, "w") as f:
+      json.dump(self.index, f, indent=2)
+    os.replace(tmp_path, self.index_path)
+
+  def _path(self, key: str, graph_format: str = None) -> str:
+    ''' Where the entry of key is stored, in graph_format, by default the one recorded in its index entry '''
+    graph_format = graph_format or self.index[key]["format"]
+    suffix = ".pkl" if graph_format == "pickle" else ""
+    return os.path.join(self.directory, f"attack_correlation_graph_{key}{suffix}")
+
+  def _remove(self, key: str):
+    path = self._path(key)
+    if os.path.isdir(path):
+      shutil.rmtree(path)
+    elif os.path.exists(path):
+      os.remove(path)
+
+  def _size(self, path: str) -> int:
+    if os.path.isfile(path):
+      return os.path.getsize(path)
+    return sum(entry.stat().st_size for entry in os.scandir(path))
+
+  def _load(self, key: str) -> nx.DiGraph | CompactGraph:
+    path = self._path(key)
+    return load_graph(path) if self.index[key]["format"] == "pickle" else CompactGraph(path)
+
+  def key(self, data_filepath: str) -> str:
+    ''' Returns the cache key for the given dataset under the current config. '''
+    return f"{dataset_fingerprint(data_filepath)[:24]}_{correlation_config_fingerprint()[:24]}"
+
+  def get(self, key: str) -> nx.DiGraph | CompactGraph | None:
+    '''
+    Returns the cached graph for key, or None on a miss. In the compact format this is a CompactGraph,
+    which only reads the parts of the graph that are used.
+    '''
+    if key not in self.index:
+      self.misses += 1
+      return None
+    self.hits += 1
+    self.index[key]["last_used"] = time.time()
+    self._write_index()
+    return self._load(key)
+
+  def put(self, key: str, graph: nx.DiGraph):
+    ''' Saves graph under key, then evicts least recently used entries over the disk budget. '''
+    if key in self.index and self.index[key]["format"] != self.graph_format:
+      self._remove(key)
+    path = self._path(key, self.graph_format)
+    if self.graph_format == "pickle":
+      save_graph(graph, path)
+    else:
+      save_compact_graph(graph, path)
+    self.index[key] = {"size": self._size(path), "last_used": time.time(), "format": self.graph_format}
+    self.evict(keep=key)
+    self._write_index()
+
+  def latest_with_same_config(self) -> nx.DiGraph | None:
+    '''
+    Returns the most recently used graph built with the current correlation config from
+    any dataset, or None. Only meaningful for append-only data feeds, see CACHE_APPEND_ONLY.
+    The graph is always an nx.DiGraph, since it is then extended in place.
+    '''
+    config_key = correlation_config_fingerprint()[:24]
+    same_config = [key for key in self.index if key.endswith(config_key)]
+    if not same_config:
+      return None
+    graph = self._load(max(same_config, key=lambda k: self.index[k]["last_used"]))
+    return graph.to_networkx() if isinstance(graph, CompactGraph) else graph
+
+  def evict(self, keep: str = None):
+    ''' Removes least recently used entries until the cache fits in max_bytes. '''
+    total = sum(entry["size"] for entry in self.index.values())
+    for key in sorted(self.index, key=lambda k: self.index[k]["last_used"]):
+      if total <= self.max_bytes:
+        break
+      if key == keep:
+        continue
+      total -= self.index[key]["size"]
+      self._remove(key)
+      del self.index[key]
+
+  def stats(self) -> dict:
+    lookups = self.hits + self.misses
+    return {"hits"    : self.hits,
+            "misses"  : self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries" : len(self.index),
+            "bytes"   : sum(entry["size"] for entry in self.index.values())}
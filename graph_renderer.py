@@ -0,0 +1,147 @@
+import os
+import json
+import hashlib
+import threading
+import networkx as nx
+from concurrent.futures import ProcessPoolExecutor, Future
+from utils import plot_graph, worker_context
+from config import IMAGES_DIRECTORY, RENDER_WORKERS
+
+RENDER_FORMAT_VERSION = 1 # Bump when plot_graph draws the same subgraph differently
+PLACEHOLDER_FILENAME = "placeholder.png"
+
+def subgraph_payload(subgraph: nx.Graph, node_label: str = "description", store=None) -> tuple:
+  '''
+  Returns everything plot_graph draws for a subgraph as plain lists: (nodes, edges) with
+  nodes as (id, severity, label) and edges as (u, v, weight, match_IP).
+  This is what is hashed for the cache key and what is sent to the rendering workers.
+  Nodes, edges and the IPs of match_IP are sorted, since the iteration order of a subgraph
+  view and of the IP sets behind match_IP change from one process to the next.
+  A compact_graph.CompactSubgraph is first turned into the nx.DiGraph it stands for.
+  '''
+  if hasattr(subgraph, "to_networkx"):
+    subgraph = subgraph.to_networkx()
+  if store is not None:
+    node_attributes = lambda node, field, default=None: store.get(store.row_of[node], field, default)
+  else:
+    node_attributes = lambda node, field, default=None: subgraph.nodes[node].get(field, default)
+
+  nodes = [(node, node_attributes(node, "severity"), node_attributes(node, node_label, "")) for node in sorted(subgraph.nodes)]
+  edges = sorted((u, v, d.get("weight", 0), ",".join(sorted(d.get("match_IP", "").split(","))))
+                 for u, v, d in subgraph.edges(data=True))
+  return nodes, edges
+
+def payload_key(payload: tuple) -> str:
+  ''' Returns the sha256 of a subgraph payload, so an image is only reused while its contents are unchanged. '''
+  content = json.dumps([RENDER_FORMAT_VERSION, *payload], sort_keys=True, default=str)
+  return hashlib.sha256(content.encode()).hexdigest()
+
+def _init_worker():
+  # Workers must not draw through the GUI's Tk backend
+  import matplotlib.pyplot as plt
+  plt.switch_backend("Agg")
+
+def render_payload(payload: tuple, save_path: str) -> str:
+  '''
+  Draws a subgraph payload with plot_graph and saves it to save_path, through a temporary
+  file so a reader never sees a half written image. Returns save_path.
+  '''
+  nodes, edges = payload
+  subgraph = nx.DiGraph()
+  for node, severity, label in nodes:
+    subgraph.add_node(node, severity=severity, label=label)
+  for u, v, weight, match_IP in edges:
+    subgraph.add_edge(u, v, weight=weight, match_IP=match_IP)
+
+  tmp_path = f"{save_path}.{os.getpid()}.tmp"
+  plot_graph(subgraph, node_label="label", save_path=tmp_path)
+  os.replace(tmp_path, save_path)
+  return save_path
+
+class GraphRenderer:
+  """
+  Renders incident subgraph images in a process pool, only when they are asked for.
+  Images are named after payload_key, so an image on disk is reused across runs until
+  its subgraph changes, and a changed subgraph never shows a stale image.
+  Components without edges all share the placeholder image.
+
+  Attributes:
+  rendered, reused (int): images drawn by this object and images found on disk
+  """
+  def __init__(self, store=None, directory: str = IMAGES_DIRECTORY, num_workers: int = RENDER_WORKERS):
+    self.store = store
+    self.directory = directory
+    self.num_workers = num_workers or os.cpu_count()
+    self.subgraphs = {}
+    self.save_paths = {} # index -> content keyed image path, hashed once per incident
+    self.pending = {} # image path -> Future of a render in flight
+    self.rendered = 0
+    self.reused = 0
+    self._pool = None
+    self._lock = threading.Lock()
+    os.makedirs(directory, exist_ok=True)
+
+  def set_subgraphs(self, event_subgraphs: list):
+    ''' Registers the incidents that can be rendered, as the event_subgraph dicts built by main.py. '''
+    self.subgraphs = {event_subgraph["Index"]: event_subgraph["Subgraph"] for event_subgraph in event_subgraphs}
+    self.save_paths = {}
+
+  def _pool_or_start(self) -> ProcessPoolExecutor:
+    if self._pool is None:
+      # Started from the GUI's pipeline thread, so never forked from this process, see worker_context
+      self._pool = ProcessPoolExecutor(self.num_workers, mp_context=worker_context(preload=[__name__]), initializer=_init_worker)
+    return self._pool
+
+  def request(self, index: int) -> Future:
+    '''
+    Returns a Future of the image path of incident index. It is already done if the image
+    is on disk; otherwise the image is rendered in the background, once however often it is asked for.
+    '''
+    subgraph = self.subgraphs[index]
+    if subgraph.number_of_edges() == 0:
+      return self._done(os.path.join(self.directory, PLACEHOLDER_FILENAME))
+
+    payload = None
+    save_path = self.save_paths.get(index)
+    if save_path is None:
+      payload = subgraph_payload(subgraph, store=self.store)
+      save_path = self.save_paths[index] = os.path.join(self.directory, f"subgraph_{payload_key(payload)[:32]}.png")
+    with self._lock:
+      if save_path in self.pending:
+        return self.pending[save_path]
+      if os.path.exists(save_path):
+        self.reused += 1
+        return self._done(save_path)
+      if payload is None: # the image was deleted since it was first requested
+        payload = subgraph_payload(subgraph, store=self.store)
+      future = self._pool_or_start().submit(render_payload, payload, save_path)
+      self.pending[save_path] = future
+      self.rendered += 1
+    future.add_done_callback(lambda _: self._forget(save_path))
+    return future
+
+  def _forget(self, save_path: str):
+    with self._lock:
+      self.pending.pop(save_path, None)
+
+  @staticmethod
+  def _done(path: str) -> Future:
+    future = Future()
+    future.set_result(path)
+    return future
+
+  def render(self, index: int, timeout: float = None) -> str:
+    ''' Returns the image path of incident index, waiting for it to be rendered if needed. '''
+    return self.request(index).result(timeout)
+
+  def prefetch(self, indices) -> list:
+    ''' Starts rendering the given incidents in the background, e.g. the highest priority ones. '''
+    return [self.request(index) for index in indices]
+
+  def shutdown(self, wait: bool = True):
+    if self._pool is not None:
+      self._pool.shutdown(wait=wait, cancel_futures=not wait)
+      self._pool = None
+
+  def stats(self) -> dict:
+    return {"rendered": self.rendered, "reused": self.reused, "pending": len(self.pending)}
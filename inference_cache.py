@@ -0,0 +1,137 @@
+from __future__ import annotations
+from typing import List, Dict, Tuple
+from collections import OrderedDict
+import os
+import json
+import pickle
+import hashlib
+
+from factor_graph import FactorGraph, MAX_ITER, run_batched_inference, resolve_engine
+from config import (INFERENCE_ENGINE, INFERENCE_CACHE_SIZE, INFERENCE_CACHE_PATH, FALSE_INDICATION, EXACT_INFERENCE_MAX_VARIABLES,
+                    BP_SCHEDULE, BP_TOLERANCE, BP_MAX_ITER, trans_prob)
+
+
+def inference_config_fingerprint() -> str:
+    """ Fingerprint of the settings that change marginals for the same canonical graph: every inference setting """
+    config = {"false_indication": FALSE_INDICATION, "transition_matrix": trans_prob, "engine": INFERENCE_ENGINE,
+              "exact_max_variables": EXACT_INFERENCE_MAX_VARIABLES, "bp_schedule": BP_SCHEDULE,
+              "bp_tolerance": BP_TOLERANCE, "bp_max_iter": BP_MAX_ITER, "recursive_max_iter": MAX_ITER}
+    return hashlib.sha256(json.dumps(config, sort_keys=True).encode()).hexdigest()
+
+
+def canonical_key(fg: FactorGraph, engine: str=INFERENCE_ENGINE) -> Tuple:
+    """
+    Canonical form of a factor graph: its variable set, its pairwise factor keys as stored in fg.factors,
+    and for each variable the sorted multiset of its unary factor distributions.
+    Graphs with the same key have the same marginals, whatever the order their alerts came in.
+    The unary distributions are kept per variable, since swapping them between tactics changes the marginals.
+    The key holds the engine that actually runs for fg, so "auto" never shares entries between "exact" and "loopy".
+    """
+    unary = tuple(
+        (name, tuple(sorted(tuple(factor.distr.tolist()) for factor in fg.variables[name].neighbours if len(factor.neighbours) == 1)))
+        for name in sorted(fg.variables)
+    )
+    return (resolve_engine(fg, engine), tuple(sorted(fg.factors)), unary)
+
+
+class InferenceCache:
+    """
+    Bounded LRU memo of factor graph marginals keyed by canonical_key, optionally persisted to disk between runs.
+
+    Attributes:
+    hits, misses (int): lookups made through this object
+    """
+    def __init__(self, max_entries: int=INFERENCE_CACHE_SIZE, path: str=INFERENCE_CACHE_PATH):
+        self.max_entries = max_entries
+        self.path = path
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        if path and os.path.exists(path):
+            self.load()
+
+    def get(self, fg: FactorGraph, engine: str=INFERENCE_ENGINE) -> Dict[str, float] | None:
+        """ Returns the cached marginals of fg in the order of fg.variables, or None """
+        key = canonical_key(fg, engine)
+        marginals = self.entries.get(key)
+        if marginals is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return {name: marginals[name] for name in fg.variables}
+
+    def put(self, fg: FactorGraph, marginals: Dict[str, float], engine: str=INFERENCE_ENGINE):
+        key = canonical_key(fg, engine)
+        self.entries[key] = dict(marginals)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def run_inference(self, fg: FactorGraph, engine: str=INFERENCE_ENGINE) -> Dict[str, float]:
+        """ Memoised FactorGraph.run_inference. The "recursive" engine depends on alert order, so it is never cached. """
+        if engine == "recursive":
+            return fg.run_inference(engine)
+        marginals = self.get(fg, engine)
+        if marginals is None:
+            marginals = fg.run_inference(engine)
+            self.put(fg, marginals, engine)
+        else:
+            fg.marginals = marginals
+            fg.inference_stats = {"engine": "cached"}
+        return marginals
+
+    def run_batched_inference(self, factor_graphs: List[FactorGraph], engine: str=INFERENCE_ENGINE) -> List[Dict[str, float]]:
+        """
+        Memoised run_batched_inference. Graphs with the same canonical form are only solved once,
+        whether the earlier one is in the cache or in the same batch.
+        """
+        if engine == "recursive":
+            return run_batched_inference(factor_graphs, engine=engine)
+        to_solve = dict() # canonical key -> first graph with that key
+        waiting = []
+        for fg in factor_graphs:
+            key = canonical_key(fg, engine)
+            marginals = self.entries.get(key)
+            if marginals is not None:
+                self.hits += 1
+                self.entries.move_to_end(key)
+                fg.marginals = {name: marginals[name] for name in fg.variables}
+                fg.inference_stats = {"engine": "cached"}
+            elif key in to_solve:
+                self.hits += 1
+                waiting.append((fg, to_solve[key]))
+            else:
+                self.misses += 1
+                to_solve[key] = fg
+
+        run_batched_inference(list(to_solve.values()), engine=engine)
+        for fg in to_solve.values():
+            self.put(fg, fg.marginals, engine)
+        for fg, solved in waiting:
+            fg.marginals = {name: solved.marginals[name] for name in fg.variables}
+            fg.inference_stats = {"engine": "cached"}
+        return [fg.marginals for fg in factor_graphs]
+
+    def save(self, path: str=None):
+        """ Writes the cache to disk, along with the config it is valid for """
+        path = path or self.path
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump({"config": inference_config_fingerprint(), "entries": self.entries}, f)
+        os.replace(tmp_path, path)
+
+    def load(self, path: str=None):
+        """ Reads a cache saved by save. A cache saved under a different config is ignored. """
+        with open(path or self.path, "rb") as f:
+            saved = pickle.load(f)
+        if saved.get("config") == inference_config_fingerprint():
+            self.entries = saved["entries"]
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def stats(self) -> Dict:
+        lookups = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / lookups if lookups else 0.0,
+                "entries": len(self.entries)}
@@ -0,0 +1,197 @@
+import os
+import json
+import time
+import shutil
+import signal
+import pstats
+import cProfile
+import resource
+import threading
+import subprocess
+import tracemalloc
+import numpy as np
+from contextlib import contextmanager, nullcontext
+from config import PROFILE_DIRECTORY, PROFILE_TRACE_MEMORY, PROFILE_SAMPLER
+
+_profiler = None # The RunProfile being recorded, if any. Every hook below is a no-op while it is None.
+_DISABLED_STAGE = nullcontext()
+
+def size_histogram(sizes) -> dict:
+  ''' Number of components by size bucket: "1", "2-3", "4-7", ... '''
+  histogram = {}
+  for size, count in zip(*np.unique(np.asarray(sizes, dtype=np.int64), return_counts=True)):
+    low = 1 << (int(size).bit_length() - 1)
+    bucket = str(low) if low == 1 else f"{low}-{2 * low - 1}"
+    histogram[bucket] = histogram.get(bucket, 0) + int(count)
+  return histogram
+
+def _max_rss_bytes() -> int:
+  # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+  max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  return max_rss if os.uname().sysname == "Darwin" else max_rss * 1024
+
+class RunProfile:
+  """
+  Timers, counters and peak memory of one run, e.g. one call of main.run_pipeline.
+  Stages nest; a stage's name is the path of the stages it is in, e.g. "scoring/inference".
+
+  Attributes:
+  stages (List[dict]): per stage, in the order they ended: name, seconds, peak_bytes (highest memory
+                       traced by tracemalloc during the stage, None if not tracing), net_bytes (traced
+                       memory kept at its end) and max_rss_bytes (the process's peak resident memory so far)
+  counters (Dict[str, int]): totals added with count
+  values (Dict[str, object]): values set with record, e.g. cache statistics or a size histogram
+  """
+  def __init__(self, name: str = "run", trace_memory: bool = PROFILE_TRACE_MEMORY):
+    self.name = name
+    self.trace_memory = trace_memory
+    self.stages = []
+    self.counters = {}
+    self.values = {}
+    self.files = {}
+    self._stack = [] # [name, start time, start traced bytes, peak traced bytes of the part before a nested stage]
+    self._lock = threading.Lock()
+    self._started_tracing = False
+
+  def start(self):
+    self.started = time.strftime("%Y-%m-%dT%H:%M:%S")
+    self._start = time.perf_counter()
+    if self.trace_memory and not tracemalloc.is_tracing():
+      tracemalloc.start()
+      self._started_tracing = True
+
+  def stop(self):
+    self.seconds = time.perf_counter() - self._start
+    if self._started_tracing:
+      tracemalloc.stop()
+
+  @contextmanager
+  def stage(self, name: str):
+    tracing = self.trace_memory and tracemalloc.is_tracing()
+    if tracing:
+      current, peak = tracemalloc.get_traced_memory()
+      if self._stack: # the enclosing stage's peak so far would be lost by the reset
+        self._stack[-1][3] = max(self._stack[-1][3], peak)
+      tracemalloc.reset_peak()
+    else:
+      current = None
+    full_name = "/".join([frame[0] for frame in self._stack] + [name])
+    self._stack.append([full_name, time.perf_counter(), current, 0])
+    try:
+      yield self
+    finally:
+      full_name, start, start_bytes, peak_before = self._stack.pop()
+      stage = {"name": full_name, "seconds": time.perf_counter() - start, "peak_bytes": None, "net_bytes": None}
+      if tracing:
+        current, peak = tracemalloc.get_traced_memory()
+        stage["peak_bytes"] = max(peak, peak_before)
+        stage["net_bytes"] = current - start_bytes
+        if self._stack:
+          self._stack[-1][3] = max(self._stack[-1][3], stage["peak_bytes"])
+      stage["max_rss_bytes"] = _max_rss_bytes()
+      self.stages.append(stage)
+
+  def count(self, name: str, value: int = 1):
+    with self._lock:
+      self.counters[name] = self.counters.get(name, 0) + value
+
+  def record(self, name: str, value):
+    self.values[name] = value
+
+  def report(self) -> dict:
+    return {"run": self.name, "started": self.started, "seconds": self.seconds, "trace_memory": self.trace_memory,
+            "max_rss_bytes": _max_rss_bytes(), "stages": self.stages, "counters": self.counters,
+            "values": self.values, "files": self.files}
+
+  def save(self, path: str):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "w") as f:
+      json.dump(self.report(), f, indent=2, default=str)
+
+# Hooks called from the pipeline's hot paths. Each costs one global lookup when no run is profiled,
+# so call them once per batch or per loop rather than once per pair or message.
+
+def enabled() -> bool:
+  return _profiler is not None
+
+def stage(name: str):
+  ''' Context manager timing a stage of the profiled run, or doing nothing '''
+  return _DISABLED_STAGE if _profiler is None else _profiler.stage(name)
+
+def count(name: str, value: int = 1):
+  if _profiler is not None:
+    _profiler.count(name, value)
+
+def record(name: str, value):
+  if _profiler is not None:
+    _profiler.record(name, value)
+
+@contextmanager
+def _sampler(kind: str, stem: str, files: dict):
+  if kind is None:
+    yield
+  elif kind == "cprofile":
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+      yield
+    finally:
+      profile.disable()
+      files["cprofile"] = stem + ".prof"
+      files["cprofile_summary"] = stem + ".prof.txt"
+      profile.dump_stats(files["cprofile"])
+      with open(files["cprofile_summary"], "w") as f:
+        pstats.Stats(profile, stream=f).sort_stats("cumulative").print_stats(50)
+  elif kind == "py-spy":
+    if shutil.which("py-spy") is None:
+      raise RuntimeError("PROFILE_SAMPLER is 'py-spy' but py-spy is not installed (pip install py-spy).")
+    files["py-spy"] = stem + ".speedscope.json"
+    sampler = subprocess.Popen(["py-spy", "record", "--pid", str(os.getpid()), "--format", "speedscope",
+                                "--output", files["py-spy"]], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+      yield
+    finally:
+      sampler.send_signal(signal.SIGINT) # py-spy writes its output when interrupted
+      sampler.wait()
+  else:
+    raise ValueError(f"Unknown sampler '{kind}'. Use None, 'cprofile' or 'py-spy'.")
+
+@contextmanager
+def profiled_run(name: str = "run", directory: str = PROFILE_DIRECTORY, trace_memory: bool = PROFILE_TRACE_MEMORY,
+                 sampler: str = PROFILE_SAMPLER):
+  '''
+  Profiles the code run inside the with block, yielding its RunProfile. The hooks above record
+  into it until the block ends; the report is then written to <directory>/<name>_<time>.json,
+  its path kept in profile.path. With sampler "cprofile" or "py-spy" the run is also profiled
+  by that profiler, whose output is saved next to the report and listed under "files".
+  Only one run is profiled at a time.
+  '''
+  global _profiler
+  if _profiler is not None:
+    raise RuntimeError(f"Run '{_profiler.name}' is already being profiled.")
+  profile = RunProfile(name, trace_memory)
+  stem = os.path.join(directory, f"{name}_{time.strftime('%Y%m%d_%H%M%S')}")
+  os.makedirs(directory, exist_ok=True)
+  _profiler = profile
+  profile.start()
+  try:
+    with _sampler(sampler, stem, profile.files):
+      yield profile
+  finally:
+    _profiler = None
+    profile.stop()
+    profile.path = stem + ".json"
+    profile.save(profile.path)
+
+if __name__ == "__main__":
+  # Overhead of the hooks with no run being profiled
+  n = 1_000_000
+  start = time.perf_counter()
+  for _ in range(n):
+    count("calls")
+  print(f"count() while disabled: {(time.perf_counter() - start) / n * 1e9:.0f} ns per call")
+  start = time.perf_counter()
+  for _ in range(n):
+    with stage("loop"):
+      pass
+  print(f"stage() while disabled: {(time.perf_counter() - start) / n * 1e9:.0f} ns per call")
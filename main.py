@@ -1,72 +1,161 @@
-import os
-
+import instrumentation
 from attack_correlation import *
-from data_loader import data_load_into_graph as load
-from utils import save_graph, load_graph, plot_graph, create_placeholder_graph
+from event_store import EventStore
+from utils import create_placeholder_graph
+from graph_cache import GraphCache
+from compact_graph import CompactGraph
 from factor_graph import *
-from config import IMAGES_DIRECTORY
-from attack_scoring import ScoreCalculator, EventsDataTracker
-
-
-# STEP 1: Load data as a graph and a dictionary
-print("Loading data...")
-G, data = load()
-
-# STEP 2: Compute attack correlation graph or load cache
-print("Finding attack correlation graph...")
-cache_path = "cached_graphs/attack_correlation_graph.pkl"
-if os.path.exists(cache_path):
-  H = load_graph(cache_path)
-  print("Loaded cached attack correlation graph.")
-else:
-  H = attack_correlation(G, data)
-  save_graph(H, cache_path)
-  print("Cached graph not found. New attack correlation graph created and cached.")
-
-# STEP 3: Compute factor graphs and scoring for each connected component
-# Extract components
-components = list(nx.connected_components(H.to_undirected()))
-components.sort(key=len, reverse=True)
-print("There are", len(components), "subgraphs.")
-print("Creating images...")
-
-all_event_subgraphs = []
-
-for i, component in enumerate(components):
-  subgraph = H.subgraph(component)
-  alerts = [event for event in data['events'] if event['id'] in subgraph.nodes()]
-  fg = FactorGraph(alerts)
-  marginals = fg.run_inference()
-  sc = ScoreCalculator(alerts, fg)
-  score = sc.compute_weighted_score() # this can be exported to a txt or json file if we like
-  # sc.export_scores_txt(f"incident{i}")
-  # sc.export_scores_json(f"incident{i}")
-  event_subgraph = {"Factor graph": fg,
-                    "Marginals"   : marginals,
-                    "Score"       : score,
-                    "Index"       : i, # This index is sorted by subgraph size.
-                    "Subgraph"    : subgraph,
-                    "Priority"    : None}
-  all_event_subgraphs.append(event_subgraph)
-
-ev_data_tracker = EventsDataTracker(all_event_subgraphs)
-ev_data_tracker.assign_priorities()
-ev_data_tracker.export_to_json()
-
-
-for event_subgraph in all_event_subgraphs:
-  subgraph = event_subgraph["Subgraph"]
-
-  # If you don't want 600+ images of a single node...
-  if subgraph.number_of_edges() == 0:
-    GRAPH_DISPLAY_CUTOFF = event_subgraph["Index"]
-    break # since after this they all have zero edges
-
-  index = event_subgraph["Index"]
-  save_path = IMAGES_DIRECTORY + f"event_subgraph_{index}.png"
-  if os.path.exists(save_path):
-    continue
-  plot_graph(subgraph, node_label="description", save_path=save_path)
-
-create_placeholder_graph()
-print("Done creating images.")
\ No newline at end of file
+from inference_cache import InferenceCache
+from parallel_scoring import score_components
+from graph_renderer import GraphRenderer
+from quantile_sketch import StreamingPriorityAssigner
+from config import PROFILE_ENABLED, RENDER_PREFETCH, DATA_FILEPATH, CACHE_APPEND_ONLY, INFERENCE_BATCH_SIZE, INFERENCE_CACHE_SIZE, INFERENCE_CACHE_PATH, NUM_WORKERS, PRIORITY_ASSIGNMENT
+from attack_scoring import ScoreCalculator, EventsDataTracker, IncidentRecord, IncidentRescorer
+
+class PipelineResult:
+  """
+  Everything one run of the pipeline produces, kept together so a caller (e.g. the GUI)
+  can swap a whole run in at once.
+
+  Attributes:
+  store (EventStore): the events the run was computed from
+  H (nx.DiGraph): the attack correlation graph
+  ev_data_tracker (EventsDataTracker): the scored incidents, sorted by score
+  component_rows (List[List[int]]): store rows of the alerts of each incident, by Index
+  GRAPH_DISPLAY_CUTOFF (int): incidents with an Index below this have an image, the rest are single events
+  renderer (GraphRenderer): renders the incidents' images on request
+  rescorer (IncidentRescorer): scores and prioritises the incidents again when the weight parameters change
+  """
+  def __init__(self, store, H, ev_data_tracker, component_rows, GRAPH_DISPLAY_CUTOFF, renderer, rescorer):
+    self.store = store
+    self.H = H
+    self.component_rows = component_rows
+    self.ev_data_tracker = ev_data_tracker
+    self.GRAPH_DISPLAY_CUTOFF = GRAPH_DISPLAY_CUTOFF
+    self.renderer = renderer
+    self.rescorer = rescorer
+
+def run_pipeline(data_filepath: str=DATA_FILEPATH, progress=print, profile: bool=PROFILE_ENABLED) -> PipelineResult:
+  '''
+  Runs the whole pipeline on data_filepath and returns its PipelineResult. Scores are exported
+  to DEFAULT_SCORES_PATH_JSON. progress is called with a message as each step starts or ends;
+  it is called from the thread running the pipeline.
+  With profile=True the run's stage timings, counters and peak memory are written to
+  PROFILE_DIRECTORY, see instrumentation.profiled_run.
+  '''
+  if not profile:
+    return _run_pipeline(data_filepath, progress)
+  with instrumentation.profiled_run("pipeline") as run_profile:
+    result = _run_pipeline(data_filepath, progress)
+  progress(f"Profile written to {run_profile.path}")
+  return result
+
+def _run_pipeline(data_filepath: str, progress) -> PipelineResult:
+  # STEP 1: Load data into a columnar event store
+  progress("Loading data...")
+  with instrumentation.stage("load"):
+    store = EventStore.from_file(data_filepath)
+  instrumentation.record("events", len(store))
+
+  # STEP 2: Compute attack correlation graph or load cache
+  progress("Finding attack correlation graph...")
+  with instrumentation.stage("correlation"):
+    cache = GraphCache()
+    cache_key = cache.key(data_filepath)
+    H = cache.get(cache_key)
+    if H is not None:
+      progress("Loaded cached attack correlation graph.")
+    else:
+      H = cache.latest_with_same_config() if CACHE_APPEND_ONLY else None
+      if H is not None:
+        old_size = H.number_of_nodes()
+        H = update_attack_correlation_from_store(H, store)
+        progress(f"Appended {H.number_of_nodes() - old_size} new events to the latest cached graph.")
+      else:
+        H = attack_correlation_from_store(store)
+        progress("Cached graph not found. New attack correlation graph created.")
+      cache.put(cache_key, H)
+  progress(f"Cache stats: {cache.stats()}")
+  instrumentation.record("graph_cache", cache.stats())
+  instrumentation.record("edges", H.number_of_edges())
+
+  # STEP 3: Compute factor graphs and scoring for each connected component
+  # Components are tracked by attack_correlation as it adds edges, largest first
+  with instrumentation.stage("components"):
+    components, component_of = event_components(H).components()
+    component_rows = [[] for _ in components]
+    for row, event_id in enumerate(store.ids): # rows come out sorted
+      component_rows[component_of[event_id]].append(row)
+  progress(f"There are {len(components)} subgraphs.")
+  instrumentation.record("components", len(components))
+  if instrumentation.enabled():
+    instrumentation.record("component_sizes", instrumentation.size_histogram([len(rows) for rows in component_rows]))
+
+  all_event_subgraphs = []
+
+  progress("Scoring subgraphs...")
+  with instrumentation.stage("scoring"):
+    if NUM_WORKERS != 1:
+      # Factor graphs are built and solved in the workers, only the marginals and scores come back
+      factor_graphs = [None] * len(components)
+      results = score_components(store, component_rows)
+    else:
+      with instrumentation.stage("factor_graphs"):
+        factor_graphs = [FactorGraph.from_store(store, rows) for rows in component_rows]
+      with instrumentation.stage("inference"):
+        if INFERENCE_CACHE_SIZE:
+          inference_cache = InferenceCache()
+          inference_cache.run_batched_inference(factor_graphs)
+          if INFERENCE_CACHE_PATH:
+            inference_cache.save()
+          progress(f"Inference cache stats: {inference_cache.stats()}")
+          instrumentation.record("inference_cache", inference_cache.stats())
+        elif INFERENCE_BATCH_SIZE:
+          run_batched_inference(factor_graphs)
+        else:
+          for fg in factor_graphs:
+            fg.run_inference()
+      with instrumentation.stage("weighted_scores"):
+        results = [(fg.marginals, ScoreCalculator.from_store(store, rows, fg).compute_weighted_score()) # this can be exported to a txt or json file if we like
+                   for rows, fg in zip(component_rows, factor_graphs)]
+
+  with instrumentation.stage("priorities"):
+    # A compact graph already holds each component's node indices, no need to look the ids up again
+    component_subgraph = H.component_subgraph if isinstance(H, CompactGraph) else lambda i: H.subgraph(components[i])
+    for i in range(len(components)):
+      marginals, score = results[i]
+      # The index is sorted by subgraph size. Records reference the subgraph view and factor graph, never copy them.
+      all_event_subgraphs.append(IncidentRecord(i, score, marginals, component_subgraph(i), factor_graphs[i]))
+
+    ev_data_tracker = EventsDataTracker(all_event_subgraphs)
+    if PRIORITY_ASSIGNMENT == "streaming":
+      assigner = StreamingPriorityAssigner()
+      for record in all_event_subgraphs:
+        assigner.add(record.score)
+      ev_data_tracker.assign_priorities_streaming(assigner)
+    else:
+      ev_data_tracker.assign_priorities()
+    # Lets the GUI apply analyst feedback to every score at once, see IncidentRescorer
+    rescorer = IncidentRescorer.from_store(store, component_rows, ev_data_tracker)
+
+  with instrumentation.stage("export"):
+    ev_data_tracker.export()
+
+  # Components with edges come first, the rest are single events shown with the placeholder image
+  GRAPH_DISPLAY_CUTOFF = next((i for i, component in enumerate(components) if len(component) == 1), len(components))
+
+  # Images are rendered in the background, the GUI asks the renderer for the others when they are selected
+  with instrumentation.stage("render_prefetch"):
+    renderer = GraphRenderer(store)
+    renderer.set_subgraphs(all_event_subgraphs)
+    with_image = [event_subgraph["Index"] for event_subgraph in ev_data_tracker.events if event_subgraph["Index"] < GRAPH_DISPLAY_CUTOFF]
+    renderer.prefetch(with_image[:RENDER_PREFETCH]) # events are sorted by score
+
+    create_placeholder_graph()
+  instrumentation.record("renderer", renderer.stats())
+  progress("Started rendering images.")
+
+  return PipelineResult(store, H, ev_data_tracker, component_rows, GRAPH_DISPLAY_CUTOFF, renderer, rescorer)
+
+if __name__ == "__main__":
+  run_pipeline()
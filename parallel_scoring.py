@@ -0,0 +1,129 @@
+from __future__ import annotations
+from typing import List, Dict, Tuple
+from concurrent.futures import ProcessPoolExecutor
+import os
+import numpy as np
+
+from factor_graph import FactorGraph, run_batched_inference
+from attack_scoring import ScoreCalculator
+from inference_cache import InferenceCache
+from utils import worker_context
+from config import NUM_WORKERS, CHUNKS_PER_WORKER, INFERENCE_CACHE_SIZE, INFERENCE_CACHE_PATH
+
+_inference_cache = None # Per worker memo, set up by _init_worker
+
+
+class ComponentChunk:
+    """
+    Compact payload for a run of consecutive components: the alert columns FactorGraph and
+    ScoreCalculator need, concatenated, about 10 bytes per alert once pickled.
+
+    Attributes:
+    start (int): index of the first component of the chunk
+    offsets (np.ndarray): the alerts of the chunk's k-th component are [offsets[k], offsets[k + 1])
+    tactic_codes, severities, times (np.ndarray): uint8 tactic code, uint8 severity and int64 epoch microseconds
+    """
+    __slots__ = ("start", "offsets", "tactic_codes", "severities", "times")
+
+    def __init__(self, start: int, store, component_rows: List[List[int]]):
+        rows = np.concatenate([np.asarray(r, dtype=np.int64) for r in component_rows])
+        self.start = start
+        self.offsets = np.concatenate(([0], np.cumsum([len(r) for r in component_rows])))
+        self.tactic_codes = store.tactic_codes[rows]
+        self.severities = store.severity[rows]
+        self.times = store.timestamps[rows]
+
+    def __getstate__(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __setstate__(self, state):
+        for name, value in zip(self.__slots__, state):
+            setattr(self, name, value)
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def component(self, k: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        alerts = slice(self.offsets[k], self.offsets[k + 1])
+        return self.tactic_codes[alerts], self.severities[alerts], self.times[alerts]
+
+
+def chunk_components(store, component_rows: List[List[int]], num_chunks: int) -> List[ComponentChunk]:
+    """
+    Splits the components, in order, into about num_chunks chunks of similar alert counts.
+    A component is never split, so a chunk holding one large component can exceed the target.
+    """
+    target = max(1, sum(len(rows) for rows in component_rows) // max(1, num_chunks))
+    chunks = []
+    start, size = 0, 0
+    for i, rows in enumerate(component_rows):
+        size += len(rows)
+        if size >= target:
+            chunks.append(ComponentChunk(start, store, component_rows[start:i + 1]))
+            start, size = i + 1, 0
+    if start < len(component_rows):
+        chunks.append(ComponentChunk(start, store, component_rows[start:]))
+    return chunks
+
+
+def _init_worker(cache_path: str | None):
+    """ Gives each worker its own inference memo, read from the saved one if there is one """
+    global _inference_cache
+    if INFERENCE_CACHE_SIZE:
+        _inference_cache = InferenceCache(path=cache_path)
+
+
+def score_chunk(chunk: ComponentChunk) -> List[Tuple[Dict[str, float], float]]:
+    """ Builds, solves and scores every component of a chunk. Returns (marginals, score) per component. """
+    factor_graphs = [FactorGraph.from_arrays(*chunk.component(k)) for k in range(len(chunk))]
+    if _inference_cache is not None:
+        _inference_cache.run_batched_inference(factor_graphs)
+    else:
+        run_batched_inference(factor_graphs)
+
+    results = []
+    for k, fg in enumerate(factor_graphs):
+        tactic_codes, severities, _ = chunk.component(k)
+        score = ScoreCalculator.from_arrays(tactic_codes, severities, fg).compute_weighted_score()
+        results.append((fg.marginals, score))
+    return results
+
+
+def score_components(store, component_rows: List[List[int]], num_workers: int | None=NUM_WORKERS,
+                     cache_path: str | None=INFERENCE_CACHE_PATH) -> List[Tuple[Dict[str, float], float]]:
+    """
+    Returns (marginals, score) for every component, in the order of component_rows, computed by a pool
+    of num_workers processes (None uses every core). The saved inference memo is read by every worker
+    but not updated, since each worker only sees its own chunks.
+    """
+    num_workers = num_workers or os.cpu_count()
+    chunks = chunk_components(store, component_rows, num_workers * CHUNKS_PER_WORKER)
+    if num_workers == 1:
+        _init_worker(cache_path)
+        return [result for chunk in chunks for result in score_chunk(chunk)]
+
+    with ProcessPoolExecutor(num_workers, mp_context=worker_context(preload=[__name__]), initializer=_init_worker,
+                             initargs=(cache_path,)) as pool:
+        # map yields the chunks' results in submission order, which keeps the components' Index order
+        return [result for chunk_results in pool.map(score_chunk, chunks) for result in chunk_results]
+
+
+if __name__ == "__main__":
+    import time
+    from event_store import EventStore
+    from attack_correlation import attack_correlation_from_store, event_components
+    from config import DATA_FILEPATH
+
+    store = EventStore.from_file(DATA_FILEPATH)
+    H = attack_correlation_from_store(store)
+    components, _ = event_components(H).components()
+    component_rows = [sorted(store.row_of[node] for node in component) for component in components]
+
+    baseline = None
+    for workers in sorted({1, 2, 4, os.cpu_count()}):
+        start = time.perf_counter()
+        results = score_components(store, component_rows, num_workers=workers, cache_path=None)
+        print(f"{workers} workers: {time.perf_counter() - start:.3f}s for {len(component_rows)} components")
+        baseline = baseline or results
+        # Chunks batch the components differently, so scores can differ in the last bits
+        assert np.allclose([score for _, score in results], [score for _, score in baseline])
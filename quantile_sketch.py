@@ -0,0 +1,197 @@
+from __future__ import annotations
+from typing import List, Tuple
+from bisect import bisect_right, insort
+import itertools
+import math
+import random
+
+from config import HIGH_PRIORITY, MED_PRIORITY, PRIORITY_SKETCH_K, PRIORITY_SKETCH_REBUILD
+
+
+class KLLSketch:
+    """ KLL quantile sketch (Karnin, Lang and Liberty, 2016) of a stream of numbers.
+    Holds O(k) items whatever the length of the stream; rank estimates are within about n / k of the
+    true rank with high probability. Two sketches of the same k can be merged, e.g. one per worker.
+
+    Attributes:
+    n (int): number of items added
+    compactors (List[List[float]]): items kept at each level, sorted; an item at level h stands for 2**h items
+    """
+    def __init__(self, k: int=PRIORITY_SKETCH_K, c: float=2/3, seed: int=0):
+        self.k = k
+        self.c = c
+        self.n = 0
+        self.compactors = [[]]
+        self.size = 0
+        self.max_size = self._capacity(0)
+        self._random = random.Random(seed)
+        self._cdf = None
+
+    def _capacity(self, height: int) -> int:
+        depth = len(self.compactors) - height - 1
+        return int(math.ceil(self.k * self.c ** depth)) + 1
+
+    def _grow(self):
+        self.compactors.append([])
+        self.max_size = sum(self._capacity(h) for h in range(len(self.compactors)))
+
+    def _compress(self):
+        """ Halves full levels into the level above until the sketch fits in max_size again """
+        for h in range(len(self.compactors)):
+            if len(self.compactors[h]) >= self._capacity(h):
+                if h + 1 >= len(self.compactors):
+                    self._grow()
+                items = self.compactors[h]
+                # An odd item out stays at this level; every other item moves up with twice the weight
+                kept = [items.pop()] if len(items) % 2 else []
+                self.compactors[h + 1] = sorted(self.compactors[h + 1] + items[self._random.random() < 0.5::2])
+                self.compactors[h] = kept
+                self.size = sum(len(compactor) for compactor in self.compactors)
+                if self.size < self.max_size:
+                    break
+
+    def update(self, x: float):
+        insort(self.compactors[0], x)
+        self.n += 1
+        self.size += 1
+        self._cdf = None
+        if self.size >= self.max_size:
+            self._compress()
+
+    def merge(self, other: KLLSketch):
+        """ Adds the items summarised by other to this sketch """
+        while len(self.compactors) < len(other.compactors):
+            self._grow()
+        for h, compactor in enumerate(other.compactors):
+            self.compactors[h] = sorted(self.compactors[h] + compactor)
+        self.n += other.n
+        self.size = sum(len(compactor) for compactor in self.compactors)
+        self._cdf = None
+        while self.size >= self.max_size:
+            self._compress()
+
+    def cdf(self) -> Tuple[List[float], List[int]]:
+        """ Sorted distinct items and the estimated number of items <= each, cached until the next update """
+        if self._cdf is None:
+            weighted = sorted((x, 2 ** h) for h, compactor in enumerate(self.compactors) for x in compactor)
+            items, counts = [], []
+            for x, weights in itertools.groupby(weighted, key=lambda pair: pair[0]):
+                items.append(x)
+                counts.append((counts[-1] if counts else 0) + sum(w for _, w in weights))
+            self._cdf = (items, counts)
+        return self._cdf
+
+    def rank(self, x: float) -> int:
+        """ Estimated number of items <= x, from the sorted levels, so updates in between cost no cdf """
+        return sum(bisect_right(compactor, x) << h for h, compactor in enumerate(self.compactors))
+
+    def quantile(self, q: float) -> float:
+        """ Estimated smallest item with at least a fraction q of the items <= it """
+        items, counts = self.cdf()
+        if not items:
+            raise ValueError("Quantile of an empty sketch.")
+        target = q * counts[-1]
+        i = bisect_right(counts, target - 1e-12)
+        return items[min(i, len(items) - 1)]
+
+    def __len__(self) -> int:
+        return self.n
+
+
+class StreamingPriorityAssigner:
+    """ Online High/Med/Low assignment with the same cut-offs as EventsDataTracker.assign_priorities:
+    an incident is High if fewer than int(n * HIGH_PRIORITY) incidents score more than it, Med if fewer than
+    int(n * (HIGH_PRIORITY + MED_PRIORITY)) do, Low otherwise, counting with KLL sketches instead of sorting.
+    A score that changes is removed from the distribution through a second sketch of removed scores.
+    Both sketches err by about their own n / k, so removals alone would let the error grow with every
+    rescoring. Given live_scores, a function returning the current scores, the sketches are rebuilt
+    from them once more than rebuild times the current count has been removed, keeping the error
+    within about (1 + 2 * rebuild) * n / k of the n current scores.
+    Unlike the batch assignment, incidents with equal scores always share a priority.
+    """
+    def __init__(self, high: float=HIGH_PRIORITY, med: float=MED_PRIORITY, k: int=PRIORITY_SKETCH_K, seed: int=0,
+                 live_scores=None, rebuild: float=PRIORITY_SKETCH_REBUILD):
+        self.high = high
+        self.med = med
+        self.k = k
+        self.seed = seed
+        self.live_scores = live_scores
+        self.rebuild = rebuild
+        self.rebuilds = 0
+        self.added = KLLSketch(k, seed=seed)
+        self.removed = KLLSketch(k, seed=seed + 1)
+
+    def __len__(self) -> int:
+        return self.added.n - self.removed.n
+
+    def add(self, score: float):
+        self.added.update(score)
+
+    def remove(self, score: float):
+        """ Takes back a score previously added, e.g. the old score of an incident that was rescored.
+        live_scores must no longer include it. """
+        self.removed.update(score)
+        self._rebuild_if_needed()
+
+    def _rebuild_if_needed(self):
+        """ Replaces the sketches by one of the live scores once the removed ones weigh too much """
+        if self.live_scores is not None and self.removed.n > self.rebuild * max(len(self), 1):
+            self.added = KLLSketch(self.k, seed=self.seed)
+            for score in self.live_scores():
+                self.added.update(score)
+            self.removed = KLLSketch(self.k, seed=self.seed + 1)
+            self.rebuilds += 1
+
+    def merge(self, other: StreamingPriorityAssigner):
+        self.added.merge(other.added)
+        self.removed.merge(other.removed)
+
+    def count_above(self, score: float) -> int:
+        """ Estimated number of current scores strictly greater than score """
+        n = len(self)
+        return max(0, n - (self.added.rank(score) - self.removed.rank(score)))
+
+    def priority(self, score: float) -> str:
+        """ Priority of score against the current distribution, without adding it """
+        n = len(self)
+        above = self.count_above(score)
+        if above < int(n * self.high):
+            return "High"
+        if above < int(n * (self.high + self.med)):
+            return "Med"
+        return "Low"
+
+    def assign(self, record, score: float=None) -> str:
+        """ Sets an IncidentRecord's score (if given) and priority, updating the distribution. Returns the priority.
+        A record that already has a priority is taken to be in the distribution with its current score.
+        """
+        tracked = record.priority is not None
+        if score is not None:
+            if tracked:
+                self.removed.update(record.score)
+            record.score = score
+        if score is not None or not tracked:
+            self.add(record.score)
+            self._rebuild_if_needed() # live_scores now hold the record's new score
+        record.priority = self.priority(record.score)
+        return record.priority
+
+
+if __name__ == "__main__":
+    # Agreement of the streaming assignment with the batch one on random scores
+    from attack_scoring import EventsDataTracker, IncidentRecord
+
+    rng = random.Random(1)
+    for n in (1000, 100000):
+        records = [IncidentRecord(i, rng.betavariate(2, 5), {}) for i in range(n)]
+        tracker = EventsDataTracker(records)
+        tracker.assign_priorities()
+        batch = [record.priority for record in tracker.by_index]
+
+        assigner = StreamingPriorityAssigner()
+        for record in records:
+            assigner.add(record.score)
+        tracker.assign_priorities_streaming(assigner)
+        agreement = sum(a == record.priority for a, record in zip(batch, tracker.by_index)) / n
+        items = sum(len(compactor) for compactor in assigner.added.compactors)
+        print(f"{n:>7} incidents: {agreement:.2%} same priority as the batch assignment, {items} items in the sketch")
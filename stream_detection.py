@@ -0,0 +1,333 @@
+import sys
+import json
+import time
+import socket
+import selectors
+import networkx as nx
+from config import CORRELATION_THRESHOLD, EVENT_TYPE_TO_MITRE, STREAM_WINDOW_SECONDS, STREAM_POLL_INTERVAL, STREAM_SOCKET_PORT, INFERENCE_ENGINE
+from data_loader import RECORD_KEYS
+from correlation_kernel import EVENT_TYPE_CODES, TACTIC_CODES, compile_type_transition_matrix, to_epoch_us
+from attack_correlation import EventComponents
+from factor_graph import FactorGraph, TacticSummary
+from attack_scoring import ScoreCalculator, IncidentRecord
+from quantile_sketch import StreamingPriorityAssigner, KLLSketch
+
+def parse_line(line: str):
+  '''
+  Parses one line of an event stream: a JSON object with a single key among RECORD_KEYS,
+  e.g. {"events": {...}}. Returns (key, record), or None for a blank line.
+  '''
+  if not line.strip():
+    return None
+  message = json.loads(line)
+  (key, record), = message.items()
+  if key not in RECORD_KEYS:
+    raise ValueError(f"Unknown record kind '{key}'. Use one of {list(RECORD_KEYS)}.")
+  return key, record
+
+def tail_jsonl(filepath: str, follow: bool = True, poll_interval: float = STREAM_POLL_INTERVAL):
+  '''
+  Yields the (key, record) lines of a JSON Lines file as they are appended, like tail -f.
+  A line is only parsed once its newline has been written. With follow=False it stops at the end of the file,
+  after parsing a last line without a newline.
+  '''
+  with open(filepath) as f:
+    partial = ""
+    while True:
+      line = f.readline()
+      if not line:
+        if not follow:
+          parsed = parse_line(partial)
+          if parsed:
+            yield parsed
+          return
+        time.sleep(poll_interval)
+        continue
+      if not line.endswith("\n"): # the writer is mid-line
+        partial += line
+        continue
+      parsed = parse_line(partial + line)
+      partial = ""
+      if parsed:
+        yield parsed
+
+def socket_records(port: int = STREAM_SOCKET_PORT, host: str = "127.0.0.1"):
+  '''
+  Listens on a local TCP port and yields the (key, record) lines sent by any number of clients,
+  e.g. `nc localhost 9099 < events.jsonl`. A client's last line needs no newline if it closes the
+  connection after it. Runs until interrupted.
+  '''
+  selector = selectors.DefaultSelector()
+  server = socket.create_server((host, port))
+  server.setblocking(False)
+  selector.register(server, selectors.EVENT_READ)
+  buffers = {}
+  try:
+    while True:
+      for key, _ in selector.select():
+        if key.fileobj is server:
+          connection, _ = server.accept()
+          connection.setblocking(False)
+          selector.register(connection, selectors.EVENT_READ)
+          buffers[connection] = b""
+          continue
+        connection = key.fileobj
+        data = connection.recv(1 << 16)
+        if not data:
+          selector.unregister(connection)
+          connection.close()
+          parsed = parse_line(buffers.pop(connection).decode())
+          if parsed:
+            yield parsed
+          continue
+        *lines, buffers[connection] = (buffers[connection] + data).split(b"\n")
+        for line in lines:
+          parsed = parse_line(line.decode())
+          if parsed:
+            yield parsed
+  finally:
+    selector.close()
+    server.close()
+
+class StreamingDetector:
+  """
+  Online counterpart of the batch pipeline in main.py. Records are processed one at a time:
+  a new event, or an event gaining a host, is correlated against the recent events seen on the
+  same IPs, the components it joins are merged, and only the affected incident is re-scored.
+  Whenever an incident's score or priority changes, emit is called with a dict describing it.
+
+  Each incident keeps its FactorGraph, grown in place with add_alert and merge, and its marginals
+  are updated with update_inference(engine). The graphs are per tactic, so re-scoring one costs the
+  same whatever its number of alerts. With "exact" (what "auto" resolves to, as there are at most 12
+  tactics) that is at most 2**12 states per update; with "loopy" belief propagation resumes from the
+  previous messages, around the tactics that changed. Priorities come from a StreamingPriorityAssigner over all current scores,
+  which it rebuilds from the incidents' scores as rescoring piles up removals;
+  only the incidents a record touches are re-prioritised when it arrives.
+  With window_seconds=None every earlier event is a candidate and the incidents and edges are
+  those of the batch pipeline; otherwise events older than the window (in event time, behind the
+  latest event seen) are no longer correlated with new ones, and relationships still waiting for
+  their event or host are dropped once the window has moved past the time they arrived.
+
+  Attributes:
+  H (nx.DiGraph): the correlation graph so far, nodes are event ids
+  components (EventComponents): connected components of H
+  incidents (Dict[str, IncidentRecord]): the current incident of each component root
+  """
+  def __init__(self, window_seconds: float = STREAM_WINDOW_SECONDS, emit=None, engine: str = INFERENCE_ENGINE):
+    self.engine = engine
+    self.window_us = None if window_seconds is None else int(window_seconds * 1_000_000)
+    self.emit = emit or (lambda change: print(json.dumps(change)))
+    self.type_matrix = compile_type_transition_matrix()
+    self.H = nx.DiGraph()
+    self.components = EventComponents()
+    self.assigner = StreamingPriorityAssigner(live_scores=lambda: (incident.score for incident in self.incidents.values()))
+
+    self.events = {}       # event id -> (type code, epoch microseconds)
+    self.event_ips = {}    # event id -> set of IPs
+    self.host_ips = {}     # host id -> IP
+    self.other_entities = set()
+    self.pending_hosts = {}  # host id not seen yet -> (latest time when last linked, events linked to it)
+    self.pending_events = {} # event id not seen yet -> (latest time when last linked, hosts linked to it)
+    self.expired = 0         # pending relationships dropped by _expire_pending
+    self.recent = {}       # IP -> event ids seen on it, oldest are dropped lazily
+    self.first_time = None
+    self.latest_time = None
+
+    self.graphs = {}       # component root -> FactorGraph of the component
+    self.incidents = {}
+    self.records = 0
+    self.latency = KLLSketch()
+    self.latency_total = 0.0
+    self.latency_max = 0.0
+
+  def process(self, key: str, record: dict, received: float = None) -> list:
+    '''
+    Applies one (key, record) of the stream and returns the incident changes it caused, which are
+    also passed to emit. received is the time.perf_counter() at which the record arrived.
+    '''
+    received = time.perf_counter() if received is None else received
+    touched = set()
+    if key == "events":
+      self._add_event(record, touched)
+    elif key == "entities":
+      self._add_entity(record, touched)
+    else:
+      self._add_relationship(record["source"], record["target"], touched)
+
+    if self.window_us is not None and self.latest_time is not None:
+      self._expire_pending()
+
+    roots = {self.components.find(event_id) for event_id in touched}
+    changes = [change for root in roots for change in self._rescore(root)]
+
+    latency = time.perf_counter() - received
+    self.records += 1
+    self.latency.update(latency)
+    self.latency_total += latency
+    self.latency_max = max(self.latency_max, latency)
+    for change in changes:
+      change["latency_ms"] = round(latency * 1000, 3)
+      self.emit(change)
+    return changes
+
+  def run(self, records, stats_every: int = 0):
+    ''' Processes every (key, record) of an iterable, e.g. tail_jsonl or socket_records. '''
+    for key, record in records:
+      self.process(key, record)
+      if stats_every and self.records % stats_every == 0:
+        print(json.dumps({"stats": self.stats()}), file=sys.stderr)
+
+  def _add_event(self, event: dict, touched: set):
+    event_id = event["id"]
+    if event_id in self.events:
+      return
+    timestamp = to_epoch_us(event["timestamp"])
+    self.events[event_id] = (EVENT_TYPE_CODES[event["type"]], timestamp)
+    self.event_ips[event_id] = set()
+    self.first_time = timestamp if self.first_time is None else self.first_time
+    self.latest_time = timestamp if self.latest_time is None else max(self.latest_time, timestamp)
+
+    self.H.add_node(event_id)
+    self.components.add(event_id)
+    tactic_code = TACTIC_CODES[EVENT_TYPE_TO_MITRE[event["type"]][0]]
+    self.graphs[event_id] = FactorGraph.from_summary(TacticSummary())
+    self.graphs[event_id].add_alert(tactic_code, event["severity"], timestamp, len(self.events))
+    touched.add(event_id)
+
+    _, hosts = self.pending_events.pop(event_id, (None, ()))
+    for host in hosts:
+      self._add_relationship(event_id, host, touched)
+
+  def _add_entity(self, entity: dict, touched: set):
+    if entity.get("type") != "Host":
+      self.other_entities.add(entity["id"])
+      self.pending_hosts.pop(entity["id"], None)
+      return
+    ip = entity.get("properties", {}).get("ip_address")
+    if not ip:
+      self.other_entities.add(entity["id"])
+      self.pending_hosts.pop(entity["id"], None)
+      return
+    self.host_ips[entity["id"]] = ip
+    _, event_ids = self.pending_hosts.pop(entity["id"], (None, ()))
+    for event_id in event_ids:
+      self._link(event_id, ip, touched)
+
+  def _add_relationship(self, event_id: str, host: str, touched: set):
+    if host in self.other_entities:
+      return
+    if event_id not in self.events:
+      self._defer(self.pending_events, event_id, host)
+    elif host not in self.host_ips:
+      self._defer(self.pending_hosts, host, event_id)
+    else:
+      self._link(event_id, self.host_ips[host], touched)
+
+  def _defer(self, pending: dict, key: str, value: str):
+    ''' Adds value to pending[key], moving the entry to the end with the latest time so entries stay in expiry order '''
+    _, values = pending.pop(key, (None, []))
+    values.append(value)
+    pending[key] = (self.latest_time, values)
+
+  def _expire_pending(self):
+    ''' Drops pending relationships last linked more than the window before the latest event, oldest first '''
+    cutoff = self.latest_time - self.window_us
+    for pending in (self.pending_events, self.pending_hosts):
+      while pending:
+        key, (stamp, values) = next(iter(pending.items()))
+        if (self.first_time if stamp is None else stamp) >= cutoff: # None: linked before the first event
+          break
+        del pending[key]
+        self.expired += len(values)
+
+  def _link(self, event_id: str, ip: str, touched: set):
+    ''' Records that an event was seen on ip and correlates it with the recent events on ip. '''
+    ips = self.event_ips[event_id]
+    if ip in ips:
+      return
+    ips.add(ip)
+    type_code, timestamp = self.events[event_id]
+
+    kept = []
+    for other in self.recent.get(ip, ()):
+      other_type, other_time = self.events[other]
+      if self.window_us is not None and other_time < self.latest_time - self.window_us:
+        continue # too old, dropped from the bucket
+      kept.append(other)
+      if other_time < timestamp:
+        self._correlate(other, event_id, self.type_matrix[other_type, type_code], touched)
+      elif timestamp < other_time:
+        self._correlate(event_id, other, self.type_matrix[type_code, other_type], touched)
+    kept.append(event_id)
+    self.recent[ip] = kept
+
+  def _correlate(self, u: str, v: str, score: float, touched: set):
+    ''' Adds the edge u -> v if it passes CORRELATION_THRESHOLD, merging the incidents of u and v. '''
+    if score <= CORRELATION_THRESHOLD:
+      return
+    match_IP = ",".join(self.event_ips[u] & self.event_ips[v])
+    if self.H.has_edge(u, v): # already found through another shared IP
+      self.H.edges[u, v]["match_IP"] = match_IP
+      return
+    self.H.add_edge(u, v, weight=float(score), match_IP=match_IP)
+
+    root_u, root_v = self.components.find(u), self.components.find(v)
+    if root_u != root_v:
+      self.components.union(u, v)
+      root = self.components.find(u)
+      absorbed = root_v if root == root_u else root_u
+      self.graphs[root].merge(self.graphs.pop(absorbed))
+      incident = self.incidents.pop(absorbed, None)
+      if incident is not None:
+        self.assigner.remove(incident.score)
+        self.emit({"incident": absorbed, "merged_into": root})
+    touched.update((u, v))
+
+  def _rescore(self, root: str) -> list:
+    ''' Re-runs inference and scoring for one incident; returns its change, if any. '''
+    fg = self.graphs[root]
+    fg.update_inference(self.engine)
+    score = ScoreCalculator.from_summary(fg.summary, fg).compute_weighted_score()
+
+    incident = self.incidents.get(root)
+    if incident is None:
+      incident = self.incidents[root] = IncidentRecord(root, score, fg.marginals, factor_graph=fg)
+      previous_score, previous_priority = None, None
+      self.assigner.assign(incident)
+    else:
+      previous_score, previous_priority = incident.score, incident.priority
+      incident.marginals, incident.factor_graph = fg.marginals, fg
+      self.assigner.assign(incident, score)
+
+    if score == previous_score and incident.priority == previous_priority:
+      return []
+    return [{"incident": root, "alerts": fg.summary.n_alerts, "score": score, "priority": incident.priority,
+             "previous_score": previous_score, "previous_priority": previous_priority}]
+
+  def stats(self) -> dict:
+    ''' Counts so far and the per-record latency, from arrival to the last change emitted, in milliseconds. '''
+    latency = {}
+    if self.records:
+      latency = {"mean": 1000 * self.latency_total / self.records,
+                 "p50" : 1000 * self.latency.quantile(0.5),
+                 "p99" : 1000 * self.latency.quantile(0.99),
+                 "max" : 1000 * self.latency_max}
+    return {"records"   : self.records,
+            "events"    : len(self.events),
+            "edges"     : self.H.number_of_edges(),
+            "incidents" : len(self.incidents),
+            "pending"   : sum(len(values) for _, values in self.pending_events.values()) +
+                          sum(len(values) for _, values in self.pending_hosts.values()),
+            "expired"   : self.expired,
+            "latency_ms": latency}
+
+if __name__ == "__main__":
+  # python stream_detection.py events.jsonl  -> follows the file
+  # python stream_detection.py --socket      -> listens on STREAM_SOCKET_PORT
+  detector = StreamingDetector()
+  source = socket_records() if sys.argv[1:] == ["--socket"] else tail_jsonl(sys.argv[1])
+  try:
+    detector.run(source, stats_every=1000)
+  except KeyboardInterrupt:
+    pass
+  print(json.dumps({"stats": detector.stats()}), file=sys.stderr)
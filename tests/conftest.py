@@ -0,0 +1,7 @@
+import os
+import sys
+
+# config.py reads prob_matrix.json and weight_parameters.json relative to the working directory
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+os.chdir(REPO_ROOT)
+sys.path.insert(0, REPO_ROOT)
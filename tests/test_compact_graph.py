@@ -0,0 +1,41 @@
+import networkx as nx
+
+from attack_correlation import EventComponents, event_components, same_correlation_graph
+from compact_graph import CompactGraph, save_compact_graph
+
+
+def correlation_graph():
+    H = nx.DiGraph()
+    H.add_nodes_from(f"evt_{i}" for i in range(10))
+    edges = [(0, 3, 0.5), (3, 7, 0.25), (7, 0, 0.8), (2, 5, 0.1), (5, 9, 0.3), (1, 4, 0.6)]
+    H.add_edges_from((f"evt_{u}", f"evt_{v}", {"weight": w, "match_IP": f"10.0.0.{u}"}) for u, v, w in edges)
+    components = H.graph["components"] = EventComponents(H.nodes)
+    for u, v in H.edges():
+        components.union(u, v)
+    return H
+
+
+def test_components_match_the_networkx_graph(tmp_path):
+    H = correlation_graph()
+    save_compact_graph(H, str(tmp_path / "graph"))
+    compact = CompactGraph(str(tmp_path / "graph"))
+
+    members, component_of = event_components(compact).components()
+    assert (members, component_of) == event_components(H).components()
+    assert same_correlation_graph(compact.to_networkx(), H)
+
+
+def test_component_subgraph_matches_subgraph_by_ids(tmp_path):
+    H = correlation_graph()
+    save_compact_graph(H, str(tmp_path / "graph"))
+    compact = CompactGraph(str(tmp_path / "graph"))
+
+    members, _ = compact.components()
+    for k, component in enumerate(members):
+        subgraph = compact.component_subgraph(k)
+        assert len(subgraph) == len(component)
+        assert subgraph.number_of_edges() == H.subgraph(component).number_of_edges()
+        graph = subgraph.to_networkx()
+        assert set(graph.nodes) == set(component)
+        assert sorted(graph.edges(data=True)) == sorted(H.subgraph(component).edges(data=True))
+        assert sorted(subgraph.indices.tolist()) == sorted(compact.subgraph(component).indices.tolist())
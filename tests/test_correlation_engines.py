@@ -0,0 +1,89 @@
+import networkx as nx
+import pytest
+
+from attack_correlation import (CORRELATION_ENGINES, attack_correlation, attack_correlation_from_store, event_components,
+                                same_correlation_graph, update_attack_correlation, update_attack_correlation_from_store)
+from data_generator import generate_dataset
+from data_loader import data_load_into_graph
+from event_store import EventStore
+
+
+def canonical(H):
+    """ H with its nodes and edges sorted, for graphs built in a different order """
+    C = nx.DiGraph()
+    C.add_nodes_from(sorted(H.nodes))
+    C.add_edges_from(sorted(H.edges(data=True), key=lambda edge: edge[:2]))
+    return C
+
+
+@pytest.fixture(scope="module")
+def dataset(tmp_path_factory):
+    # Few IPs for many hosts, so that incidents share IPs and correlate across groups
+    filepath = str(tmp_path_factory.mktemp("data") / "events.json")
+    generate_dataset(filepath, n_events=400, n_hosts=60, n_ips=25, time_span=5 * 86400, incident_span=6 * 3600,
+                     hosts_per_incident=2, second_host_fraction=0.3, seed=7)
+    return filepath
+
+
+def test_engines_build_the_same_graph(dataset):
+    G, data = data_load_into_graph(dataset)
+    graphs = {engine: attack_correlation(G, data, engine=engine) for engine in CORRELATION_ENGINES}
+    assert graphs["naive"].number_of_edges() > 0
+    for engine, H in graphs.items():
+        assert same_correlation_graph(H, graphs["naive"]), engine
+        assert event_components(H).components() == event_components(graphs["naive"]).components(), engine
+
+    H = attack_correlation_from_store(EventStore.from_file(dataset))
+    assert same_correlation_graph(canonical(H), canonical(graphs["naive"]))
+    assert event_components(H).components() == event_components(graphs["naive"]).components()
+
+
+def test_streaming_load_builds_the_same_graph(dataset):
+    G, data = data_load_into_graph(dataset)
+    G_stream, data_stream = data_load_into_graph(dataset, streaming=True, chunk_size=97)
+    assert same_correlation_graph(attack_correlation(G_stream, data_stream), attack_correlation(G, data))
+
+
+@pytest.mark.parametrize("batches", [1, 3])
+def test_append_matches_rebuild(dataset, batches):
+    G_full, data = data_load_into_graph(dataset)
+    rebuilt = attack_correlation(G_full, data, engine="naive")
+
+    events, relationships = data["events"], data["relationships"]
+    first = len(events) // 2
+    old_ids = {event["id"] for event in events[:first]}
+    G = nx.MultiDiGraph()
+    for event in events[:first]:
+        G.add_node(event["id"], **event, node_type="event")
+    for entity in data["entities"]:
+        G.add_node(entity["id"], **entity, node_type="entity")
+    for rel in relationships:
+        if rel["source"] in old_ids:
+            G.add_edge(rel["source"], rel["target"], **rel)
+    H = attack_correlation(G, {"events": events[:first]})
+
+    new_events = events[first:]
+    step = -(-len(new_events) // batches)
+    for start in range(0, len(new_events), step):
+        batch = new_events[start:start + step]
+        batch_ids = {event["id"] for event in batch}
+        update_attack_correlation(H, G, batch, new_relationships=[rel for rel in relationships if rel["source"] in batch_ids])
+
+    assert same_correlation_graph(canonical(H), canonical(rebuilt))
+    assert sorted(map(sorted, event_components(H).components()[0])) == sorted(map(sorted, event_components(rebuilt).components()[0]))
+
+
+def test_store_append_matches_rebuild(dataset):
+    store = EventStore.from_file(dataset)
+    rebuilt = attack_correlation_from_store(store)
+
+    # An earlier version of the data: the first half of the events and their relationships
+    G, data = data_load_into_graph(dataset)
+    old = G.copy()
+    old.remove_nodes_from(event["id"] for event in data["events"][len(data["events"]) // 2:])
+    H = attack_correlation_from_store(EventStore.from_graph(old))
+    assert H.number_of_nodes() < rebuilt.number_of_nodes()
+
+    update_attack_correlation_from_store(H, store)
+    assert same_correlation_graph(canonical(H), canonical(rebuilt))
+    assert sorted(map(sorted, event_components(H).components()[0])) == sorted(map(sorted, event_components(rebuilt).components()[0]))
@@ -0,0 +1,138 @@
+import itertools
+
+import numpy as np
+import pytest
+
+from config import MITRE_TACTICS
+import factor_graph
+from factor_graph import (FactorGraph, VariableNode, FactorNode, Messages, CompiledFactorGraph, MAX_ITER,
+                          exact_blocks, exact_marginal_arrays, run_batched_inference)
+
+
+def make_graph(rng, n_variables, edges):
+    """ FactorGraph over variables v0..v{n-1}, with one random unary factor each and a random
+    pairwise factor per (i, j) in edges """
+    fg = FactorGraph.__new__(FactorGraph)
+    fg.variables, fg.factors = dict(), dict()
+    for i in range(n_variables):
+        variable = VariableNode(f"v{i}")
+        unary = FactorNode(f"u{i}", rng.uniform(0.05, 1.0, 2))
+        unary.add_neighbour(variable)
+        variable.add_neighbour(unary)
+        fg.variables[variable.name] = variable
+    for i, j in edges:
+        factor = FactorNode((f"v{i}", f"v{j}"), rng.uniform(0.05, 1.0, (2, 2)))
+        for variable in (fg.variables[f"v{i}"], fg.variables[f"v{j}"]):
+            factor.add_neighbour(variable)
+            variable.add_neighbour(factor)
+        fg.factors[factor.name] = factor
+    return fg
+
+
+def brute_force_marginals(fg):
+    """ P(variable active) by summing the product of every factor's distribution over all states """
+    names = list(fg.variables)
+    index = {name: i for i, name in enumerate(names)}
+    factors = {id(factor): factor for variable in fg.variables.values() for factor in variable.neighbours}
+    total, active = 0.0, np.zeros(len(names))
+    for states in itertools.product((0, 1), repeat=len(names)):
+        p = 1.0
+        for factor in factors.values():
+            p *= factor.distr[tuple(states[index[v.name]] for v in factor.neighbours)]
+        total += p
+        active += p * np.array(states)
+    return dict(zip(names, active / total))
+
+
+def random_edges(rng, n_variables):
+    """ A random subset of the ordered pairs of distinct variables, so the graphs mostly have cycles """
+    pairs = [(i, j) for i in range(n_variables) for j in range(n_variables) if i != j]
+    keep = rng.random(len(pairs)) < rng.uniform(0.1, 0.6)
+    return [pair for pair, kept in zip(pairs, keep) if kept]
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_exact_matches_brute_force_on_random_graphs(seed):
+    rng = np.random.default_rng(seed)
+    n_variables = int(rng.integers(1, 13))
+    fg = make_graph(rng, n_variables, random_edges(rng, n_variables))
+    expected = brute_force_marginals(fg)
+
+    marginals = fg.run_inference("exact")
+    assert marginals.keys() == expected.keys()
+    np.testing.assert_allclose([marginals[name] for name in expected], list(expected.values()), rtol=1e-9, atol=1e-12)
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_exact_matches_brute_force_on_alert_graphs(seed):
+    # Graphs built from alerts, over up to all 12 tactics
+    rng = np.random.default_rng(seed)
+    n_alerts = int(rng.integers(1, 40))
+    fg = FactorGraph.from_arrays(rng.integers(0, len(MITRE_TACTICS), n_alerts), rng.integers(1, 10, n_alerts),
+                                 rng.integers(0, 10**9, n_alerts))
+    expected = brute_force_marginals(fg)
+
+    marginals = fg.run_inference("exact")
+    np.testing.assert_allclose([marginals[name] for name in expected], list(expected.values()), rtol=1e-9, atol=1e-12)
+
+
+def test_batched_exact_matches_single_graphs():
+    rng = np.random.default_rng(0)
+    graphs = [make_graph(rng, n, random_edges(rng, n)) for n in rng.integers(1, 9, 30)]
+    expected = [brute_force_marginals(fg) for fg in graphs]
+
+    batched = exact_marginal_arrays([CompiledFactorGraph(fg) for fg in graphs])
+    for p, marginals in zip(batched, expected):
+        np.testing.assert_allclose(p, list(marginals.values()), rtol=1e-9, atol=1e-12)
+    for marginals, fg_marginals in zip(expected, run_batched_inference(graphs, batch_size=7, engine="exact")):
+        np.testing.assert_allclose(list(fg_marginals.values()), list(marginals.values()), rtol=1e-9, atol=1e-12)
+
+
+def test_exact_blocks_stay_within_block_size():
+    rng = np.random.default_rng(1)
+    graphs = [CompiledFactorGraph(make_graph(rng, 6, random_edges(rng, 6))) for _ in range(50)]
+    costs = [2 ** 6 * (6 + len(g.tables)) for g in graphs]
+    block_size = 3 * max(costs)
+
+    blocks = exact_blocks(graphs, list(range(len(graphs))), 6, block_size)
+    assert [i for block in blocks for i in block] == list(range(len(graphs)))
+    assert len(blocks) > 1
+    for block in blocks:
+        assert sum(costs[i] for i in block) <= block_size
+
+    # A graph larger than the block size is a block of its own
+    assert exact_blocks(graphs, [0, 1, 2], 6, min(costs) - 1) == [[0], [1], [2]]
+
+
+def test_exact_results_do_not_depend_on_blocks(monkeypatch):
+    rng = np.random.default_rng(2)
+    graphs = [CompiledFactorGraph(make_graph(rng, n, random_edges(rng, n))) for n in rng.integers(1, 9, 40)]
+    expected = exact_marginal_arrays(graphs)
+
+    blocks = []
+    def small_blocks(graphs, members, n):
+        split = exact_blocks(graphs, members, n, block_size=1000)
+        blocks.extend(split)
+        return split
+    monkeypatch.setattr(factor_graph, "exact_blocks", small_blocks)
+    for p, q in zip(exact_marginal_arrays(graphs), expected):
+        np.testing.assert_allclose(p, q, rtol=1e-12, atol=1e-15)
+    assert len(blocks) > len({len(g.names) for g in graphs})
+
+
+# Trees small enough for the Messages recursion to reach every leaf before MAX_ITER calls
+TREES = [(1, []), (2, [(0, 1)]), (2, [(1, 0)]), (3, [(0, 1), (1, 2)]), (3, [(0, 1), (0, 2)]), (3, [(1, 0), (2, 0)])]
+
+
+@pytest.mark.parametrize("seed", range(5))
+@pytest.mark.parametrize("n_variables, edges", TREES)
+def test_exact_matches_messages_on_trees(n_variables, edges, seed):
+    fg = make_graph(np.random.default_rng(seed), n_variables, edges)
+    messages = Messages()
+    expected = {}
+    for name, variable in fg.variables.items():
+        expected[name] = messages.marginal(variable)[1]
+        assert messages.i < MAX_ITER # the recursion was not truncated, so it is exact on a tree
+
+    marginals = fg.run_inference("exact")
+    np.testing.assert_allclose([marginals[name] for name in expected], list(expected.values()), rtol=1e-9, atol=1e-12)
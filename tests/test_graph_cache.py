@@ -0,0 +1,60 @@
+import json
+import os
+
+import networkx as nx
+import pytest
+
+from attack_correlation import same_correlation_graph
+from graph_cache import GraphCache
+
+
+def correlation_graph(n):
+    H = nx.DiGraph()
+    H.add_nodes_from(f"evt_{i}" for i in range(n))
+    H.add_edges_from((f"evt_{i}", f"evt_{i + 1}", {"weight": 0.5, "match_IP": "10.0.0.1"}) for i in range(n - 1))
+    return H
+
+
+def cached_files(directory):
+    return sorted(name for name in os.listdir(directory) if name.startswith("attack_correlation_graph_"))
+
+
+@pytest.mark.parametrize("first, second", [("compact", "pickle"), ("pickle", "compact")])
+def test_entries_survive_a_format_change(tmp_path, first, second):
+    directory = str(tmp_path)
+    GraphCache(directory, graph_format=first).put("a", correlation_graph(3))
+
+    cache = GraphCache(directory, graph_format=second)
+    graph = cache.get("a")
+    graph = graph.to_networkx() if first == "compact" else graph
+    assert same_correlation_graph(graph, correlation_graph(3))
+    cache.put("b", correlation_graph(4))
+    assert {key: entry["format"] for key, entry in cache.index.items()} == {"a": first, "b": second}
+    assert cache.stats()["bytes"] == sum(entry["size"] for entry in cache.index.values())
+
+    cache.max_bytes = 0
+    cache.evict()
+    assert cached_files(directory) == []
+
+
+def test_put_replaces_an_entry_stored_in_the_other_format(tmp_path):
+    directory = str(tmp_path)
+    GraphCache(directory, graph_format="compact").put("a", correlation_graph(3))
+    GraphCache(directory, graph_format="pickle").put("a", correlation_graph(3))
+    assert cached_files(directory) == ["attack_correlation_graph_a.pkl"]
+
+
+def test_index_without_formats_is_read(tmp_path):
+    directory = str(tmp_path)
+    GraphCache(directory, graph_format="compact").put("a", correlation_graph(3))
+    GraphCache(directory, graph_format="pickle").put("b", correlation_graph(3))
+    index_path = os.path.join(directory, "cache_index.json")
+    with open(index_path) as f:
+        index = json.load(f)
+    for entry in index.values():
+        del entry["format"]
+    with open(index_path, "w") as f:
+        json.dump(index, f)
+
+    cache = GraphCache(directory)
+    assert {key: entry["format"] for key, entry in cache.index.items()} == {"a": "compact", "b": "pickle"}
@@ -0,0 +1,45 @@
+import numpy as np
+import pytest
+
+import inference_cache
+from factor_graph import FactorGraph
+from inference_cache import InferenceCache, canonical_key, inference_config_fingerprint
+
+
+def alert_graph(tactic_codes):
+    n = len(tactic_codes)
+    return FactorGraph.from_arrays(np.array(tactic_codes), np.full(n, 7), np.arange(n) * 1_000_000)
+
+
+def test_auto_is_keyed_by_the_engine_that_runs(monkeypatch):
+    fg = alert_graph([0, 3, 8])
+    assert canonical_key(fg, "auto") == canonical_key(fg, "exact")
+    monkeypatch.setattr("factor_graph.EXACT_INFERENCE_MAX_VARIABLES", 2)
+    assert canonical_key(fg, "auto") == canonical_key(fg, "loopy")
+
+
+def test_auto_does_not_reuse_marginals_of_the_other_engine(monkeypatch):
+    cache = InferenceCache(path=None)
+    fg = alert_graph([0, 3, 8])
+    cache.run_inference(fg, "auto") # exact
+    monkeypatch.setattr("factor_graph.EXACT_INFERENCE_MAX_VARIABLES", 2)
+    cache.run_inference(alert_graph([0, 3, 8]), "auto") # loopy now
+    assert cache.stats()["misses"] == 2
+
+
+@pytest.mark.parametrize("setting, value", [("EXACT_INFERENCE_MAX_VARIABLES", 2), ("BP_SCHEDULE", "residual"),
+                                            ("BP_TOLERANCE", 1e-4), ("BP_MAX_ITER", 5), ("INFERENCE_ENGINE", "loopy")])
+def test_fingerprint_covers_inference_settings(monkeypatch, setting, value):
+    before = inference_config_fingerprint()
+    monkeypatch.setattr(inference_cache, setting, value)
+    assert inference_config_fingerprint() != before
+
+
+def test_cache_saved_under_other_settings_is_ignored(monkeypatch, tmp_path):
+    path = str(tmp_path / "inference_cache.pkl")
+    cache = InferenceCache(path=path)
+    cache.run_inference(alert_graph([0, 3, 8]))
+    cache.save()
+    assert len(InferenceCache(path=path).entries) == 1
+    monkeypatch.setattr(inference_cache, "BP_SCHEDULE", "residual")
+    assert len(InferenceCache(path=path).entries) == 0
@@ -0,0 +1,106 @@
+import random
+from bisect import bisect_right
+
+import pytest
+
+from attack_scoring import EventsDataTracker, IncidentRecord
+from quantile_sketch import KLLSketch, StreamingPriorityAssigner
+
+
+def exact_rank(sorted_items, x):
+    return bisect_right(sorted_items, x)
+
+
+@pytest.mark.parametrize("n", [50, 10000, 200000])
+def test_rank_is_within_n_over_k(n):
+    rng = random.Random(n)
+    items = [rng.betavariate(2, 5) for _ in range(n)]
+    sketch = KLLSketch(k=200)
+    for x in items:
+        sketch.update(x)
+    items.sort()
+
+    assert len(sketch) == n
+    # O(k) items whatever n: the level capacities add up to about k / (1 - c) = 3k
+    assert sum(len(compactor) for compactor in sketch.compactors) <= 3 * 200 + 2 * len(sketch.compactors)
+    for q in (0.01, 0.1, 0.35, 0.5, 0.9, 0.99):
+        x = items[int(q * (n - 1))]
+        assert abs(sketch.rank(x) - exact_rank(items, x)) <= max(2, 2 * n / 200)
+        assert abs(exact_rank(items, sketch.quantile(q)) - q * n) <= max(2, 2 * n / 200)
+
+
+def test_levels_stay_sorted_and_rank_matches_cdf():
+    rng = random.Random(0)
+    sketch = KLLSketch(k=50)
+    for _ in range(5000):
+        sketch.update(rng.random())
+        if rng.random() < 0.01:
+            assert all(compactor == sorted(compactor) for compactor in sketch.compactors)
+    items, counts = sketch.cdf()
+    for x in (0.0, 0.25, 0.5, 0.75, 1.0):
+        i = bisect_right(items, x)
+        assert sketch.rank(x) == (counts[i - 1] if i else 0)
+
+
+def test_merge_adds_the_other_sketch():
+    rng = random.Random(1)
+    first, second, whole = KLLSketch(k=100), KLLSketch(k=100, seed=1), []
+    for sketch in (first, second):
+        for _ in range(20000):
+            x = rng.random()
+            sketch.update(x)
+            whole.append(x)
+    first.merge(second)
+    whole.sort()
+
+    assert len(first) == 40000
+    assert all(compactor == sorted(compactor) for compactor in first.compactors)
+    for x in (0.1, 0.5, 0.9):
+        assert abs(first.rank(x) - exact_rank(whole, x)) <= 2 * 40000 / 100
+
+
+def churned_priorities(n, updates, live, seed=0):
+    """ Streaming and batch priorities of n incidents after updates random rescorings """
+    rng = random.Random(seed)
+    records = [IncidentRecord(i, rng.betavariate(2, 5), {}) for i in range(n)]
+    assigner = StreamingPriorityAssigner(live_scores=(lambda: (record.score for record in records)) if live else None)
+    for record in records:
+        assigner.assign(record)
+    for _ in range(updates):
+        assigner.assign(records[rng.randrange(n)], rng.betavariate(2, 5))
+
+    streaming = [assigner.priority(record.score) for record in records]
+    tracker = EventsDataTracker(records)
+    tracker.assign_priorities()
+    return assigner, streaming, [record.priority for record in tracker.by_index]
+
+
+@pytest.mark.parametrize("n, updates", [(500, 40000), (1000, 100000)])
+def test_priorities_do_not_drift_under_churn(n, updates):
+    assigner, streaming, batch = churned_priorities(n, updates, live=True)
+    assert len(assigner) == n
+    assert assigner.rebuilds > 0
+    assert assigner.removed.n <= assigner.rebuild * n
+    agreement = sum(a == b for a, b in zip(streaming, batch)) / n
+    assert agreement > 0.97
+    for priority in ("High", "Med"):
+        assert abs(streaming.count(priority) - batch.count(priority)) <= 0.03 * n
+
+
+def test_without_live_scores_removals_accumulate():
+    assigner, streaming, batch = churned_priorities(500, 40000, live=False)
+    assert assigner.rebuilds == 0
+    assert assigner.removed.n == 40000
+    assert sum(a == b for a, b in zip(streaming, batch)) / 500 < 0.97
+
+
+def test_remove_rebuilds_from_the_live_scores():
+    scores = [i / 100 for i in range(100)]
+    assigner = StreamingPriorityAssigner(live_scores=lambda: iter(scores), rebuild=0.1)
+    for score in scores:
+        assigner.add(score)
+    for _ in range(20):
+        assigner.remove(scores.pop())
+    assert assigner.rebuilds > 0
+    assert len(assigner) == len(scores) == 80
+    assert assigner.count_above(0.5) == sum(score > 0.5 for score in scores)
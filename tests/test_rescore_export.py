@@ -0,0 +1,68 @@
+import json
+import os
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+import config
+import user_feedback
+from attack_scoring import EventsDataTracker, IncidentRecord, IncidentRescorer, ScoreCalculator
+from config import MITRE_TACTICS
+
+
+def test_export_after_rescore_writes_the_new_scores(tmp_path):
+    marginals = [{"Initial Access": 0.9, "Collection": 0.2}, {"Initial Access": 0.1, "Collection": 0.7}]
+    tracker = EventsDataTracker([IncidentRecord(i, 0.0, m) for i, m in enumerate(marginals)])
+    contributions = np.array([[m.get(tactic, 0.0) for tactic in MITRE_TACTICS] for m in marginals])
+    rescorer = IncidentRescorer(tracker, contributions, np.array([2, 2]), np.array([np.nan, np.nan]))
+
+    json_path, jsonl_path = str(tmp_path / "scores.json"), str(tmp_path / "scores.jsonl")
+    for weights in ({"Initial Access": 10.0, "Collection": 0.0}, {"Initial Access": 0.0, "Collection": 10.0}):
+        scores = rescorer.rescore(weights, priority_assignment="batch")
+        tracker.export(json_path, jsonl_path)
+
+        with open(json_path) as f:
+            exported = {event["Index"]: (event["Score"], event["Priority"]) for event in json.load(f)}
+        with open(jsonl_path) as f:
+            streamed = {event["index"]: (event["score"], event["priority"]) for event in map(json.loads, f)}
+        assert exported == streamed == {record.index: (record.score, record.priority) for record in tracker.by_index}
+        assert [exported[i][0] for i in range(2)] == scores.tolist()
+
+
+def test_export_from_a_snapshot_while_rescoring(tmp_path):
+    marginals = [{"Initial Access": 0.9}, {"Initial Access": 0.1}]
+    tracker = EventsDataTracker([IncidentRecord(i, 0.0, m) for i, m in enumerate(marginals)])
+    contributions = np.array([[m.get(tactic, 0.0) for tactic in MITRE_TACTICS] for m in marginals])
+    rescorer = IncidentRescorer(tracker, contributions, np.array([2, 2]), np.array([np.nan, np.nan]))
+    rescorer.rescore({"Initial Access": 10.0}, priority_assignment="batch")
+
+    snapshot = tracker.snapshot()
+    rescorer.rescore({"Initial Access": 5.0}, priority_assignment="batch")
+    snapshot.export(str(tmp_path / "scores.json"), str(tmp_path / "scores.jsonl"))
+
+    with open(tmp_path / "scores.json") as f:
+        assert [event["Score"] for event in json.load(f)] == [0.45, 0.05]
+    assert sorted(os.listdir(tmp_path)) == ["scores.json", "scores.jsonl"]
+
+
+def test_feedback_swaps_the_weights_dict(tmp_path, monkeypatch):
+    weights = dict(config.WEIGHT_PARAMETERS)
+    (tmp_path / "weight_parameters.json").write_text(json.dumps(weights))
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(config, "WEIGHT_PARAMETERS", weights)
+
+    new_weights = user_feedback.update_weight_parameters({"Collection": True})
+    assert config.WEIGHT_PARAMETERS is new_weights and new_weights is not weights
+    saved = json.loads((tmp_path / "weight_parameters.json").read_text())
+    assert saved == new_weights
+    assert new_weights["Collection"] == pytest.approx(weights["Collection"] + config.WEIGHT_PARAMATER_ADJUST_AMOUNT)
+
+    # Scores computed from now on, and rescoring by default, use the new dict
+    fg = SimpleNamespace(marginals={"Collection": 0.5})
+    calculator = ScoreCalculator([{"severity": 4, "type": next(t for t, m in config.EVENT_TYPE_TO_MITRE.items() if m[0] == "Collection")}] * 2, fg)
+    assert calculator.compute_weighted_score() == pytest.approx(4 * 0.5 * new_weights["Collection"] / 10)
+    contributions = np.array([[2.0 if tactic == "Collection" else 0.0 for tactic in MITRE_TACTICS]])
+    rescorer = IncidentRescorer(EventsDataTracker([IncidentRecord(0, 0.0, {"Collection": 0.5})]), contributions,
+                                np.array([2]), np.array([np.nan]))
+    assert rescorer.scores().tolist() == pytest.approx([2.0 * new_weights["Collection"] / 20])
@@ -0,0 +1,47 @@
+import json
+import os
+
+import numpy as np
+import pytest
+
+from attack_scoring import ScoreExportSink
+
+
+def record(i):
+    return {"index": i, "name": f"incident{i}", "score": i / 10, "priority": "Low", "marginals": {"Collection": 0.5}}
+
+
+def test_two_sinks_on_one_file_do_not_truncate_each_other(tmp_path):
+    filename = str(tmp_path / "scores.jsonl")
+    first, second = ScoreExportSink(filename, batch_size=2, binary=True), ScoreExportSink(filename, batch_size=2, binary=True)
+    assert first.tmp_filename != second.tmp_filename
+    for i in range(10):
+        first.write(record(i))
+        second.write(record(100 + i))
+    first.finalize()
+    with open(filename) as f:
+        assert [json.loads(line)["index"] for line in f] == list(range(10))
+    second.finalize()
+    with open(filename) as f:
+        assert [json.loads(line)["index"] for line in f] == list(range(100, 110))
+    assert np.load(str(tmp_path / "scores.npz"))["index"].tolist() == list(range(100, 110))
+    assert sorted(os.listdir(tmp_path)) == ["scores.jsonl", "scores.npz"]
+
+
+def test_discard_leaves_the_previous_export(tmp_path):
+    filename = str(tmp_path / "scores.jsonl")
+    with ScoreExportSink(filename) as sink:
+        sink.write(record(1))
+    mode = os.stat(filename).st_mode & 0o777
+
+    with pytest.raises(RuntimeError):
+        with ScoreExportSink(filename, batch_size=1) as sink:
+            sink.write(record(2))
+            raise RuntimeError("export failed")
+    with open(filename) as f:
+        assert [json.loads(line)["index"] for line in f] == [1]
+    assert os.listdir(tmp_path) == ["scores.jsonl"]
+    # Exports are readable like any new file, not private to the owner as mkstemp creates them
+    umask = os.umask(0)
+    os.umask(umask)
+    assert mode == 0o666 & ~umask
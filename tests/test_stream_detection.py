@@ -0,0 +1,82 @@
+import json
+import socket
+import threading
+import time
+
+from stream_detection import StreamingDetector, tail_jsonl, socket_records
+
+
+def jsonl(records):
+    return "\n".join(json.dumps({key: record}) for key, record in records)
+
+
+def event(event_id, timestamp, event_type="Authentication", severity=5):
+    return {"id": event_id, "type": event_type, "severity": severity, "timestamp": timestamp}
+
+
+RECORDS = [("entities", {"id": "host_1", "type": "Host", "properties": {"ip_address": "10.0.0.1"}}),
+           ("events", event("evt_1", "2024-01-01T00:00:00")),
+           ("relationships", {"source": "evt_1", "target": "host_1", "type": "occurred_on"})]
+
+
+def test_tail_jsonl_yields_a_last_line_without_newline(tmp_path):
+    path = tmp_path / "events.jsonl"
+    path.write_text(jsonl(RECORDS)) # no trailing newline
+    assert list(tail_jsonl(str(path), follow=False)) == RECORDS
+
+
+def test_socket_records_yields_a_last_line_without_newline():
+    with socket.socket() as probe: # a free port
+        probe.bind(("127.0.0.1", 0))
+        port = probe.getsockname()[1]
+    received = []
+    def listen():
+        for record in socket_records(port):
+            received.append(record)
+            if len(received) == len(RECORDS):
+                return
+    listener = threading.Thread(target=listen, daemon=True)
+    listener.start()
+    for _ in range(100):
+        try:
+            client = socket.create_connection(("127.0.0.1", port))
+            break
+        except ConnectionRefusedError:
+            time.sleep(0.05)
+    with client:
+        client.sendall(jsonl(RECORDS).encode())
+    listener.join(timeout=5)
+    assert received == RECORDS
+
+
+def test_pending_relationships_expire_with_the_window():
+    detector = StreamingDetector(window_seconds=3600, emit=lambda change: None)
+    detector.process("relationships", {"source": "evt_missing", "target": "host_1", "type": "occurred_on"})
+    detector.process("events", event("evt_1", "2024-01-01T00:00:00"))
+    detector.process("relationships", {"source": "evt_1", "target": "host_unknown", "type": "occurred_on"})
+    assert detector.stats()["pending"] == 2
+
+    detector.process("events", event("evt_2", "2024-01-01T00:30:00"))
+    assert detector.stats()["pending"] == 2 # still within the window
+    detector.process("events", event("evt_3", "2024-01-01T02:00:00"))
+    assert detector.stats()["pending"] == 0
+    assert detector.expired == 2
+
+
+def test_pending_relationships_are_kept_without_window():
+    detector = StreamingDetector(window_seconds=None, emit=lambda change: None)
+    detector.process("relationships", {"source": "evt_late", "target": "host_1", "type": "occurred_on"})
+    detector.process("events", event("evt_1", "2024-01-01T00:00:00"))
+    detector.process("events", event("evt_2", "2030-01-01T00:00:00"))
+    assert detector.stats()["pending"] == 1
+
+
+def test_loopy_detector_warm_starts_its_incidents():
+    detector = StreamingDetector(window_seconds=None, emit=lambda change: None, engine="loopy")
+    detector.process("entities", RECORDS[0][1])
+    for i, (event_type, minute) in enumerate([("Authentication", 0), ("Privilege Operation", 1), ("Data Access", 2)]):
+        detector.process("events", event(f"evt_{i}", f"2024-01-01T00:0{minute}:00", event_type, severity=8))
+        detector.process("relationships", {"source": f"evt_{i}", "target": "host_1", "type": "occurred_on"})
+    (fg,) = detector.graphs.values()
+    assert len(fg.variables) == 3
+    assert fg.inference_stats["engine"] == "warm loopy"
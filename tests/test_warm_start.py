@@ -0,0 +1,55 @@
+import numpy as np
+import pytest
+
+from config import MITRE_TACTICS, BP_TOLERANCE
+from factor_graph import FactorGraph, TacticSummary
+
+
+def random_alerts(rng, n_alerts):
+    return (rng.integers(0, len(MITRE_TACTICS), n_alerts), rng.integers(1, 10, n_alerts),
+            np.sort(rng.integers(0, 10**9, n_alerts)) if rng.random() < 0.5 else rng.integers(0, 10**9, n_alerts))
+
+
+def cold_marginals(tactic_codes, severities, times):
+    fg = FactorGraph.from_arrays(tactic_codes, severities, times)
+    marginals = fg.run_inference("loopy")
+    return marginals, fg.inference_stats["residual"] < BP_TOLERANCE
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_warm_start_after_add_alert_matches_cold_start(seed):
+    rng = np.random.default_rng(seed)
+    tactic_codes, severities, times = random_alerts(rng, 25)
+    fg = FactorGraph.from_summary(TacticSummary())
+    for k in range(len(tactic_codes)):
+        resumes = bool(fg.messages) # the previous run had pairwise factors to keep messages of
+        fg.add_alert(int(tactic_codes[k]), int(severities[k]), int(times[k]), k)
+        warm = fg.update_inference("loopy")
+        assert (fg.inference_stats["engine"] == "warm loopy") == resumes
+        cold, converged = cold_marginals(tactic_codes[:k + 1], severities[:k + 1], times[:k + 1])
+        assert list(warm) == list(cold) # same variables, in order of first appearance
+        if converged and fg.inference_stats["residual"] < BP_TOLERANCE:
+            np.testing.assert_allclose(list(warm.values()), list(cold.values()), atol=1e-6)
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_warm_start_after_merge_matches_cold_start(seed):
+    rng = np.random.default_rng(seed)
+    tactic_codes, severities, times = random_alerts(rng, 20)
+    split = int(rng.integers(1, 19))
+    graphs = []
+    for part in (slice(0, split), slice(split, None)):
+        fg = FactorGraph.from_arrays(tactic_codes[part], severities[part], times[part])
+        fg.run_inference("loopy")
+        graphs.append(fg)
+    present = graphs[1].summary.count > 0
+    graphs[1].summary.order[present] += split # positions continue across the two parts
+    resumes = bool(graphs[0].messages or graphs[1].messages)
+    graphs[0].merge(graphs[1])
+    warm = graphs[0].update_inference("loopy")
+    assert (graphs[0].inference_stats["engine"] == "warm loopy") == resumes
+
+    cold, converged = cold_marginals(tactic_codes, severities, times)
+    assert list(warm) == list(cold)
+    if converged and graphs[0].inference_stats["residual"] < BP_TOLERANCE:
+        np.testing.assert_allclose(list(warm.values()), list(cold.values()), atol=1e-6)
@@ -1,8 +1,12 @@
+import config
 from config import WEIGHT_PARAMATER_ADJUST_AMOUNT
 import json
 
 #user_input is a dictionary that looks like {"name of tactic" : Bool} 
 #where the bool is the user's input of whether the tactic happened
+#config.WEIGHT_PARAMETERS is replaced by the new weights, so scores computed from now on use them.
+#It is swapped rather than updated in place, as a pipeline run may be reading the old dict on another thread.
+#Returns the new weights, e.g. for IncidentRescorer.rescore
 def update_weight_parameters(user_input):
     
     with open('weight_parameters.json','r') as file:
@@ -18,6 +22,9 @@ def update_weight_parameters(user_input):
     with open('weight_parameters.json','w') as file:
         json.dump(thresholds, file)
 
+    config.WEIGHT_PARAMETERS = thresholds
+    return thresholds
+
 #sample/test usage
 if __name__ == "__main__":
     update_weight_parameters({"Exfiltration" : True, "Collection" : False})
\ No newline at end of file
@@ -1,4 +1,6 @@
 import pickle
+import tracemalloc
+import multiprocessing
 import networkx as nx
 import matplotlib.pyplot as plt
 import os
@@ -42,10 +44,52 @@ def load_graph(filename: str) -> nx.Graph:
   with open(filename, "rb") as f:
     return pickle.load(f)
 
-def plot_graph(subgraph: nx.Graph, node_label="description", save_path=None) -> None:
+def peak_memory(func, *args, **kwargs):
+  """
+  Calls func(*args, **kwargs) and returns its result along with the peak
+  number of bytes allocated by Python during the call, as seen by tracemalloc.
+  """
+  already_tracing = tracemalloc.is_tracing()
+  if not already_tracing:
+    tracemalloc.start()
+  tracemalloc.reset_peak()
+  start = tracemalloc.get_traced_memory()[0]
+  try:
+    result = func(*args, **kwargs)
+    return result, tracemalloc.get_traced_memory()[1] - start
+  finally:
+    if not already_tracing:
+      tracemalloc.stop()
+
+def worker_context(preload=()):
+  """
+  multiprocessing context for the worker pools. Pools are started from the GUI's pipeline
+  thread, in a process that already runs other threads, and forking such a process can
+  deadlock on a lock one of them held (Tcl/Xlib, logging, BLAS). "forkserver" forks the
+  workers from a single threaded server process instead, which imports the preload modules
+  once; "spawn" is used where it is not available.
+  """
+  if "forkserver" in multiprocessing.get_all_start_methods():
+    context = multiprocessing.get_context("forkserver")
+    context.set_forkserver_preload(list(preload)) # only read when the server starts
+    return context
+  return multiprocessing.get_context("spawn")
+
+def plot_graph(subgraph: nx.Graph, node_label="description", save_path=None, store=None) -> None:
+  """
+  Plots a subgraph of the attack correlation graph. If an EventStore is given, node
+  severities and labels are read from it instead of from the node attributes.
+  A compact_graph.CompactSubgraph is first turned into the nx.DiGraph it stands for.
+  """
+  if hasattr(subgraph, "to_networkx"):
+    subgraph = subgraph.to_networkx()
+  if store is not None:
+    node_attributes = lambda node, field, default=None: store.get(store.row_of[node], field, default)
+  else:
+    node_attributes = lambda node, field, default=None: subgraph.nodes[node].get(field, default)
 
   # Get node severities and scale them (e.g., severity 1–10 becomes size 300–1000)
-  node_severities = nx.get_node_attributes(subgraph, "severity")
+  node_severities = {node: node_attributes(node, "severity") for node in subgraph.nodes}
   min_sev, max_sev = min(node_severities.values()), max(node_severities.values())
   node_sizes = [
     30 + 1000 * ((node_severities[n] - min_sev) / (max_sev - min_sev)) if max_sev > min_sev else 500
@@ -54,7 +98,7 @@ def plot_graph(subgraph: nx.Graph, node_label="description", save_path=None) ->
 
   # Node labels: use event label (e.g. description or type)
   node_labels = {
-      node: subgraph.nodes[node].get(node_label, "") 
+      node: node_attributes(node, node_label, "") 
       for node in subgraph.nodes
   }
 